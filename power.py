@@ -11,6 +11,8 @@ import re
 import struct
 import glob
 import time
+import json
+import socket
 
 # raw_input() is only available in python 2.
 try:
@@ -33,6 +35,8 @@ UNCORE_MIN = "min_freq_khz"
 UNCORE_MAX = "max_freq_khz"
 UNCORE_CUR = "current_freq_khz"
 TURBO_PATH = "/sys/devices/system/cpu/intel_pstate/no_turbo"
+CPUIDLE_PATH = "/sys/devices/system/cpu/cpuidle/"
+HALTPOLL_PATH = "/sys/module/haltpoll/parameters/"
 CPU_PATH = "/sys/devices/system/cpu/"
 TOPO_PKG = "topology/physical_package_id"
 PKG0_DIE0_PATH = "package_00_die_00"
@@ -52,6 +56,82 @@ freq_P1n = 0
 PKG_TO_DIE_PATH = {}
 CORE_TO_PKG = {}
 list_interval = 0
+pwrd_socket = None
+
+
+def pwrd_request(op, **args):
+    """Send a request to the pwrd daemon and return its response."""
+    args["op"] = op
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(pwrd_socket)
+        sock.sendall(json.dumps(args).encode() + b"\n")
+        response = json.loads(sock.makefile("rb").readline().decode())
+    finally:
+        sock.close()
+    if not response.pop("ok"):
+        raise IOError(response["error"])
+    return response
+
+
+def pwrd_listinfo(cores):
+    """List core information from the pwrd daemon snapshot."""
+    snap = pwrd_request("snapshot")["snapshot"]
+    print("")
+    print("Core    Max    Min    Now  EPP                  C-States disabled")
+    print("==== ====== ====== ====== ==================== =================")
+    for core_id in sorted(snap["cores"], key=int):
+        if cores and int(core_id) not in cores:
+            continue
+        core = snap["cores"][core_id]
+        if not core["online"]:
+            print(f"{core_id:>4} offline")
+            continue
+        disabled = ",".join(sorted(n for n, enabled in core["cstates"].items()
+                                   if not enabled))
+        print(f"{core_id:>4} {core['max_freq']:>6} {core['min_freq']:>6} "
+              f"{core['curr_freq']:>6} {str(core['epp']):<20} {disabled}")
+    print("")
+
+
+def pwrd_main(opts):
+    """Thin client mode, send the requested changes to a pwrd daemon."""
+    cores = None
+    values = {}
+    cstates = {}
+    for opt, arg in opts:
+        if opt in ("-r", "--range"):
+            cores = arg
+    for opt, arg in opts:
+        if opt == '-h':
+            show_help()
+            return
+        if opt == '-l':
+            pwrd_listinfo(range_expand(cores) if cores else None)
+            return
+        if opt in ("-M", "--maxfreq"):
+            values["max_freq"] = arg.lower() if arg.lower() in \
+                ("max", "min", "base") else int(arg)
+        elif opt in ("-m", "--minfreq"):
+            values["min_freq"] = arg.lower() if arg.lower() in \
+                ("max", "min", "base") else int(arg)
+        elif opt in ("-e", "--enable"):
+            cstates[arg] = True
+        elif opt in ("-d", "--disable"):
+            cstates[arg] = False
+        elif opt in ("-U", "--maxUncore"):
+            pwrd_request("uncore", max_freq=int(arg))
+        elif opt in ("-u", "--minUncore"):
+            pwrd_request("uncore", min_freq=int(arg))
+        elif opt not in ("-r", "--range", "--pwrd"):
+            print(f"Option {opt} is not supported with --pwrd")
+    if cstates:
+        values["cstates"] = cstates
+    if values:
+        # all changes to the cores are committed together by the daemon
+        errors = pwrd_request("set", cores=cores, **values)["errors"]
+        for core_id, err in sorted(errors.items(), key=lambda e: int(e[0])):
+            print(f"Could not update core {core_id}: {err}")
 
 
 def getfileval(stateFileName):
@@ -222,6 +302,62 @@ def show_governors():
     print(s)
 
 
+def get_idle_governor():
+    for name in ("current_governor", "current_governor_ro"):
+        try:
+            return getfileval(CPUIDLE_PATH + name)
+        except (IOError, OSError):
+            continue
+    return ""
+
+
+def get_idle_governors():
+    try:
+        return getfileval(CPUIDLE_PATH + "available_governors").split()
+    except (IOError, OSError):
+        current = get_idle_governor()
+        return [current] if current else []
+
+
+def show_idle_governors():
+    print("      Idle Governor: " + get_idle_governor() +
+          " (available: " + str(get_idle_governors()) + ")")
+    try:
+        params = sorted(os.listdir(HALTPOLL_PATH))
+    except OSError:
+        return
+    values = [f"{name}={getfileval(HALTPOLL_PATH + name)}" for name in params]
+    print("    Haltpoll Params: " + ", ".join(values))
+
+
+def set_idle_governor(gov):
+    govs = get_idle_governors()
+    if gov not in govs:
+        print(f"Invalid idle governor {gov}, available governors are {govs}")
+        return
+    govName = CPUIDLE_PATH + "current_governor"
+    try:
+        print("Writing '" + str(gov) + "' to " + govName)
+        writetofile(gov, govName)
+    except (IOError, OSError) as err:
+        print(f"{err}: failed to set idle governor")
+
+
+def set_haltpoll(params):
+    """Set haltpoll parameters from a name=value[,name=value] list."""
+    for param in params.split(","):
+        name, _, value = param.partition("=")
+        paramName = HALTPOLL_PATH + name
+        if not value or not os.path.exists(paramName):
+            print(f"Invalid haltpoll parameter '{param}', skipping.")
+            continue
+        try:
+            print("Writing '" + value + "' to " + paramName)
+            writetofile(value, paramName)
+        except (IOError, OSError) as err:
+            print(f"{err}: failed to set haltpoll parameter {name}")
+
+
 def getinfo():
     global driver
 
@@ -236,6 +372,7 @@ def getinfo():
 
     show_governors()
     show_cstates()
+    show_idle_governors()
 
 
 
@@ -668,6 +805,11 @@ def show_help():
     print('   -u <freq>     Set uncore minimum frequency')
     print('   -T            Enable Turbo')
     print('   -t            Disable Turbo')
+    print('   --idle-governor <governor>')
+    print('                 Set cpuidle governor, e.g. menu, teo or haltpoll')
+    print('   --haltpoll <name=value,...>')
+    print('                 Set guest haltpoll parameters, e.g. guest_halt_poll_ns=200000')
+    print('   --pwrd <sock> Send -M/-m/-e/-d/-U/-u/-l requests to a running pwrd daemon')
     print()
     print('Examples:')
     print()
@@ -843,17 +985,30 @@ def do_menu(cpurange):
         print("Unknown Option")
 
 
-if (check_driver() == 0):
-    print("Invalid Driver : [" + driver + "]")
-    sys.exit(1)
-
 try:
     opts, args = getopt.getopt(sys.argv[1:], "hilM:m:r:s:g:e:d:U:u:TtL:", [
-                               "maxfreq=", "minfreq=", "range="])
+                               "maxfreq=", "minfreq=", "range=", "pwrd=",
+                               "idle-governor=", "haltpoll="])
 except getopt.GetoptError:
     print('d.py -x <maxfreq>')
     sys.exit(-1)
 
+# the daemon has already discovered the system, so skip the checks below
+for opt, arg in opts:
+    if opt == "--pwrd":
+        pwrd_socket = arg
+if pwrd_socket:
+    try:
+        pwrd_main(opts)
+    except (IOError, OSError, ValueError) as err:
+        print(f"pwrd request failed: {err}")
+        sys.exit(1)
+    sys.exit(0)
+
+if (check_driver() == 0):
+    print("Invalid Driver : [" + driver + "]")
+    sys.exit(1)
+
 cpucount = getcpucount()
 cpurange = range_expand('0-' + str(cpucount-1))
 
@@ -936,6 +1091,10 @@ for opt, arg in opts:
     if opt in "-t":
         print("Disabling Turbo")
         set_turbo(1)
+    if opt == "--idle-governor":
+        set_idle_governor(arg)
+    if opt == "--haltpoll":
+        set_haltpoll(arg)
 for opt, arg in opts:
     if opt in ("-s", "--setfreq"):
 
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright(c) 2019 Intel Corporation
+"""
+Reader throughput of pwr.snapshot with one writer and N reader threads.
+
+Each reader thread repeatedly reads the current frequency and frequency
+limits of every core, while one writer thread keeps refreshing or committing.
+The "snapshot" mode reads published snapshots without locking, the "locked"
+mode reads the live objects under a global lock which the writer also holds,
+as applications had to before snapshots. Needs root, like the library.
+"""
+import argparse
+import sys
+import threading
+import time
+
+import pwr
+import pwr.snapshot
+
+
+def _read_snapshot(core_ids):
+    """ Read every core from the current snapshot """
+    snap = pwr.snapshot.current()
+    for core_id in core_ids:
+        state = snap.cores[core_id]
+        _ = (state.curr_freq, state.min_freq, state.max_freq)
+
+
+def _read_locked(core_ids, lock, cores):
+    """ Read every core from the live objects under the global lock """
+    with lock:
+        for core_id in core_ids:
+            core = cores[core_id]
+            _ = (core.curr_freq, core.min_freq, core.max_freq)
+
+
+def _writer(mode, writer, lock, cores, stop, counts):
+    """ Refresh or commit until stopped, counting the operations """
+    core = cores[min(cores)]
+    limits = (core.highest_freq, max(core.lowest_freq, core.highest_freq - 100))
+    ops = 0
+    while not stop.is_set():
+        if writer == "refresh":
+            if mode == "snapshot":
+                pwr.snapshot.refresh(["curr_freq"])
+            else:
+                with lock:
+                    for live in cores.values():
+                        live.refresh_stats(["curr_freq"])
+        else:
+            max_freq = limits[ops % 2]
+            if mode == "snapshot":
+                staged = pwr.snapshot.stage(core)
+                staged.max_freq = max_freq
+                staged.commit()
+            else:
+                with lock:
+                    core.max_freq = max_freq
+                    core.commit()
+        ops += 1
+    counts.append(ops)
+
+
+def _reader(mode, lock, cores, stop, counts):
+    """ Read until stopped, counting the reads of all cores """
+    core_ids = sorted(cores)
+    reads = 0
+    while not stop.is_set():
+        if mode == "snapshot":
+            _read_snapshot(core_ids)
+        else:
+            _read_locked(core_ids, lock, cores)
+        reads += 1
+    counts.append(reads)
+
+
+def run(mode, writer, readers, duration):
+    """
+    Run one writer and a number of readers for duration seconds.
+    Returns the reads per second of all readers and the writer operations
+    per second.
+    """
+    cores = dict((c.core_id, c) for c in pwr.get_cores() if c.online)
+    lock = threading.Lock()
+    stop = threading.Event()
+    read_counts = []
+    write_counts = []
+    threads = [threading.Thread(target=_reader,
+                                args=(mode, lock, cores, stop, read_counts))
+               for _ in range(readers)]
+    if writer != "none":
+        threads.append(threading.Thread(
+            target=_writer, args=(mode, writer, lock, cores, stop, write_counts)))
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    return sum(read_counts) / elapsed, sum(write_counts) / elapsed
+
+
+def main():
+    """ Run the benchmark from the command line """
+    parser = argparse.ArgumentParser(
+        description="Measure pwr state reader throughput with one writer")
+    parser.add_argument("-r", "--readers", default="1,2,4,8",
+                        help="comma separated reader thread counts, default 1,2,4,8")
+    parser.add_argument("-d", "--duration", type=float, default=5.0,
+                        help="seconds to run each configuration, default 5")
+    parser.add_argument("-w", "--writer", choices=("refresh", "commit", "none"),
+                        default="refresh",
+                        help="writer refreshes curr_freq, or commits max_freq "
+                        "changes on the first core, default refresh")
+    parser.add_argument("-m", "--mode", choices=("snapshot", "locked", "both"),
+                        default="both", help="reader mode, default both")
+    args = parser.parse_args()
+
+    try:
+        readers = [int(n) for n in args.readers.split(",")]
+    except ValueError:
+        print("Invalid reader counts {}".format(args.readers), file=sys.stderr)
+        sys.exit(1)
+    modes = ("snapshot", "locked") if args.mode == "both" else (args.mode,)
+
+    core = [c for c in pwr.get_cores() if c.online][0]   # the committing core
+    saved_max = core.max_freq
+    print("{:<9} {:>7} {:>14} {:>14} {:>12}".format(
+        "mode", "readers", "reads/s", "reads/s/thread", "writes/s"))
+    try:
+        for mode in modes:
+            for count in readers:
+                reads, writes = run(mode, args.writer, count, args.duration)
+                print("{:<9} {:>7} {:>14.0f} {:>14.0f} {:>12.0f}".format(
+                    mode, count, reads, reads / max(count, 1), writes))
+    finally:
+        if args.writer == "commit":
+            core.max_freq = saved_max
+            core.commit()
+
+
+if __name__ == "__main__":
+    main()
@@ -1 +1,2 @@
 from .pwr import *
+from .checkpoint import capture, restore
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright(c) 2019 Intel Corporation
+"""
+asyncio interface to the pwr library. Blocking sysfs and MSR access is run
+on a bounded thread pool, so it does not stall the event loop.
+"""
+import asyncio
+import concurrent.futures
+import os
+import time
+
+from . import pwr
+
+
+class AsyncPwr(object):
+    """
+    Awaitable versions of the pwr refresh and commit operations.
+    Work is spread over a bounded executor, with at most
+    package_concurrency operations in flight for each physical package.
+    """
+
+    def __init__(self, max_workers=None, package_concurrency=4, timeout=None):
+        """ AsyncPwr object constructor """
+        if max_workers is None:
+            max_workers = min(32, (os.cpu_count() or 1) + 4)
+        self.package_concurrency = package_concurrency  # per package limit
+        self.timeout = timeout                          # default timeout (s)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+        self._semaphores = {}
+
+    def close(self):
+        """ Shut down the executor, waiting for running operations """
+        self._executor.shutdown(wait=True)
+
+    def _semaphore(self, physical_id):
+        """ Get the concurrency limit for a package in the running loop """
+        loop = asyncio.get_running_loop()
+        key = (id(loop), physical_id)
+        if key not in self._semaphores:
+            self._semaphores[key] = asyncio.Semaphore(self.package_concurrency)
+        return self._semaphores[key]
+
+    async def _run(self, physical_id, func, *args):
+        """ Run a blocking call on the executor, within the package limit """
+        loop = asyncio.get_running_loop()
+        async with self._semaphore(physical_id):
+            return await loop.run_in_executor(self._executor, func, *args)
+
+    async def _gather(self, calls, timeout):
+        """
+        Run (physical_id, func, args) calls concurrently. If the timeout
+        expires or the caller is cancelled, calls which have not started yet
+        are cancelled, calls already running are left to finish.
+        """
+        tasks = [asyncio.ensure_future(self._run(pkg, func, *args))
+                 for pkg, func, args in calls]
+        if not tasks:
+            return []
+        if timeout is None:
+            timeout = self.timeout
+        try:
+            return await asyncio.wait_for(asyncio.gather(*tasks), timeout)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
+    async def _objects(self):
+        """
+        Get library objects without blocking on first initialization, which
+        get_objects() runs only once however many calls race for it
+        """
+        if not pwr._INITIALIZED:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self._executor, pwr.get_objects)
+        return pwr.get_objects()
+
+    async def refresh(self, fields=None, cores=None, timeout=None):
+        """
+        Refresh the named core and CPU stats, all stats if fields is None.
+        Only the given cores, and their CPUs, are refreshed if cores is set.
+        """
+        _, cpus, all_cores = await self._objects()
+        if fields is None:
+            fields = pwr.CORE_STATS + pwr.CPU_STATS
+        core_fields = [f for f in fields if f in pwr.CORE_STATS]
+        cpu_fields = [f for f in fields if f in pwr.CPU_STATS]
+        unknown = set(fields) - set(core_fields) - set(cpu_fields)
+        if unknown:
+            raise ValueError("Cannot refresh unknown stats {}"
+                             .format(sorted(unknown)))
+        if cores is None:
+            cores = all_cores
+        else:
+            cpus = [c for c in cpus if any(k.cpu is c for k in cores)]
+
+        if core_fields:
+            await self._gather([(c.cpu.physical_id, c.refresh_stats,
+                                 (core_fields,)) for c in cores], timeout)
+        if cpu_fields:
+            await self._gather([(c.physical_id, c.refresh_stats,
+                                 (None, cpu_fields)) for c in cpus], timeout)
+
+    async def refresh_all(self, timeout=None):
+        """ Refresh all system, cpu and core stats """
+        system, _, _ = await self._objects()
+        await self.refresh(timeout=timeout)
+        await self._gather([(None, system.refresh_stats, ())], timeout)
+
+    async def commit(self, profile="", cores=None, timeout=None):
+        """
+        Commit core configurations, followed by CPU uncore configurations
+        and the system wide dma_latency request, like System.commit(). Only
+        the given cores are committed, without CPUs and the system, if cores
+        is set. Each object is committed under its lock.
+        """
+        system, cpus, all_cores = await self._objects()
+        await self._gather([(c.cpu.physical_id, _commit, (c, profile))
+                            for c in (all_cores if cores is None else cores)],
+                           timeout)
+        if cores is None:
+            await self._gather([(c.physical_id, _commit, (c,)) for c in cpus],
+                               timeout)
+            await self._gather([(None, system._commit_dma_latency, ())], timeout)
+
+    async def apply(self, plan, timeout=None):
+        """
+        Apply a plan, given as a mapping or list of pairs of Core or CPU
+        object to a dict of attribute values, and commit the changed objects.
+        Each object is changed and committed on the executor, under its lock.
+        """
+        if hasattr(plan, "items"):
+            plan = plan.items()
+        calls = []
+        for obj, values in plan:
+            physical_id = obj.cpu.physical_id if isinstance(obj, pwr.Core) \
+                else obj.physical_id
+            calls.append((physical_id, _set_and_commit, (obj, dict(values))))
+        await self._gather(calls, timeout)
+
+    async def sample(self, interval, fields=None, cores=None, count=None):
+        """
+        Async iterator refreshing the named stats every interval seconds.
+        Each sample is a dict with the sample timestamp, and the values of
+        the refreshed stats for each core id and CPU physical id.
+        """
+        _, cpus, all_cores = await self._objects()
+        if fields is None:
+            fields = pwr.CORE_STATS + pwr.CPU_STATS
+        if cores is None:
+            cores = all_cores
+        cpus = [c for c in cpus if any(k.cpu is c for k in cores)]
+        core_fields = [f for f in fields if f in pwr.CORE_STATS]
+        cpu_fields = [f for f in fields if f in pwr.CPU_STATS]
+
+        deadline = time.monotonic()
+        while count is None or count > 0:
+            await self.refresh(fields, cores)
+            yield {
+                "timestamp": time.time(),
+                "cores": {c.core_id: {f: getattr(c, f) for f in core_fields}
+                          for c in cores},
+                "cpus": {c.physical_id: {f: getattr(c, f) for f in cpu_fields}
+                         for c in cpus},
+            }
+            if count is not None:
+                count -= 1
+            # schedule against a fixed timeline so the period does not drift
+            deadline += interval
+            await asyncio.sleep(max(0, deadline - time.monotonic()))
+
+
+def _commit(obj, *args):
+    """ Commit a Core or CPU object under its lock """
+    with obj._lock:
+        obj.commit(*args)
+
+
+def _set_and_commit(obj, values):
+    """ Set attributes of a Core or CPU object and commit it, under its lock """
+    with obj._lock:
+        for attr, value in values.items():
+            setattr(obj, attr, value)
+        obj.commit()
+
+
+_DEFAULT = None
+
+
+def _default():
+    """ Get the shared AsyncPwr instance used by the module functions """
+    global _DEFAULT
+    if _DEFAULT is None:
+        _DEFAULT = AsyncPwr()
+    return _DEFAULT
+
+
+async def refresh(fields=None, cores=None, timeout=None):
+    """ Refresh the named stats, see AsyncPwr.refresh() """
+    await _default().refresh(fields, cores, timeout)
+
+
+async def refresh_all(timeout=None):
+    """ Refresh all system, cpu and core stats """
+    await _default().refresh_all(timeout)
+
+
+async def commit(profile="", cores=None, timeout=None):
+    """ Commit core and CPU configurations, see AsyncPwr.commit() """
+    await _default().commit(profile, cores, timeout)
+
+
+async def apply(plan, timeout=None):
+    """ Apply attribute values and commit, see AsyncPwr.apply() """
+    await _default().apply(plan, timeout)
+
+
+def sample(interval, fields=None, cores=None, count=None):
+    """ Async iterator over periodic samples, see AsyncPwr.sample() """
+    return _default().sample(interval, fields, cores, count)
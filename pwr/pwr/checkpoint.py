@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright(c) 2019 Intel Corporation
+"""
+Power state checkpoints. capture() reads the tunable state of all online
+cores and packages into a plain dict, which can be serialized as JSON, and
+restore() writes back only the values which have changed since.
+
+    {
+        "version": 1,
+        "timestamp": 1571234567.8,
+        "cores": {"0": {"governor": "powersave", "min_freq_khz": 800000,
+                        "max_freq_khz": 3900000, "epp": "balance_performance",
+                        "cstates": {"POLL": true, "C1": true, "C6": false},
+                        "resume_latency": "0"}},
+        "packages": {"0": {"uncore_min_freq": 1200, "uncore_max_freq": 2400}}
+    }
+"""
+import os
+import struct
+import time
+
+from . import plan
+from . import pwr
+
+CHECKPOINT_VERSION = 1
+
+
+def _governor_filename(core):
+    """ Get the scaling governor sysfs file of a core """
+    return os.path.join(pwr.BASE_PATH, core._cpu_name, "cpufreq",
+                        "scaling_governor")
+
+
+def _capture_core(core):
+    """ Read the tunable state of a core """
+    state = {
+        "governor": pwr._read_sysfs(_governor_filename(core)),
+        "min_freq_khz": int(pwr._read_sysfs(core._min_desired_filename)),
+        "max_freq_khz": int(pwr._read_sysfs(core._max_desired_filename)),
+    }
+    if core.cpu.sys.epp_enabled:
+        state["epp"] = pwr._read_sysfs(core._epp_filename)
+    state["cstates"] = {
+        name: not int(pwr._read_sysfs(
+            os.path.join(core._idle_filename, fname, "disable")))
+        for fname, name in core._states_name_map.items()
+    }
+    if core.resume_latency_available:
+        state["resume_latency"] = pwr._read_sysfs(core._resume_latency_filename)
+    return state
+
+
+def _capture_package(cpu):
+    """ Read the uncore frequency limits of a package """
+    if cpu._uncore_max_freq_khz_filename:
+        return {
+            "uncore_min_freq": int(pwr._read_sysfs(
+                cpu._uncore_min_freq_khz_filename)) // 1000,
+            "uncore_max_freq": int(pwr._read_sysfs(
+                cpu._uncore_max_freq_khz_filename)) // 1000,
+        }
+    regstr = pwr._rdmsr(cpu._msr_core(), pwr.MSR_UNCORE_RATIO_LIMIT)
+    data = struct.unpack('BBBBBBBB', regstr)
+    return {
+        "uncore_min_freq": (data[1] & 0x7F) * 100,  # bits 8-14
+        "uncore_max_freq": (data[0] & 0x7F) * 100,  # bits 0-6
+    }
+
+
+def capture():
+    """
+    Capture the frequency, EPP, C-state, resume latency, governor and uncore
+    configuration of all online cores and packages. Returns a JSON
+    serializable dict.
+    """
+    _, cpus, cores = pwr.get_objects()
+    checkpoint = {
+        "version": CHECKPOINT_VERSION,
+        "timestamp": time.time(),
+        "cores": {},
+        "packages": {},
+    }
+    for core in cores:
+        if not core.online:
+            continue
+        try:
+            checkpoint["cores"][str(core.core_id)] = _capture_core(core)
+        except (IOError, OSError) as err:
+            if not pwr._read_core_topology(core.core_id)[0]:
+                continue  # went offline mid capture
+            raise IOError("{}\nCould not capture state of core {}"
+                          .format(err, core.core_id))
+    for cpu in cpus:
+        checkpoint["packages"][str(cpu.physical_id)] = _capture_package(cpu)
+    return checkpoint
+
+
+def _plan_core(governor_plan, write_plan, core, state):
+    """ Add the writes restoring a core to a governor plan and a settings plan """
+    if "governor" in state:
+        governor_plan.add(_governor_filename(core), state["governor"], core)
+    if "min_freq_khz" in state:
+        write_plan.add(core._min_desired_filename, state["min_freq_khz"], core)
+    if "max_freq_khz" in state:
+        write_plan.add(core._max_desired_filename, state["max_freq_khz"], core)
+    if "epp" in state:
+        write_plan.add(core._epp_filename, state["epp"], core)
+    cstates = state.get("cstates", {})
+    for fname, name in sorted(core._states_name_map.items()):
+        if name in cstates:
+            write_plan.add(os.path.join(core._idle_filename, fname, "disable"),
+                           int(not cstates[name]), core)
+    if "resume_latency" in state:
+        write_plan.add(core._resume_latency_filename, state["resume_latency"], core)
+
+
+def _plan_package(write_plan, cpu, state):
+    """ Add the writes restoring a package to a plan """
+    uncore_min = state.get("uncore_min_freq")
+    uncore_max = state.get("uncore_max_freq")
+    if cpu._uncore_max_freq_khz_filename:
+        if uncore_min is not None:
+            write_plan.add(cpu._uncore_min_freq_khz_filename, uncore_min * 1000, cpu)
+        if uncore_max is not None:
+            write_plan.add(cpu._uncore_max_freq_khz_filename, uncore_max * 1000, cpu)
+        return
+    target = plan.msr_target(cpu._msr_core(), pwr.MSR_UNCORE_RATIO_LIMIT)
+    if uncore_min is not None:
+        write_plan.add(target, ((uncore_min // 100) << 8, 0x7F00), cpu)
+    if uncore_max is not None:
+        write_plan.add(target, (uncore_max // 100, 0x7F), cpu)
+
+
+def _restore_plans(checkpoint):
+    """
+    Get the write plans of the governors and of the other settings which
+    restore a checkpoint, not yet diffed against the current state
+    """
+    if checkpoint.get("version") != CHECKPOINT_VERSION:
+        raise ValueError("Unsupported checkpoint version {}"
+                         .format(checkpoint.get("version")))
+    _, cpus, _ = pwr.get_objects()
+    governor_plan = plan.WritePlan()
+    write_plan = plan.WritePlan()
+    for core_id, state in sorted(checkpoint["cores"].items(),
+                                 key=lambda item: int(item[0])):
+        core = pwr.get_core(int(core_id))
+        if core is None or not core.online:
+            continue  # cannot be restored until it is back online
+        _plan_core(governor_plan, write_plan, core, state)
+    for cpu in cpus:
+        state = checkpoint["packages"].get(str(cpu.physical_id))
+        if state:
+            _plan_package(write_plan, cpu, state)
+    return governor_plan, write_plan
+
+
+def restore_plan(checkpoint):
+    """
+    Get the write plan which restores a checkpoint, with only the values
+    that differ from the current state. Governor changes come first. The
+    other values are compared before they are applied, restore() compares
+    them again after the governor changes.
+    """
+    governor_plan, write_plan = _restore_plans(checkpoint)
+    changed = governor_plan.diff()
+    changed.update(write_plan.diff())
+    return changed
+
+
+def restore(checkpoint):
+    """
+    Restore a checkpoint taken by capture(), writing only the values which
+    have changed. Governors are restored first, and the other values are
+    compared against the state they leave. Cores which are offline are
+    skipped. The restored core and CPU objects are refreshed. Returns a dict
+    of write target to exception.
+    """
+    governor_plan, write_plan = _restore_plans(checkpoint)
+    governor_plan = governor_plan.diff()
+    errors = governor_plan.apply()
+    write_plan = write_plan.diff()
+    errors.update(write_plan.apply())
+    owners = governor_plan.owners()
+    owners += [obj for obj in write_plan.owners() if obj not in owners]
+    for obj in owners:
+        with obj._lock:
+            if isinstance(obj, pwr.Core):
+                obj.refresh_stats(["min_freq", "max_freq", "epp", "cstates",
+                                   "resume_latency"])
+            else:
+                obj.refresh_stats(fields=["uncore_min_freq", "uncore_max_freq"])
+    return errors
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright(c) 2019 Intel Corporation
+"""
+CPUID capability probing.
+
+Power management features are read from CPUID leaves 0x6, 0x7, 0x16 and
+0x1A through the cpuid driver, /dev/cpu/N/cpuid, which never faults and
+needs no /proc/cpuinfo parsing. The leaves are read once per core type, on
+hybrid CPUs, or once for the system otherwise, and cached as Features
+objects. Without the cpuid driver, get_features() returns None and callers
+fall back to probing MSRs and /proc/cpuinfo.
+"""
+import struct
+
+from .internal import cpuinfo
+
+# Core type field of CPUID leaf 0x1A, EAX bits 24-31
+CORE_TYPES = {
+    0x20: "atom",
+    0x40: "core",
+}
+
+_FEATURES = {}      # core type, None if not hybrid, to Features
+_HYBRID = None      # hybrid flag, None until probed
+
+
+class Features(object):
+    """
+    Power management feature flags of a core type, from CPUID
+    """
+
+    def __init__(self, regs):
+        """
+        Features object constructor, regs is a dict of leaf to its eax, ebx,
+        ecx and edx registers. Missing leaves read as zero.
+        """
+        leaf0 = regs.get(0x0, (0, 0, 0, 0))
+        eax6, _, ecx6, _ = regs.get(0x6, (0, 0, 0, 0))
+        _, _, ecx7, edx7 = regs.get(0x7, (0, 0, 0, 0))
+        eax16, ebx16, ecx16, _ = regs.get(0x16, (0, 0, 0, 0))
+        eax1a = regs.get(0x1A, (0, 0, 0, 0))[0]
+
+        self.max_leaf = leaf0[0]                # highest basic leaf
+        self.vendor = struct.pack(              # vendor id, e.g. GenuineIntel
+            "III", leaf0[1], leaf0[3], leaf0[2]).decode("ascii", "replace")
+
+        # leaf 0x6 EAX: thermal and power management
+        self.dts = bool(eax6 & (1 << 0))            # digital temperature sensor
+        self.turbo = bool(eax6 & (1 << 1))          # turbo boost available and enabled
+        self.arat = bool(eax6 & (1 << 2))           # always running APIC timer
+        self.pln = bool(eax6 & (1 << 4))            # power limit notification
+        self.pts = bool(eax6 & (1 << 6))            # package thermal status
+        self.hwp = bool(eax6 & (1 << 7))            # hardware P-states
+        self.hwp_notify = bool(eax6 & (1 << 8))     # HWP notification interrupt
+        self.hwp_act_window = bool(eax6 & (1 << 9))  # HWP activity window
+        self.hwp_epp = bool(eax6 & (1 << 10))       # HWP energy performance preference
+        self.hwp_pkg_req = bool(eax6 & (1 << 11))   # HWP package level request
+        self.hdc = bool(eax6 & (1 << 13))           # hardware duty cycling
+        self.turbo_max_3 = bool(eax6 & (1 << 14))   # turbo boost max 3.0
+        self.hwp_fast_request = bool(eax6 & (1 << 18))  # fast IA32_HWP_REQUEST access
+        self.hfi = bool(eax6 & (1 << 19))           # hardware feedback interface
+        # leaf 0x6 ECX
+        self.aperfmperf = bool(ecx6 & (1 << 0))     # APERF/MPERF effective frequency
+        self.epb = bool(ecx6 & (1 << 3))            # energy performance bias
+
+        # leaf 0x7 subleaf 0
+        self.waitpkg = bool(ecx7 & (1 << 5))        # UMWAIT/TPAUSE light C0 states
+        self.hybrid = bool(edx7 & (1 << 15))        # hybrid core types
+
+        # leaf 0x16, frequencies in MHz, None if not reported
+        self.base_freq = (eax16 & 0xFFFF) or None   # processor base frequency
+        self.max_freq = (ebx16 & 0xFFFF) or None    # maximum frequency
+        self.bus_freq = (ecx16 & 0xFFFF) or None    # bus (reference) frequency
+
+        # leaf 0x1A, hybrid core type
+        self.core_type = CORE_TYPES.get(eax1a >> 24) if self.hybrid else None
+
+    def __repr__(self):
+        flags = sorted(k for k, v in vars(self).items() if v is True)
+        return "Features({})".format(" ".join(flags))
+
+
+def _read_leaves(core):
+    """ Read the power management CPUID leaves of a core """
+    regs = {0x0: cpuinfo.read_cpuid(core, 0x0)}
+    for leaf in (0x6, 0x7, 0x16, 0x1A):
+        if leaf <= regs[0x0][0]:
+            regs[leaf] = cpuinfo.read_cpuid(core, leaf)
+    return regs
+
+
+def _core_type(core):
+    """ Get the core type of a core, None if the CPU is not hybrid """
+    global _HYBRID
+    if _HYBRID is None:
+        leaf0 = cpuinfo.read_cpuid(core, 0x0)
+        _HYBRID = leaf0[0] >= 0x7 and bool(cpuinfo.read_cpuid(core, 0x7)[3] & (1 << 15))
+    if not _HYBRID:
+        return None
+    return CORE_TYPES.get(cpuinfo.read_cpuid(core, 0x1A)[0] >> 24)
+
+
+def get_features(core=0, core_type=None):
+    """
+    Get the Features of a core, read once per core type. The core type can
+    be given when it is already known, to skip probing it. Returns None if
+    CPUID cannot be read, e.g. without the cpuid driver.
+    """
+    try:
+        if core_type is None:
+            core_type = _core_type(core)
+        if core_type not in _FEATURES:
+            _FEATURES[core_type] = Features(_read_leaves(core))
+    except (IOError, OSError):
+        return None
+    return _FEATURES[core_type]
+
+
+def clear_cache():
+    """ Forget the probed features, e.g. after a microcode or BIOS change """
+    global _HYBRID
+    _FEATURES.clear()
+    _HYBRID = None
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright(c) 2019 Intel Corporation
+"""
+C-state planning from cpuidle latency and target residency data.
+
+Given a wakeup latency budget, the deepest C-states whose exit latency fits
+in the budget are enabled on each core and the deeper ones are disabled.
+The cpuidle governor, which picks among the enabled states, and the guest
+haltpoll parameters can be read and set, and the idle residency of each
+state sampled to check how well the governor's choices fit the workload.
+"""
+import collections
+import os
+import time
+
+from . import plan
+from . import pwr
+
+StateInfo = collections.namedtuple("StateInfo", [
+    "state",        # cpuidle directory name, e.g. state3
+    "name",         # C-state name, e.g. C6
+    "latency",      # exit latency in us
+    "residency",    # target residency in us
+])
+
+CPUIDLE_PATH = os.path.join(pwr.BASE_PATH, "cpuidle")
+HALTPOLL_PATH = "/sys/module/haltpoll/parameters"
+
+Residency = collections.namedtuple("Residency", [
+    "name",         # C-state name
+    "usage",        # times the state was entered
+    "time",         # time spent in the state in us
+    "share",        # fraction of the sampled period spent in the state
+    "above",        # entries cut short, woken before the target residency
+    "below",        # entries where a deeper state would have fit
+])
+
+
+def states(core):
+    """ Get the C-states of a core, from shallowest to deepest """
+    infos = []
+    for fname, name in core._states_name_map.items():
+        state_dir = os.path.join(core._idle_filename, fname)
+        try:
+            infos.append(StateInfo(
+                state=fname,
+                name=name,
+                latency=int(pwr._read_sysfs(os.path.join(state_dir, "latency"))),
+                residency=int(pwr._read_sysfs(os.path.join(state_dir, "residency")))))
+        except (IOError, OSError) as err:
+            raise IOError("{}\nCould not read C-state {} of core {}"
+                          .format(err, name, core.core_id))
+    return sorted(infos, key=lambda s: int(s.state[len("state"):]))
+
+
+def allowed_states(core, max_latency, idle_duration=None):
+    """
+    Get the C-state configuration of a core for a wakeup latency budget in us,
+    as a dict of C-state name to enabled flag. States whose target residency
+    is longer than idle_duration, the expected idle period in us, are also
+    disabled, as they would not save any power.
+    """
+    cstates = {}
+    for info in states(core):
+        enabled = info.latency <= max_latency
+        if idle_duration is not None and info.residency > idle_duration:
+            enabled = False
+        cstates[info.name] = enabled or info.latency == 0
+    return cstates
+
+
+def deepest_state(core, max_latency, idle_duration=None):
+    """ Get the StateInfo of the deepest C-state allowed on a core """
+    allowed = allowed_states(core, max_latency, idle_duration)
+    enabled = [s for s in states(core) if allowed[s.name]]
+    return enabled[-1] if enabled else None
+
+
+def plan_latency(cores, max_latency, idle_duration=None, write_plan=None):
+    """
+    Add the C-state writes for a wakeup latency budget on the given cores to
+    a write plan, a new one if not given. Offline cores are skipped.
+    """
+    if write_plan is None:
+        write_plan = plan.WritePlan()
+    for core in cores:
+        if not core.online:
+            continue
+        allowed = allowed_states(core, max_latency, idle_duration)
+        for fname, name in sorted(core._states_name_map.items()):
+            write_plan.add(os.path.join(core._idle_filename, fname, "disable"),
+                           int(not allowed[name]), core)
+    return write_plan
+
+
+def apply_latency(cores, max_latency, idle_duration=None):
+    """
+    Apply a wakeup latency budget in us on the given cores, writing only
+    changed C-states. Returns a dict of write target to exception.
+    """
+    write_plan = plan_latency(cores, max_latency, idle_duration).diff()
+    errors = write_plan.apply()
+    for core in write_plan.owners():
+        with core._lock:
+            core.refresh_stats(["cstates"])
+    return errors
+
+
+def current_governor():
+    """ Get the name of the cpuidle governor in use, None without cpuidle """
+    for fname in ("current_governor", "current_governor_ro"):
+        try:
+            return pwr._read_sysfs(os.path.join(CPUIDLE_PATH, fname))
+        except (IOError, OSError):
+            continue
+    return None
+
+
+def available_governors():
+    """ Get the names of the cpuidle governors which can be selected """
+    try:
+        return pwr._read_sysfs(
+            os.path.join(CPUIDLE_PATH, "available_governors")).split()
+    except (IOError, OSError):
+        # older kernels only list them with cpuidle_sysfs_switch
+        current = current_governor()
+        return [current] if current else []
+
+
+def plan_governor(name, write_plan=None):
+    """ Add the write selecting a cpuidle governor to a write plan """
+    if write_plan is None:
+        write_plan = plan.WritePlan()
+    filename = os.path.join(CPUIDLE_PATH, "current_governor")
+    if not os.path.exists(filename):
+        raise ValueError("Cannot set cpuidle governor to {}, the governor can "
+                         "not be changed on this system".format(name))
+    available = available_governors()
+    if name not in available:
+        raise ValueError("Invalid cpuidle governor {}, available governors are {}"
+                         .format(name, available))
+    write_plan.add(filename, name)
+    return write_plan
+
+
+def set_governor(name):
+    """ Select the cpuidle governor, if it is not already in use """
+    errors = plan_governor(name).diff().apply()
+    for err in errors.values():
+        raise IOError("{}\nCould not set cpuidle governor to {}".format(err, name))
+
+
+def _parse_param(value):
+    """ Convert a module parameter to a bool or int where it is one """
+    if value in ("Y", "N"):
+        return value == "Y"
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+def haltpoll_params():
+    """
+    Get the guest haltpoll parameters as a dict of name to value, empty if
+    the haltpoll driver is not loaded
+    """
+    try:
+        names = sorted(os.listdir(HALTPOLL_PATH))
+    except OSError:
+        return {}
+    return {name: _parse_param(pwr._read_sysfs(os.path.join(HALTPOLL_PATH, name)))
+            for name in names}
+
+
+def plan_haltpoll(params, write_plan=None):
+    """ Add the writes setting guest haltpoll parameters to a write plan """
+    if write_plan is None:
+        write_plan = plan.WritePlan()
+    current = haltpoll_params()
+    if not current:
+        raise ValueError("Cannot set haltpoll parameters, the haltpoll driver "
+                         "is not loaded")
+    unknown = set(params) - set(current)
+    if unknown:
+        raise ValueError("Unknown haltpoll parameters {}, available parameters "
+                         "are {}".format(sorted(unknown), sorted(current)))
+    for name, value in sorted(params.items()):
+        if isinstance(current[name], bool):
+            if not isinstance(value, bool):
+                raise ValueError("Invalid value {} for haltpoll parameter {}, "
+                                 "must be true or false".format(value, name))
+            value = "Y" if value else "N"
+        elif isinstance(value, bool) or not isinstance(value, int) or value < 0:
+            raise ValueError("Invalid value {} for haltpoll parameter {}"
+                             .format(value, name))
+        write_plan.add(os.path.join(HALTPOLL_PATH, name), value)
+    return write_plan
+
+
+def set_haltpoll(params):
+    """
+    Set guest haltpoll parameters from a dict of name to value, writing only
+    the ones which change. Returns a dict of write target to exception.
+    """
+    return plan_haltpoll(params).diff().apply()
+
+
+def usage(core):
+    """
+    Get the cumulative usage counters of the C-states of a core, as a dict
+    of C-state name to (usage, time, above, below)
+    """
+    counters = {}
+    for fname, name in core._states_name_map.items():
+        state_dir = os.path.join(core._idle_filename, fname)
+        values = []
+        for counter in ("usage", "time", "above", "below"):
+            try:
+                values.append(int(pwr._read_sysfs(os.path.join(state_dir, counter))))
+            except (IOError, OSError) as err:
+                if counter in ("usage", "time") or err.errno != 2:
+                    raise IOError("{}\nCould not read C-state {} usage of core {}"
+                                  .format(err, name, core.core_id))
+                values.append(0)  # above and below are missing on older kernels
+        counters[name] = tuple(values)
+    return counters
+
+
+def residency(cores, interval=1.0):
+    """
+    Sample the C-state usage of the given cores over interval seconds.
+    Returns a dict of core id to a list of Residency, from the shallowest
+    to the deepest state. Many "above" entries mean the governor picks
+    states too deep for the wakeup pattern, many "below" entries mean it
+    leaves power on the table. Cores which go offline are left out.
+    """
+    cores = [c for c in cores if c.online]
+    before = {}
+    for core in cores:
+        try:
+            before[core.core_id] = usage(core)
+        except IOError:
+            continue
+    start = time.monotonic()
+    time.sleep(interval)
+    period = (time.monotonic() - start) * 1000000
+
+    result = {}
+    for core in cores:
+        if core.core_id not in before:
+            continue
+        try:
+            after = usage(core)
+            infos = states(core)
+        except IOError:
+            continue
+        samples = []
+        for info in infos:
+            count, spent, above, below = [
+                a - b for a, b in zip(after[info.name], before[core.core_id][info.name])]
+            samples.append(Residency(info.name, count, spent, spent / period,
+                                     above, below))
+        result[core.core_id] = samples
+    return result
@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright(c) 2019 Intel Corporation
+"""
+DPDK lcore busyness consumer.
+
+Reads the lcore busyness telemetry added to DPDK by the patches in
+ipm/patches/dpdk over the DPDK telemetry socket, maps lcores to cpus using
+the lcore cpusets, and provides the result as a busyness source for the
+userspace governor in pwr.governor. FakeTelemetryServer serves the same
+commands without a DPDK application, for testing.
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+from . import governor
+from . import pwr
+
+DEFAULT_SOCKET = "/var/run/dpdk/rte/dpdk_telemetry.v2"
+BUSYNESS_CMD = "/eal/lcore/busyness"
+CAPACITY_CMD = "/eal/lcore/capacity_used"
+CPUSET_CMD = "/eal/lcore/cpuset"
+METRICS = {
+    "busyness": BUSYNESS_CMD,
+    "capacity_used": CAPACITY_CMD,
+}
+BUSYNESS_NOT_SET = -1
+
+
+class TelemetryClient(object):
+    """
+    Client for the DPDK telemetry v2 socket. Commands are sent as strings
+    and answered with a JSON object keyed by the command.
+    """
+
+    def __init__(self, path=DEFAULT_SOCKET, timeout=1.0):
+        """ TelemetryClient object constructor """
+        self.path = path                    # telemetry socket path
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self._sock.settimeout(timeout)
+        try:
+            self._sock.connect(path)
+            # the application greets every new connection
+            greeting = json.loads(self._sock.recv(1024).decode())
+        except (IOError, OSError, ValueError) as err:
+            self._sock.close()
+            raise IOError("{}\nCould not connect to DPDK telemetry at {}"
+                          .format(err, path))
+        self.pid = greeting.get("pid")                  # application pid
+        self.max_output_len = greeting.get("max_output_len", 16384)
+
+    def command(self, cmd, params=None):
+        """ Run a telemetry command and return its data """
+        request = cmd if params is None else "{},{}".format(cmd, params)
+        try:
+            self._sock.send(request.encode())
+            reply = self._sock.recv(self.max_output_len)
+        except (IOError, OSError) as err:
+            raise IOError("{}\nDPDK telemetry command {} failed".format(err, cmd))
+        if not reply:
+            raise IOError("DPDK telemetry connection closed by {}".format(self.path))
+        try:
+            return json.loads(reply.decode())[cmd]
+        except (ValueError, KeyError):
+            raise IOError("Invalid reply to DPDK telemetry command {}".format(cmd))
+
+    def close(self):
+        """ Close the connection """
+        self._sock.close()
+
+
+class DpdkSource(object):
+    """
+    Governor busyness source reading DPDK lcore telemetry. Lcores are mapped
+    to the cpu in their cpuset, lcores not pinned to a single cpu are ignored.
+    The application is queried at most once every min_interval seconds, and
+    reconnected to with exponential backoff if it goes away, during which
+    no busyness is reported.
+    """
+
+    def __init__(self, path=DEFAULT_SOCKET, metric="busyness", min_interval=0.01,
+                 cpuset_interval=5.0, reconnect_interval=0.5,
+                 max_reconnect_interval=30.0, timeout=1.0):
+        """ DpdkSource object constructor """
+        if metric not in METRICS:
+            raise ValueError("Invalid metric {}, available metrics are {}"
+                             .format(metric, list(METRICS)))
+        self.path = path                                # telemetry socket path
+        self.metric = metric                            # busyness or capacity_used
+        self.min_interval = min_interval                # fastest query period
+        self.cpuset_interval = cpuset_interval          # lcore mapping refresh period
+        self.reconnect_interval = reconnect_interval    # first reconnect delay
+        self.max_reconnect_interval = max_reconnect_interval
+        self.timeout = timeout                          # socket timeout
+
+        self.connects = 0                               # successful connects
+        self.errors = 0                                 # failed queries
+
+        self._client = None
+        self._lcore_cpus = {}
+        self._cpuset_time = 0.0
+        self._last = {}
+        self._last_time = None
+        self._retry_delay = reconnect_interval
+        self._retry_time = 0.0
+
+    def _connect(self, now):
+        """ Try to connect, returns False while waiting to retry """
+        if now < self._retry_time:
+            return False
+        try:
+            self._client = TelemetryClient(self.path, self.timeout)
+        except IOError:
+            self._retry_time = now + self._retry_delay
+            self._retry_delay = min(self._retry_delay * 2, self.max_reconnect_interval)
+            return False
+        self.connects += 1
+        self._retry_delay = self.reconnect_interval
+        self._cpuset_time = 0.0
+        return True
+
+    def _disconnect(self, now):
+        """ Drop the connection after a failure and schedule a reconnect """
+        self.errors += 1
+        self._client.close()
+        self._client = None
+        self._last = {}
+        self._retry_time = now + self._retry_delay
+
+    def _update_cpusets(self):
+        """ Map lcores pinned to a single cpu to that cpu """
+        cpusets = self._client.command(CPUSET_CMD)
+        self._lcore_cpus = {int(lcore): cpus[0] for lcore, cpus in cpusets.items()
+                            if len(cpus) == 1}
+
+    def lcore_cpus(self):
+        """ Get the current mapping of lcore id to cpu id """
+        return dict(self._lcore_cpus)
+
+    def poll(self):
+        """
+        Query the application if min_interval has passed since the last
+        query, returns a dict of cpu id to busyness
+        """
+        now = time.monotonic()
+        if self._last_time is not None and now - self._last_time < self.min_interval:
+            return self._last
+        self._last_time = now
+        if self._client is None and not self._connect(now):
+            return {}
+        try:
+            if now - self._cpuset_time >= self.cpuset_interval:
+                self._update_cpusets()
+                self._cpuset_time = now
+            values = self._client.command(METRICS[self.metric])
+        except IOError:
+            self._disconnect(now)
+            return {}
+
+        busyness = {}
+        for lcore, value in values.items():
+            cpu = self._lcore_cpus.get(int(lcore))
+            if cpu is None or value == BUSYNESS_NOT_SET:
+                continue
+            # several lcores sharing a cpu, the busiest one counts
+            busyness[cpu] = max(value, busyness.get(cpu, 0))
+        self._last = busyness
+        return busyness
+
+    def read(self, core_ids):
+        """ Get busyness of the given cores """
+        busyness = self.poll()
+        return {c: busyness[c] for c in core_ids if c in busyness}
+
+    def close(self):
+        """ Close the telemetry connection """
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+
+class FakeTelemetryServer(object):
+    """
+    Fake DPDK telemetry v2 server for testing. Greets every connection like
+    the application does, and answers the lcore commands from the cpusets,
+    busyness and capacity_used dicts, which can be changed while it runs.
+    Other commands are answered with null data. Each command is logged as
+    received. disconnect() drops the clients, and stop() removes the
+    socket, to exercise their reconnect handling.
+    """
+
+    def __init__(self, path, cpusets=None, busyness=None, capacity_used=None,
+                 pid=None, max_output_len=16384):
+        """ FakeTelemetryServer object constructor """
+        self.path = path                                # telemetry socket path
+        self.cpusets = dict(cpusets or {})              # lcore id to list of cpus
+        self.busyness = dict(busyness or {})            # lcore id to busyness
+        self.capacity_used = dict(capacity_used or {})  # lcore id to capacity used
+        self.pid = os.getpid() if pid is None else pid  # reported application pid
+        self.max_output_len = max_output_len            # reported reply size limit
+        self.connects = 0                               # connections accepted
+        self.commands = []                              # log of commands
+
+        self._sock = None
+        self._thread = None
+        self._conns = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        """ Listen on the socket path, serving clients in background threads """
+        if self._sock is not None:
+            return
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        try:
+            sock.bind(self.path)
+            sock.listen(4)
+        except (IOError, OSError) as err:
+            sock.close()
+            raise IOError("{}\nCould not listen on {}".format(err, self.path))
+        self._sock = sock
+        self._thread = threading.Thread(target=self._accept, args=(sock,),
+                                        name="pwr-fake-telemetry")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _accept(self, sock):
+        """ Accept and greet clients until the listening socket is shut down """
+        greeting = json.dumps({"version": "DPDK fake telemetry", "pid": self.pid,
+                               "max_output_len": self.max_output_len}).encode()
+        while True:
+            try:
+                conn, _ = sock.accept()
+            except (IOError, OSError):
+                return
+            with self._lock:
+                self._conns.append(conn)
+                self.connects += 1
+            thread = threading.Thread(target=self._serve, args=(conn, greeting),
+                                      name="pwr-fake-telemetry-client")
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, conn, greeting):
+        """ Answer the commands of a client until it goes away """
+        try:
+            conn.send(greeting)
+            while True:
+                request = conn.recv(1024)
+                if not request:
+                    break
+                cmd = request.decode().split(",", 1)[0]
+                self.commands.append(cmd)
+                reply = json.dumps({cmd: self._data(cmd)}).encode()
+                conn.send(reply[:self.max_output_len])
+        except (IOError, OSError):
+            pass
+        self._drop(conn)
+
+    def _data(self, cmd):
+        """ Get the reply data of a command """
+        if cmd == "/":
+            return [CPUSET_CMD] + [METRICS[m] for m in sorted(METRICS)]
+        values = {
+            CPUSET_CMD: self.cpusets,
+            BUSYNESS_CMD: self.busyness,
+            CAPACITY_CMD: self.capacity_used,
+        }.get(cmd)
+        if values is None:
+            return None
+        return {str(lcore): value for lcore, value in dict(values).items()}
+
+    def _drop(self, conn):
+        """ Close a client connection """
+        with self._lock:
+            if conn in self._conns:
+                self._conns.remove(conn)
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except (IOError, OSError):
+            pass
+        conn.close()
+
+    def disconnect(self):
+        """ Drop all clients, as if the application had restarted """
+        with self._lock:
+            conns = list(self._conns)
+        for conn in conns:
+            self._drop(conn)
+
+    def stop(self):
+        """ Stop listening, drop all clients and remove the socket """
+        if self._sock is None:
+            return
+        # shutdown wakes up the accept() of the background thread
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except (IOError, OSError):
+            pass
+        self._sock.close()
+        self._sock = None
+        self._thread.join()
+        self._thread = None
+        self.disconnect()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+def main():
+    """ Drive core frequencies from the busyness of a DPDK application """
+    parser = argparse.ArgumentParser(
+        description="Scale core frequencies with DPDK lcore busyness")
+    parser.add_argument("-s", "--socket", default=DEFAULT_SOCKET,
+                        help="DPDK telemetry socket (default: %(default)s)")
+    parser.add_argument("-c", "--cores",
+                        help="cores to scale, the cpus of the application "
+                             "lcores if not given")
+    parser.add_argument("-m", "--metric", choices=sorted(METRICS),
+                        default="busyness", help="telemetry metric to use")
+    parser.add_argument("-p", "--period", type=float, default=10.0,
+                        help="control period in ms")
+    parser.add_argument("-u", "--up", type=float, default=80.0,
+                        help="busyness to step frequency up at")
+    parser.add_argument("-d", "--down", type=float, default=30.0,
+                        help="busyness to step frequency down at")
+    parser.add_argument("--step", type=int, default=100,
+                        help="frequency step in MHz")
+    args = parser.parse_args()
+
+    source = DpdkSource(args.socket, args.metric, min_interval=args.period / 1000.0)
+    try:
+        if args.cores:
+            core_ids = pwr._parse_cpulist(args.cores)
+        else:
+            while not source.poll() and not source.lcore_cpus():
+                time.sleep(source.reconnect_interval)
+            core_ids = sorted(set(source.lcore_cpus().values()))
+        cores = [pwr.get_core(c) for c in core_ids]
+        if None in cores:
+            raise ValueError("Invalid core list {}".format(core_ids))
+        gov = governor.Governor(cores, source, period=args.period / 1000.0,
+                                up_threshold=args.up, down_threshold=args.down,
+                                step=args.step)
+        gov.run()
+    except (IOError, OSError, ValueError) as err:
+        print(err, file=sys.stderr)
+        sys.exit(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        source.close()
+
+
+if __name__ == "__main__":
+    main()
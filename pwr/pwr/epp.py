@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright(c) 2019 Intel Corporation
+"""
+Workload adaptive EPP tuning.
+
+Each period, the load of every core is measured from its C0 residency and
+effective frequency, and its EPP is moved between a performance bound for
+fully loaded cores and a power saving bound for idle ones. Numeric EPP
+values are used where the driver accepts them, otherwise the nearest
+available named preference is used.
+"""
+import struct
+import threading
+import time
+
+from . import governor
+from . import plan
+from . import pwr
+
+MSR_IA32_APERF = 0xE8
+
+
+def _epp_number(epp):
+    """ Get the numeric value of an EPP name or number, None if unknown """
+    if epp in pwr.EPP_VALUES:
+        return pwr.EPP_VALUES[epp]
+    try:
+        return int(epp)
+    except (TypeError, ValueError):
+        return None
+
+
+class EppTuner(object):
+    """
+    Moves the EPP of each core between perf_epp, used at full load, and
+    power_epp, used when idle. Load is the C0 residency of the core, scaled
+    up by the ratio of its effective frequency over base frequency while
+    turbo is in use, and smoothed over periods. A new EPP is only written
+    if it differs from the current one by at least hysteresis, and all
+    writes of a period are applied as one batch.
+    """
+
+    def __init__(self, cores, perf_epp="performance", power_epp="balance_power",
+                 period=1.0, hysteresis=32, smoothing=0.5, source=None,
+                 numeric=None):
+        """ EppTuner object constructor """
+        self.perf_epp = _epp_number(perf_epp)
+        self.power_epp = _epp_number(power_epp)
+        if self.perf_epp is None or self.power_epp is None or \
+                not 0 <= self.perf_epp <= self.power_epp <= 255:
+            raise ValueError("Invalid EPP bounds {} to {}".format(perf_epp, power_epp))
+        if not 0 <= smoothing < 1:
+            raise ValueError("Smoothing must be in the range 0 to 1")
+        if not pwr.get_system().epp_enabled:
+            raise ValueError("Cannot tune EPP, EPP is not enabled")
+        pwr.keep_msr_open()
+
+        self.cores = list(cores)            # tuned core objects
+        self.period = period                # tuning period in seconds
+        self.hysteresis = hysteresis        # smallest EPP change written
+        self.smoothing = smoothing          # weight of the previous load
+        self.source = source                # busyness source, MSRs if None
+        self.numeric = numeric              # write numeric EPP values
+
+        self.ticks = 0                      # tuning periods run
+        self.writes = 0                     # EPP changes made
+        self.last_tick_time = 0.0           # duration of last period
+
+        self.loads = {}                     # smoothed load of each core id
+        self._prev = {}
+        self._thread = None
+        self._stop = threading.Event()
+        if self.numeric is None:
+            self.numeric = _probe_numeric(self.cores)
+
+    def _sample(self, core_id):
+        """
+        Get C0 residency and effective over base frequency ratio of a core
+        since the previous sample, None on the first sample
+        """
+        tsc = struct.unpack("Q", pwr._rdmsr(core_id, governor.MSR_IA32_TSC))[0]
+        aperf = struct.unpack("Q", pwr._rdmsr(core_id, MSR_IA32_APERF))[0]
+        mperf = struct.unpack("Q", pwr._rdmsr(core_id, governor.MSR_IA32_MPERF))[0]
+        prev = self._prev.get(core_id)
+        self._prev[core_id] = (tsc, aperf, mperf)
+        if prev is None or tsc <= prev[0] or aperf < prev[1] or mperf <= prev[2]:
+            return None
+        busy = min(100.0, 100.0 * (mperf - prev[2]) / (tsc - prev[0]))
+        return busy, float(aperf - prev[1]) / (mperf - prev[2])
+
+    def _target(self, core, load):
+        """ Get the EPP for a load, as a number or an available name """
+        epp = int(round(self.power_epp - (self.power_epp - self.perf_epp) * load))
+        if self.numeric:
+            return epp
+        names = [n for n in core._epp_available.split()
+                 if n in pwr.EPP_VALUES and
+                 self.perf_epp <= pwr.EPP_VALUES[n] <= self.power_epp]
+        if not names:
+            return None
+        return min(names, key=lambda n: abs(pwr.EPP_VALUES[n] - epp))
+
+    def tick(self):
+        """ Run one tuning period, returns dict of core id to new EPP """
+        start = time.monotonic()
+        online = [c for c in self.cores if c.online]
+        busyness = {}
+        if self.source is not None:
+            busyness = self.source.read([c.core_id for c in online])
+
+        write_plan = plan.WritePlan()
+        targets = {}
+        for core in online:
+            try:
+                sample = self._sample(core.core_id)
+            except IOError:
+                continue  # went offline
+            if sample is None:
+                continue
+            busy, freq_ratio = sample
+            busy = busyness.get(core.core_id, busy)
+            load = min(1.0, busy / 100.0 * max(1.0, freq_ratio))
+            if core.core_id in self.loads:
+                load = self.smoothing * self.loads[core.core_id] + \
+                    (1 - self.smoothing) * load
+            self.loads[core.core_id] = load
+
+            epp = self._target(core, load)
+            current = _epp_number(core.epp)
+            if epp is None or (current is not None and
+                               abs(_epp_number(epp) - current) < self.hysteresis):
+                continue
+            if epp == core.epp:
+                continue
+            write_plan.add(core._epp_filename, epp, core)
+            targets[core] = epp
+
+        errors = write_plan.apply()
+        changed = {}
+        for core, epp in targets.items():
+            if core._epp_filename not in errors:
+                core.epp = epp
+                changed[core.core_id] = epp
+        self.writes += len(changed)
+
+        self.ticks += 1
+        self.last_tick_time = time.monotonic() - start
+        return changed
+
+    def run(self, count=None):
+        """ Run tuning periods on a fixed timeline, forever or count times """
+        deadline = time.monotonic()
+        while not self._stop.is_set() and (count is None or count > 0):
+            self.tick()
+            if count is not None:
+                count -= 1
+            deadline += self.period
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                self._stop.wait(delay)
+            else:
+                deadline = time.monotonic()
+
+    def start(self):
+        """ Run the tuner in a background thread """
+        if self._thread:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name="pwr-epp")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Stop the background thread """
+        if self._thread:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+
+def _probe_numeric(cores):
+    """
+    Check whether the driver accepts numeric EPP values, by writing the
+    current EPP of an online core back as a number
+    """
+    for core in cores:
+        if not core.online:
+            continue
+        current = pwr._read_sysfs(core._epp_filename)
+        number = _epp_number(current)
+        if number is None:
+            continue
+        try:
+            pwr._write_sysfs(core._epp_filename, number)
+        except (IOError, OSError):
+            return False
+        # put the name back, so the setting reads the same as before
+        pwr._write_sysfs(core._epp_filename, current)
+        return True
+    return False
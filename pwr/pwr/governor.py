@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright(c) 2019 Intel Corporation
+"""
+Userspace frequency governor driven by per-core busyness.
+
+Busyness sources report a value from 0 to 100 for each core. The governor
+polls its source every period, and steps the frequency of cores above the
+up threshold up, and of cores below the down threshold down. Sources have a
+read(core_ids) method returning a dict of core id to busyness, cores with
+no value are left alone.
+"""
+import os
+import struct
+import threading
+import time
+
+from . import pwr
+
+MSR_IA32_TSC = 0x10
+MSR_IA32_MPERF = 0xE7
+MSR_IA32_HWP_CAPABILITIES = 0x771
+MSR_IA32_HWP_REQUEST = 0x774
+
+PROC_STAT = "/proc/stat"
+
+# Frequency actuators
+ACTUATE_MAX = "max"         # step scaling_max_freq
+ACTUATE_PIN = "pin"         # step scaling_min_freq and scaling_max_freq together
+ACTUATE_HWP = "hwp"         # step the min and max ratios of IA32_HWP_REQUEST
+ACTUATORS = (ACTUATE_MAX, ACTUATE_PIN, ACTUATE_HWP)
+
+
+class ProcStatSource(object):
+    """
+    Busyness from /proc/stat, the share of time since the previous read
+    which the core was not idle
+    """
+
+    def __init__(self):
+        """ ProcStatSource object constructor """
+        self._prev = {}
+        self._file = open(PROC_STAT)
+
+    def read(self, core_ids):
+        """ Get busyness of the given cores """
+        self._file.seek(0)
+        wanted = set(core_ids)
+        busyness = {}
+        for line in self._file.read().splitlines()[1:]:
+            if not line.startswith("cpu"):
+                break
+            fields = line.split()
+            core_id = int(fields[0][len("cpu"):])
+            if core_id not in wanted:
+                continue
+            times = [int(f) for f in fields[1:]]
+            total = sum(times[:8])      # up to and including steal
+            idle = times[3] + times[4]  # idle and iowait
+            prev = self._prev.get(core_id)
+            self._prev[core_id] = (total, idle)
+            if prev is None or total == prev[0]:
+                continue
+            busyness[core_id] = 100.0 * (1 - float(idle - prev[1]) / (total - prev[0]))
+        return busyness
+
+    def close(self):
+        """ Close /proc/stat """
+        self._file.close()
+
+
+class MperfSource(object):
+    """
+    Busyness from MSRs, the C0 residency of the core (MPERF over TSC) since
+    the previous read, as reported by turbostat as Busy%. Busy polling cores
+    report 100.
+    """
+
+    def __init__(self):
+        """ MperfSource object constructor """
+        self._prev = {}
+        pwr.keep_msr_open()
+
+    def read(self, core_ids):
+        """ Get busyness of the given cores """
+        busyness = {}
+        for core_id in core_ids:
+            tsc = struct.unpack("Q", pwr._rdmsr(core_id, MSR_IA32_TSC))[0]
+            mperf = struct.unpack("Q", pwr._rdmsr(core_id, MSR_IA32_MPERF))[0]
+            prev = self._prev.get(core_id)
+            self._prev[core_id] = (tsc, mperf)
+            if prev is None or tsc <= prev[0] or mperf < prev[1]:
+                continue  # first read, or counter reset
+            busyness[core_id] = min(100.0, 100.0 * (mperf - prev[1]) / (tsc - prev[0]))
+        return busyness
+
+
+class CallbackSource(object):
+    """ Busyness from a function taking core ids and returning a dict """
+
+    def __init__(self, func):
+        """ CallbackSource object constructor """
+        self.func = func
+
+    def read(self, core_ids):
+        """ Get busyness of the given cores """
+        return self.func(core_ids)
+
+
+class AppSource(object):
+    """ Busyness pushed by the application, from any thread """
+
+    def __init__(self):
+        """ AppSource object constructor """
+        self._values = {}
+
+    def set(self, core_id, busyness):
+        """ Set the latest busyness of a core """
+        self._values[core_id] = busyness
+
+    def read(self, core_ids):
+        """ Get the latest busyness of the given cores """
+        values = self._values
+        return {c: values[c] for c in core_ids if c in values}
+
+
+class Governor(object):
+    """
+    Steps core frequencies up or down based on busyness. Only changed
+    frequencies are written, through sysfs files kept open, so the cost of a
+    period is one source read plus one write per changed core.
+    """
+
+    def __init__(self, cores, source, period=0.01, up_threshold=80.0,
+                 down_threshold=30.0, step=100, min_freq=None, max_freq=None,
+                 actuator=ACTUATE_MAX):
+        """ Governor object constructor """
+        if actuator not in ACTUATORS:
+            raise ValueError("Invalid actuator {}, available actuators are {}"
+                             .format(actuator, list(ACTUATORS)))
+        if down_threshold >= up_threshold:
+            raise ValueError("Down threshold ({}) must be below up threshold ({})"
+                             .format(down_threshold, up_threshold))
+        cores = list(cores)
+        if actuator == ACTUATE_HWP:
+            if not all(core.cpu.hwp_enabled for core in cores):
+                raise ValueError("Cannot use the {} actuator, HWP is not enabled"
+                                 .format(actuator))
+            pwr.keep_msr_open()
+        self.cores = list(cores)                # governed core objects
+        self.source = source                    # busyness source
+        self.period = period                    # control period in seconds
+        self.up_threshold = up_threshold        # busyness to step up at
+        self.down_threshold = down_threshold    # busyness to step down at
+        self.step = step                        # frequency step in MHz
+        self.min_freq = min_freq                # lower limit, lowest if None
+        self.max_freq = max_freq                # upper limit, highest if None
+        self.actuator = actuator                # what is written
+
+        self.ticks = 0                          # control periods run
+        self.writes = 0                         # frequency changes made
+        self.overruns = 0                       # periods which took too long
+        self.errors = 0                         # periods failed by IOError/OSError
+        self.last_error = None                  # exception of the last failed period
+        self.last_tick_time = 0.0               # duration of last period
+        self.max_tick_time = 0.0                # longest period
+        self.total_tick_time = 0.0              # sum of all periods
+
+        self._targets = {}
+        self._applied = {}
+        self._fds = {}
+        self._hwp_highest = {}
+        self._thread = None
+        self._stop = threading.Event()
+        for core in self.cores:
+            low, high = self._limits(core)
+            current = core.max_freq if core.max_freq is not None else high
+            self._targets[core.core_id] = min(max(current, low), high)
+
+    def _limits(self, core):
+        """ Get the frequency range the governor may use on a core """
+        low = core.lowest_freq if self.min_freq is None \
+            else max(self.min_freq, core.lowest_freq)
+        if self.actuator == ACTUATE_MAX and core.min_freq is not None:
+            # scaling_max_freq cannot go below the scaling_min_freq left as is
+            low = max(low, core.min_freq)
+        high = core.highest_freq if self.max_freq is None \
+            else min(self.max_freq, core.highest_freq)
+        return low, high
+
+    def _write_file(self, filename, value):
+        """ Write a sysfs file through a cached file descriptor """
+        fd = self._fds.get(filename)
+        if fd is None:
+            fd = os.open(filename, os.O_WRONLY)
+            self._fds[filename] = fd
+        os.pwrite(fd, str(value).encode(), 0)
+
+    def _close_files(self, core):
+        """ Close the cached files of a core, they are gone once it is offline """
+        self._applied.pop(core.core_id, None)
+        self._hwp_highest.pop(core.core_id, None)
+        for filename in (core._min_desired_filename, core._max_desired_filename):
+            fd = self._fds.pop(filename, None)
+            if fd is not None:
+                os.close(fd)
+
+    def _hwp_perf(self, core, freq):
+        """
+        Convert a frequency to an HWP performance level. Levels are not in
+        units of 100 MHz on all CPUs, e.g. on hybrid ones, so the frequency
+        is scaled by the highest performance level of IA32_HWP_CAPABILITIES
+        against the highest frequency of the core.
+        """
+        highest = self._hwp_highest.get(core.core_id)
+        if highest is None:
+            regstr = pwr._rdmsr(core.core_id, MSR_IA32_HWP_CAPABILITIES)
+            highest = struct.unpack("Q", regstr)[0] & 0xFF  # bits 0-7
+            self._hwp_highest[core.core_id] = highest
+        return min(max(1, int(round(freq * highest / float(core.highest_freq)))),
+                   highest)
+
+    def _actuate(self, core, freq):
+        """ Set the frequency of a core """
+        if self.actuator == ACTUATE_HWP:
+            ratio = self._hwp_perf(core, freq)
+            regstr = pwr._rdmsr(core.core_id, MSR_IA32_HWP_REQUEST)
+            request = struct.unpack("Q", regstr)[0] & ~0xFFFF
+            request |= ratio | (ratio << 8)   # min perf bits 0-7, max perf 8-15
+            pwr._wrmsr(core.core_id, MSR_IA32_HWP_REQUEST,
+                       struct.pack("Q", request))
+            return
+        khz = freq * 1000
+        if self.actuator == ACTUATE_PIN:
+            if freq > core.max_freq:
+                self._write_file(core._max_desired_filename, khz)
+                self._write_file(core._min_desired_filename, khz)
+            else:
+                self._write_file(core._min_desired_filename, khz)
+                self._write_file(core._max_desired_filename, khz)
+            core.min_freq = freq
+        else:
+            self._write_file(core._max_desired_filename, khz)
+        core.max_freq = freq
+
+    def tick(self):
+        """ Run one control period, returns dict of core id to new frequency """
+        start = time.monotonic()
+        online = [c for c in self.cores if c.online]
+        busyness = self.source.read([c.core_id for c in online])
+        changed = {}
+        for core in online:
+            busy = busyness.get(core.core_id)
+            if busy is None:
+                continue
+            target = self._targets[core.core_id]
+            if busy >= self.up_threshold:
+                new = target + self.step
+            elif busy <= self.down_threshold:
+                new = target - self.step
+            else:
+                continue
+            low, high = self._limits(core)
+            new = min(max(new, low), high)
+            if new == self._applied.get(core.core_id):
+                continue
+            try:
+                self._actuate(core, new)
+            except (IOError, OSError):
+                self._close_files(core)
+                if core.online:
+                    raise
+                continue  # went offline mid tick
+            self._targets[core.core_id] = new
+            self._applied[core.core_id] = new
+            changed[core.core_id] = new
+        self.writes += len(changed)
+
+        elapsed = time.monotonic() - start
+        self.ticks += 1
+        self.last_tick_time = elapsed
+        self.total_tick_time += elapsed
+        self.max_tick_time = max(self.max_tick_time, elapsed)
+        if elapsed > self.period:
+            self.overruns += 1
+        return changed
+
+    def stats(self):
+        """ Get the overhead counters of the governor """
+        return {
+            "ticks": self.ticks,
+            "writes": self.writes,
+            "overruns": self.overruns,
+            "errors": self.errors,
+            "last_tick_time": self.last_tick_time,
+            "max_tick_time": self.max_tick_time,
+            "avg_tick_time": self.total_tick_time / self.ticks if self.ticks else 0.0,
+        }
+
+    def run(self, count=None):
+        """
+        Run control periods on a fixed timeline, forever or count times.
+        Periods failing with IOError or OSError, e.g. a transient source
+        read error, are counted in errors and the governor keeps going.
+        """
+        deadline = time.monotonic()
+        while not self._stop.is_set() and (count is None or count > 0):
+            try:
+                self.tick()
+            except (IOError, OSError) as err:
+                self.errors += 1
+                self.last_error = err
+            if count is not None:
+                count -= 1
+            deadline += self.period
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                self._stop.wait(delay)
+            else:
+                # fell behind, do not try to catch up with a burst of periods
+                deadline = time.monotonic()
+
+    def start(self):
+        """ Run the governor in a background thread """
+        if self._thread:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name="pwr-governor")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Stop the background thread and close cached files """
+        if self._thread:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        for fd in self._fds.values():
+            os.close(fd)
+        self._fds = {}
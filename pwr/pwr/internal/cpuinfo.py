@@ -3,20 +3,48 @@
 # Copyright(c) 2019 Intel Corporation
 
 """
-Simple /proc/cpuinfo parser
+Streaming /proc/cpuinfo parser
+
+Only the requested keys are parsed, blocks are indexed by their processor
+field, and reading stops as soon as the wanted CPU has been found. Flags
+of CPUs missing from /proc/cpuinfo can be read from CPUID instead.
 """
+import os
+import struct
+
+CPUINFO_FILE = "/proc/cpuinfo"
+DEFAULT_KEYS = ("flags",)
+
+# cpuinfo flags which can be read from CPUID, as
+# (leaf, subleaf, register index of eax, ebx, ecx, edx, bit)
+CPUID_FLAGS = {
+    "ida": (0x6, 0, 0, 1),
+    "arat": (0x6, 0, 0, 2),
+    "pln": (0x6, 0, 0, 4),
+    "pts": (0x6, 0, 0, 6),
+    "hwp": (0x6, 0, 0, 7),
+    "hwp_notify": (0x6, 0, 0, 8),
+    "hwp_act_window": (0x6, 0, 0, 9),
+    "hwp_epp": (0x6, 0, 0, 10),
+    "hwp_pkg_req": (0x6, 0, 0, 11),
+    "hybrid_cpu": (0x7, 0, 3, 15),
+}
 
-__INFOS = []  # type: List[ParsedInfo]
+__INFOS = {}        # type: Dict[Tuple[str], Dict[int, ParsedInfo]]
+__COMPLETE = set()  # key sets for which all of /proc/cpuinfo was parsed
 
 
 class ParsedInfo(object):
     """
-    Simple wrapper around parsed /proc/cpuinfo
+    Simple wrapper around a parsed /proc/cpuinfo block
     """
     def __init__(self, lines):
+        self.processor = None       # logical cpu id
         self.flags = None           # CPU flags reported by cpuinfo
+        self.values = {}            # other parsed keys, as strings
 
         self.__parse_funcs = {
+            "processor": self.__parse_processor,
             "flags": self.__parse_flags
         }
 
@@ -24,40 +52,114 @@ class ParsedInfo(object):
         for line in lines:
             self.__parse_line(line)
 
+    def __parse_processor(self, val):
+        self.processor = int(val)
+
     def __parse_flags(self, val):
         self.flags = val.split()
 
     def __parse_line(self, line):
-        key, val = [s.strip() for s in line.split(":")]
+        key, _, val = [s.strip() for s in line.partition(":")]
 
-        func = self.__parse_funcs.setdefault(key, None)
+        func = self.__parse_funcs.get(key)
         if func:
             func(val)
+        else:
+            self.values[key] = val
 
 
-def __read_cpuinfo():  # type: List[ParsedInfo]
-    info_list = []
-    with open("/proc/cpuinfo") as cpuinfo_f:
+def __stream_cpuinfo(keys, processor=None):
+    """
+    Parse the given keys of each /proc/cpuinfo block, yielding ParsedInfo
+    objects. Stops after the block of processor, if given.
+    """
+    wanted = set(keys) | set(["processor"])
+    with open(CPUINFO_FILE) as cpuinfo_f:
         info_lines = []
-        for line in cpuinfo_f.readlines():
+        for line in cpuinfo_f:
             if not line.strip():
-                info_list += [ParsedInfo(info_lines)]
+                if info_lines:
+                    info = ParsedInfo(info_lines)
+                    yield info
+                    if processor is not None and info.processor == processor:
+                        return
                 info_lines = []  # reset current buffer
-            # don't add empty lines
-            line = line.strip()
-            if line:
+                continue
+            # only keep the lines of requested keys
+            if line.partition(":")[0].strip() in wanted:
                 info_lines += [line]
         # we may have stopped early
         if info_lines:
-            info_list += [ParsedInfo(info_lines)]
-    return info_list
+            yield ParsedInfo(info_lines)
+
+
+def get_info(processor, keys=DEFAULT_KEYS):  # type: (int, Tuple[str]) -> ParsedInfo
+    """
+    Get the ParsedInfo of a logical cpu, reading /proc/cpuinfo only up to
+    its block. Returns None if the cpu is not listed.
+    """
+    keys = tuple(sorted(keys))
+    infos = __INFOS.setdefault(keys, {})
+    if processor in infos or keys in __COMPLETE:
+        return infos.get(processor)
+    for info in __stream_cpuinfo(keys, processor):
+        infos[info.processor] = info
+    return infos.get(processor)
+
+
+def get_info_dict(keys=DEFAULT_KEYS):  # type: (Tuple[str]) -> Dict[int, ParsedInfo]
+    """
+    Parse the given keys of /proc/cpuinfo into a dict of logical cpu id to
+    ParsedInfo
+    """
+    keys = tuple(sorted(keys))
+    if keys not in __COMPLETE:
+        __INFOS[keys] = dict((info.processor, info)
+                             for info in __stream_cpuinfo(keys))
+        __COMPLETE.add(keys)
+    return __INFOS[keys]
 
 
 def get_info_list():  # type: List[ParsedInfo]
     """
-    Parse /proc/cpuinfo into a list of per-core ParsedInfo objects
+    Parse /proc/cpuinfo into a list of per-core ParsedInfo objects, in
+    processor order. Use get_info() to look up a cpu by its id.
+    """
+    infos = get_info_dict()
+    return [infos[processor] for processor in sorted(infos)]
+
+
+def read_cpuid(core, leaf, subleaf=0):
+    """
+    Run CPUID on a core through the cpuid driver.
+    Returns the eax, ebx, ecx and edx registers.
+    """
+    try:
+        fd = os.open(os.path.join("/dev/cpu", str(core), "cpuid"), os.O_RDONLY)
+        try:
+            regstr = os.pread(fd, 16, leaf | (subleaf << 32))
+        finally:
+            os.close(fd)
+    except (IOError, OSError) as err:
+        raise IOError("{}\nCould not read CPUID leaf 0x{:x} on core {}"
+                      .format(err, leaf, core))
+    return struct.unpack("IIII", regstr)
+
+
+def has_flag(processor, flag):  # type: (int, str) -> bool
+    """
+    Check whether a logical cpu reports a cpuinfo flag. If /proc/cpuinfo
+    cannot be read or does not list the cpu, flags in CPUID_FLAGS are read
+    from CPUID instead, other flags raise IOError.
     """
-    global __INFOS
-    if not __INFOS:
-        __INFOS = __read_cpuinfo()
-    return __INFOS
+    try:
+        info = get_info(processor)
+    except (IOError, OSError):
+        info = None
+    if info is not None and info.flags is not None:
+        return flag in info.flags
+    if flag not in CPUID_FLAGS:
+        raise IOError("Could not find flags of cpu {} in {}"
+                      .format(processor, CPUINFO_FILE))
+    leaf, subleaf, register, bit = CPUID_FLAGS[flag]
+    return bool(read_cpuid(processor, leaf, subleaf)[register] & (1 << bit))
@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright(c) 2019 Intel Corporation
+"""
+IRQ affinity placement.
+
+Interrupts are read from /proc/interrupts and classified by device and
+queue. A policy then places the queue interrupts of each network device on
+the high priority cores of the device's NUMA node, and all other interrupts
+on the housekeeping cores, away from the isolated and nohz_full ones. The
+placement is a write plan of /proc/irq/N/smp_affinity_list files, which can
+be diffed against the current affinities and applied in one batch.
+"""
+import argparse
+import collections
+import errno
+import os
+import re
+import sys
+
+from . import plan
+from . import pwr
+
+PROC_INTERRUPTS = "/proc/interrupts"
+PROC_IRQ_PATH = "/proc/irq"
+NET_PATH = "/sys/class/net"
+NODE_PATH = "/sys/devices/system/node"
+ISOLATED_FILE = os.path.join(pwr.BASE_PATH, "isolated")
+NOHZ_FULL_FILE = os.path.join(pwr.BASE_PATH, "nohz_full")
+
+# IRQ kinds
+KIND_QUEUE = "queue"        # a queue of a network device
+KIND_NIC = "nic"            # other network device interrupts, e.g. misc/admin
+KIND_OTHER = "other"        # interrupts of any other device
+
+# Queue number in action names such as eth0-TxRx-3, mlx5_comp3@pci:...,
+# virtio0-input.0 or iavf-eth0-rx-1
+QUEUE_REGEX = re.compile(
+    r"(?:txrx|rx|tx|comp|input|output|queue|q)[-_.]?([0-9]+)(?:@|$)", re.IGNORECASE)
+
+Irq = collections.namedtuple("Irq", [
+    "irq",          # interrupt number
+    "name",         # action names from /proc/interrupts, e.g. eth0-TxRx-3
+    "kind",         # KIND_QUEUE, KIND_NIC or KIND_OTHER
+    "device",       # network interface name, None for other devices
+    "queue",        # queue number, None if not a queue
+    "node",         # NUMA node of the device, None if unknown
+    "affinity",     # list of core ids the interrupt may run on
+    "count",        # interrupts handled so far, on all cores
+])
+
+
+def _format_cpulist(cores):
+    """ Format core ids as a kernel cpulist string such as "0-3,8" """
+    ranges = []
+    for core_id in sorted(set(cores)):
+        if ranges and core_id == ranges[-1][1] + 1:
+            ranges[-1][1] = core_id
+        else:
+            ranges.append([core_id, core_id])
+    return ",".join(str(low) if low == high else "{}-{}".format(low, high)
+                    for low, high in ranges)
+
+
+def _read_cpulist(filename):
+    """ Read a cpulist file into a set of core ids, empty if it is missing """
+    try:
+        return set(pwr._parse_cpulist(pwr._read_sysfs(filename)))
+    except (IOError, OSError):
+        return set()
+
+
+def _net_devices():
+    """
+    Map the MSI interrupts of network devices to (interface, NUMA node).
+    Interfaces without a device, such as lo or bridges, are left out.
+    """
+    devices = {}
+    try:
+        names = sorted(os.listdir(NET_PATH))
+    except OSError:
+        return devices
+    for name in names:
+        device_dir = os.path.join(NET_PATH, name, "device")
+        try:
+            irqs = os.listdir(os.path.join(device_dir, "msi_irqs"))
+        except OSError:
+            continue
+        node = None
+        try:
+            node = int(pwr._read_sysfs(os.path.join(device_dir, "numa_node")))
+        except (IOError, OSError, ValueError):
+            pass
+        if node is not None and node < 0:
+            node = None
+        for irq in irqs:
+            devices.setdefault(int(irq), (name, node))
+    return devices
+
+
+def _classify(irq, name, devices):
+    """ Get the kind, interface and queue number of an interrupt """
+    device, node = devices.get(irq, (None, None))
+    if device is None:
+        # legacy interrupts and virtual devices name the interface instead
+        for iface, iface_node in set(devices.values()):
+            if re.search(r"(^|[^a-z0-9]){}([^a-z0-9]|$)".format(re.escape(iface)), name):
+                device, node = iface, iface_node
+                break
+    if device is None:
+        return KIND_OTHER, None, None, None
+    match = QUEUE_REGEX.search(name.split(",")[0].strip())
+    if match is None:
+        return KIND_NIC, device, None, node
+    return KIND_QUEUE, device, int(match.group(1)), node
+
+
+def get_irqs():
+    """
+    Read and classify the device interrupts of the system. Interrupts whose
+    affinity cannot be read, such as the per-cpu ones, are left out.
+    Returns a list of Irq sorted by interrupt number.
+    """
+    try:
+        with open(PROC_INTERRUPTS) as interrupts_file:
+            lines = interrupts_file.read().splitlines()
+    except (IOError, OSError) as err:
+        raise IOError("{}\nCould not read {}".format(err, PROC_INTERRUPTS))
+    columns = len(lines[0].split()) if lines else 0
+    devices = _net_devices()
+
+    irqs = []
+    for line in lines[1:]:
+        fields = line.split()
+        if not fields or not fields[0].rstrip(":").isdigit():
+            continue
+        irq = int(fields[0].rstrip(":"))
+        counts = fields[1:1 + columns]
+        # after the counts come the chip, hwirq and trigger, then the actions
+        rest = fields[1 + columns:]
+        for i, field in enumerate(rest):
+            if field.endswith(("-edge", "-level", "-fasteoi")):
+                rest = rest[i + 1:]
+                break
+        else:
+            rest = rest[-1:]
+        name = " ".join(rest)
+        try:
+            affinity = pwr._parse_cpulist(pwr._read_sysfs(
+                os.path.join(PROC_IRQ_PATH, str(irq), "smp_affinity_list")))
+        except (IOError, OSError):
+            continue
+        kind, device, queue, node = _classify(irq, name, devices)
+        irqs.append(Irq(irq, name, kind, device, queue, node, affinity,
+                        sum(int(c) for c in counts if c.isdigit())))
+    return irqs
+
+
+class IrqPolicy(object):
+    """
+    Default placement. Queue interrupts of network devices are spread one
+    per core, by queue number, over the high priority cores of the device's
+    NUMA node, first threads of physical cores first. Without SST-BF, or
+    with nic_cores set to "housekeeping", the housekeeping cores of the node
+    are used instead. All other interrupts may run on any housekeeping core.
+    Isolated and nohz_full cores get no interrupts. Subclasses can override
+    place() for other policies.
+    """
+
+    def __init__(self, housekeeping=None, nic_cores="high_priority"):
+        """ IrqPolicy object constructor """
+        if nic_cores not in ("high_priority", "housekeeping"):
+            raise ValueError("Invalid NIC cores {}, must be high_priority or "
+                             "housekeeping".format(nic_cores))
+        cores = [c for c in pwr.get_cores() if c.online]
+        online = set(c.core_id for c in cores)
+        self.isolated = _read_cpulist(ISOLATED_FILE) | _read_cpulist(NOHZ_FULL_FILE)
+        if housekeeping is None:
+            housekeeping = online - self.isolated
+        self.housekeeping = set(housekeeping) & online  # cores for all IRQs
+        if not self.housekeeping:
+            raise ValueError("No online housekeeping cores to place interrupts on")
+        self.nic_cores = set(self.housekeeping)         # cores for queue IRQs
+        if nic_cores == "high_priority" and pwr.get_system().sst_bf_enabled:
+            high = set(c.core_id for c in cores if c.high_priority) - self.isolated
+            if high:
+                self.nic_cores = high
+        self._cores = dict((c.core_id, c) for c in cores)
+        self._nodes = {}
+
+    def _node_cores(self, node):
+        """ Get the core ids of a NUMA node, None if unknown """
+        if node not in self._nodes:
+            cores = _read_cpulist(os.path.join(NODE_PATH, "node{}".format(node),
+                                               "cpulist"))
+            self._nodes[node] = cores or None
+        return self._nodes[node]
+
+    def _spread_order(self, core_ids):
+        """ Order core ids so each physical core comes up once per round """
+        core_ids = set(core_ids)
+
+        def key(core_id):
+            siblings = self._cores[core_id].thread_siblings or []
+            return (len([s for s in siblings
+                         if s.core_id < core_id and s.core_id in core_ids]), core_id)
+        return sorted(core_ids, key=key)
+
+    def queue_cores(self, node):
+        """ Get the ordered cores for the queue interrupts of a NUMA node """
+        local = self._node_cores(node) if node is not None else None
+        for candidates in ((self.nic_cores & local) if local else None,
+                           (self.housekeeping & local) if local else None,
+                           self.nic_cores):
+            if candidates:
+                return self._spread_order(candidates)
+        return self._spread_order(self.housekeeping)
+
+    def place(self, irq):
+        """ Get the core ids an interrupt should run on, None to leave it """
+        if irq.kind == KIND_QUEUE:
+            cores = self.queue_cores(irq.node)
+            return [cores[irq.queue % len(cores)]]
+        return sorted(self.housekeeping)
+
+
+def plan_affinity(irqs=None, policy=None, write_plan=None):
+    """
+    Add the smp_affinity_list writes placing interrupts by a policy, the
+    default IrqPolicy if not given, to a write plan, a new one if not given
+    """
+    if irqs is None:
+        irqs = get_irqs()
+    if policy is None:
+        policy = IrqPolicy()
+    if write_plan is None:
+        write_plan = plan.WritePlan()
+    for irq in irqs:
+        cores = policy.place(irq)
+        if not cores:
+            continue
+        write_plan.add(os.path.join(PROC_IRQ_PATH, str(irq.irq), "smp_affinity_list"),
+                       _format_cpulist(cores))
+    return write_plan
+
+
+def affinity_diff(irqs, write_plan):
+    """
+    Describe the affinity changes of a plan, as a list of
+    (Irq, current cpulist, new cpulist) tuples
+    """
+    writes = dict(write_plan)
+    changes = []
+    for irq in irqs:
+        target = os.path.join(PROC_IRQ_PATH, str(irq.irq), "smp_affinity_list")
+        if target in writes:
+            new = writes[target]
+            current = _format_cpulist(irq.affinity)
+            if new != current:
+                changes.append((irq, current, new))
+    return changes
+
+
+def rebalance(policy=None):
+    """
+    Place all interrupts by a policy, writing only the affinities which
+    change. Interrupts whose affinity is managed by the kernel, such as
+    NVMe queues, reject the write with EIO. Returns a dict of write target
+    to exception.
+    """
+    return plan_affinity(policy=policy).diff().apply()
+
+
+def main():
+    """ Place interrupts from the command line """
+    parser = argparse.ArgumentParser(
+        description="Place interrupts on SST-BF high priority and housekeeping cores")
+    parser.add_argument("-n", "--dry-run", action="store_true",
+                        help="only print the affinity changes which would be made")
+    parser.add_argument("--housekeeping", metavar="CPULIST",
+                        help="cores for interrupts other than NIC queues, "
+                        "default all but isolated and nohz_full cores")
+    parser.add_argument("--nic-cores", choices=("high_priority", "housekeeping"),
+                        default="high_priority",
+                        help="cores for NIC queue interrupts, on the NIC's NUMA node")
+    parser.add_argument("-l", "--list", action="store_true",
+                        help="list the interrupts and their current affinity")
+    args = parser.parse_args()
+
+    try:
+        irqs = get_irqs()
+        if args.list:
+            for irq in irqs:
+                print("{:>5} {:<6} {:<10} {:>5} {:>4} {:<16} {}".format(
+                    irq.irq, irq.kind, irq.device or "-",
+                    "-" if irq.queue is None else irq.queue,
+                    "-" if irq.node is None else irq.node,
+                    _format_cpulist(irq.affinity), irq.name))
+            return
+        housekeeping = None
+        if args.housekeeping is not None:
+            housekeeping = pwr._parse_cpulist(args.housekeeping)
+        policy = IrqPolicy(housekeeping, args.nic_cores)
+        write_plan = plan_affinity(irqs, policy).diff()
+        if args.dry_run:
+            for irq, current, new in affinity_diff(irqs, write_plan):
+                print("IRQ {} {}: {} -> {}".format(irq.irq, irq.name, current, new))
+            return
+        errors = write_plan.apply()
+    except (IOError, OSError, ValueError) as err:
+        print(err, file=sys.stderr)
+        sys.exit(1)
+    failed = False
+    for target, err in sorted(errors.items()):
+        if err.errno == errno.EIO:
+            continue    # kernel managed, cannot be moved
+        print("Could not write {}: {}".format(target, err), file=sys.stderr)
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
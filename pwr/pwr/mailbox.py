@@ -0,0 +1,904 @@
+#!/usr/bin/env python
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright(c) 2019 Intel Corporation
+"""
+OS/BIOS mailbox client for SST discovery and control.
+
+Commands are issued through the OS_MAILBOX_INTERFACE (MSR 0xB0) and
+OS_MAILBOX_DATA (MSR 0xB1) registers of a core of the package, as described
+in intel_sst_os_interface/mailbox.md: the data register is written first,
+then the command with the RUN_BUSY bit set, and the interface register is
+polled until the firmware clears RUN_BUSY. The mailbox is shared by all
+cores of a package, so commands are serialized per package. Responses to
+discovery commands which cannot change at runtime are cached.
+
+Where the isst_if driver is loaded, commands are instead sent through the
+ISST_IF_MBOX_COMMAND ioctl of /dev/isst_interface, which takes arrays of
+commands for any cores, so discovery of all packages and levels only needs
+a few system calls. Commands the driver rejects are retried through MSRs.
+"""
+import collections
+import errno
+import fcntl
+import os
+import struct
+import threading
+import time
+
+from . import pwr
+
+MSR_OS_MAILBOX_INTERFACE = 0xB0
+MSR_OS_MAILBOX_DATA = 0xB1
+MSR_THREAD_ID_INFO = 0x53       # thread id known to the firmware
+RUN_BUSY = 1 << 31
+
+# Mailbox command ids
+CONFIG_TDP = 0x7F
+CLOS = 0xD0
+
+# CONFIG_TDP sub-commands
+CONFIG_TDP_GET_LEVELS_INFO = 0x00
+CONFIG_TDP_GET_CONFIG_TDP_CONTROL = 0x01
+CONFIG_TDP_SET_CONFIG_TDP_CONTROL = 0x02
+CONFIG_TDP_GET_TDP_INFO = 0x03
+CONFIG_TDP_GET_PWR_INFO = 0x04
+CONFIG_TDP_GET_TJMAX_INFO = 0x05
+CONFIG_TDP_GET_CORE_MASK = 0x06
+CONFIG_TDP_GET_TURBO_LIMIT_RATIOS = 0x07
+CONFIG_TDP_SET_LEVEL = 0x08
+CONFIG_TDP_GET_UNCORE_P0_P1_INFO = 0x09
+CONFIG_TDP_GET_P1_INFO = 0x0A
+CONFIG_TDP_GET_MEM_FREQ = 0x0B
+CONFIG_TDP_GET_FACT_HP_TURBO_LIMIT_NUMCORES = 0x10
+CONFIG_TDP_GET_FACT_HP_TURBO_LIMIT_RATIOS = 0x11
+CONFIG_TDP_GET_FACT_LP_CLIPPING_RATIO = 0x12
+CONFIG_TDP_PBF_GET_CORE_MASK_INFO = 0x20
+CONFIG_TDP_PBF_GET_P1HI_P1LO_INFO = 0x21
+CONFIG_TDP_PBF_GET_TJ_MAX_INFO = 0x22
+CONFIG_TDP_PBF_GET_TDP_INFO = 0x23
+
+# CLOS sub-commands
+CLOS_PQR_ASSOC = 0x00
+CLOS_PM_CLOS = 0x01
+CLOS_PM_QOS_CONFIG = 0x02
+CLOS_STATUS = 0x03
+
+# Write flag in the parameter of CLOS commands, which read without it
+CLOS_WRITE = 1 << 8
+
+# Mailbox completion codes
+NO_ERROR = 0x00
+INVALID_COMMAND = 0x01
+ILLEGAL_DATA = 0x16
+
+# Discovery commands whose responses only depend on their inputs
+CACHEABLE = frozenset((CONFIG_TDP, sub) for sub in (
+    CONFIG_TDP_GET_TDP_INFO,
+    CONFIG_TDP_GET_PWR_INFO,
+    CONFIG_TDP_GET_TJMAX_INFO,
+    CONFIG_TDP_GET_CORE_MASK,
+    CONFIG_TDP_GET_TURBO_LIMIT_RATIOS,
+    CONFIG_TDP_GET_UNCORE_P0_P1_INFO,
+    CONFIG_TDP_GET_P1_INFO,
+    CONFIG_TDP_GET_MEM_FREQ,
+    CONFIG_TDP_GET_FACT_HP_TURBO_LIMIT_NUMCORES,
+    CONFIG_TDP_GET_FACT_HP_TURBO_LIMIT_RATIOS,
+    CONFIG_TDP_GET_FACT_LP_CLIPPING_RATIO,
+    CONFIG_TDP_PBF_GET_CORE_MASK_INFO,
+    CONFIG_TDP_PBF_GET_P1HI_P1LO_INFO,
+    CONFIG_TDP_PBF_GET_TJ_MAX_INFO,
+    CONFIG_TDP_PBF_GET_TDP_INFO,
+))
+
+# Number of 32-bit words of the core masks
+CORE_MASK_WORDS = 2
+
+# isst_if driver interface, include/uapi/linux/isst_if.h
+ISST_DEVICE = "/dev/isst_interface"
+ISST_IF_GET_PLATFORM_INFO = 0x8008FE00
+ISST_IF_GET_PHY_ID = 0xC008FE01
+ISST_IF_MBOX_COMMAND = 0xC008FE03
+ISST_IF_MSR_COMMAND = 0xC008FE04
+ISST_IF_CMD_LIMIT = 64          # most commands per ioctl
+
+# api_version, driver_version, max_cmds_per_ioctl, mbox_supported, mmio_supported
+ISST_PLATFORM_INFO = struct.Struct("=HHHBB")
+# cmd_count, followed by the cpu maps
+ISST_CPU_MAPS = struct.Struct("=I")
+# logical_cpu, physical_cpu
+ISST_CPU_MAP = struct.Struct("=II")
+# cmd_count, followed by the commands
+ISST_MBOX_CMDS = struct.Struct("=I")
+# logical_cpu, parameter, req_data, resp_data, command, sub_command, reserved
+ISST_MBOX_CMD = struct.Struct("=IIIIHHI")
+# cmd_count, padded to the alignment of the 64-bit command fields
+ISST_MSR_CMDS = struct.Struct("=I4x")
+# read_write, logical_cpu, msr, data
+ISST_MSR_CMD = struct.Struct("=IIQQ")
+
+LevelsInfo = collections.namedtuple("LevelsInfo", [
+    "enabled",          # SST-PP supported
+    "locked",           # level selection locked
+    "current_level",    # active SST-PP level
+    "max_level",        # highest SST-PP level
+    "version",          # SST-PP version
+])
+
+TdpControl = collections.namedtuple("TdpControl", [
+    "fact_support",     # SST-TF supported at the level
+    "pbf_support",      # SST-BF supported at the level
+    "fact_enabled",     # SST-TF enabled
+    "pbf_enabled",      # SST-BF enabled
+])
+
+TdpInfo = collections.namedtuple("TdpInfo", [
+    "base_freq",        # base frequency of the level in MHz
+    "tdp",              # package TDP of the level in W
+])
+
+PbfInfo = collections.namedtuple("PbfInfo", [
+    "p1_hi",            # base frequency of high priority cores in MHz
+    "p1_lo",            # base frequency of low priority cores in MHz
+])
+
+P1Info = collections.namedtuple("P1Info", [
+    "sse",              # base frequency without AVX in MHz
+    "avx2",             # base frequency with AVX2 in MHz
+    "avx3",             # base frequency with AVX-512 in MHz
+])
+
+UncoreInfo = collections.namedtuple("UncoreInfo", [
+    "p0",               # max uncore frequency in MHz
+    "p1",               # base uncore frequency in MHz
+])
+
+FactInfo = collections.namedtuple("FactInfo", [
+    "bucket_cores",     # high priority core count of each bucket
+    "bucket_freqs",     # turbo frequency of each bucket in MHz
+    "lp_clip_freqs",    # low priority core frequency, SSE, AVX2 and AVX3
+])
+
+
+Level = collections.namedtuple("Level", [
+    "level",            # SST-PP level
+    "control",          # TdpControl, None if not readable
+    "tdp_info",         # TdpInfo
+    "core_mask",        # cores enabled at the level, None if not readable
+    "pbf_core_mask",    # SST-BF high priority cores, None if not supported
+    "pbf_info",         # PbfInfo, None if SST-BF is not supported
+    "fact_info",        # FactInfo, None if SST-TF is not supported
+    "p1_info",          # P1Info, None if not readable
+    "turbo_freqs",      # turbo frequency of each bucket in MHz, None if not readable
+    "uncore_info",      # UncoreInfo, None if not readable
+])
+
+
+class MailboxError(IOError):
+    """ Mailbox command completed with an error code """
+
+    def __init__(self, message, status):
+        IOError.__init__(self, message)
+        self.status = status                # mailbox completion code, None if unknown
+
+
+class MsrTransport(object):
+    """
+    Mailbox access through the msr driver. Commands run one at a time, and
+    callers serialize the commands of each package.
+    """
+    batched = False
+
+    def read(self, core, msr):
+        """ Read a mailbox register """
+        return struct.unpack("Q", pwr._rdmsr(core, msr))[0]
+
+    def write(self, core, msr, value):
+        """ Write a mailbox register """
+        pwr._wrmsr(core, msr, struct.pack("Q", value))
+
+    def _wait(self, core, deadline, timeout):
+        """ Poll the interface register until RUN_BUSY is clear """
+        while True:
+            interface = self.read(core, MSR_OS_MAILBOX_INTERFACE)
+            if not interface & RUN_BUSY:
+                return interface
+            if time.monotonic() > deadline:
+                raise IOError("Mailbox of core {} stayed busy for {}s"
+                              .format(core, timeout))
+            time.sleep(0)
+
+    def command(self, core, cmd, sub, param, data, timeout):
+        """ Run a mailbox command on a core and return its response data """
+        deadline = time.monotonic() + timeout
+        # a command from another process may still be running
+        self._wait(core, deadline, timeout)
+        self.write(core, MSR_OS_MAILBOX_DATA, data & 0xFFFFFFFF)
+        self.write(core, MSR_OS_MAILBOX_INTERFACE,
+                   RUN_BUSY | (param & 0x1FFF) << 16 | (sub & 0xFF) << 8 | (cmd & 0xFF))
+        status = self._wait(core, deadline, timeout) & 0xFF
+        if status != NO_ERROR:
+            raise MailboxError(
+                "Mailbox command 0x{:x}/0x{:x} failed on core {} with status 0x{:x}"
+                .format(cmd, sub, core, status), status)
+        return self.read(core, MSR_OS_MAILBOX_DATA) & 0xFFFFFFFF
+
+    def run(self, commands, timeout):
+        """
+        Run a list of (core, cmd, sub, param, data) commands. Returns a list
+        of the response data of each command, or the exception it raised.
+        """
+        results = []
+        for core, cmd, sub, param, data in commands:
+            try:
+                results.append(self.command(core, cmd, sub, param, data, timeout))
+            except (IOError, OSError) as err:
+                results.append(err)
+        return results
+
+    def punit_cpus(self, cores):
+        """
+        Get the thread id known to the firmware of each given core. Returns
+        a list of ids, or the exception raised reading them.
+        """
+        results = []
+        for core in cores:
+            try:
+                results.append(self.read(core, MSR_THREAD_ID_INFO))
+            except (IOError, OSError) as err:
+                results.append(err)
+        return results
+
+
+class SimulatedTransport(MsrTransport):
+    """
+    Simulated mailbox firmware for testing. Handlers are called with the
+    package core, parameter and data of a command, and return a completion
+    code and the response data. Commands without a handler complete with
+    INVALID_COMMAND. The first busy_polls reads of the interface register
+    after a command still see RUN_BUSY set.
+    """
+
+    def __init__(self, handlers=None, busy_polls=0):
+        """ SimulatedTransport object constructor """
+        self.handlers = dict(handlers or {})   # (command, sub-command) to handler
+        self.busy_polls = busy_polls            # reads which still see RUN_BUSY
+        self.commands = []                      # log of (core, cmd, sub, param, data)
+        self._regs = {}
+        self._pending = {}
+
+    def read(self, core, msr):
+        """ Read a mailbox register """
+        if msr == MSR_OS_MAILBOX_INTERFACE and core in self._pending:
+            if self._pending[core]:
+                self._pending[core] -= 1
+            else:
+                del self._pending[core]
+                self._complete(core)
+        return self._regs.get((core, msr), 0)
+
+    def write(self, core, msr, value):
+        """ Write a mailbox register """
+        self._regs[(core, msr)] = value
+        if msr == MSR_OS_MAILBOX_INTERFACE and value & RUN_BUSY:
+            self._pending[core] = self.busy_polls
+
+    def _complete(self, core):
+        """ Run the command written to the interface register of a core """
+        interface = self._regs[(core, MSR_OS_MAILBOX_INTERFACE)]
+        cmd, sub = interface & 0xFF, (interface >> 8) & 0xFF
+        param = (interface >> 16) & 0x1FFF
+        data = self._regs.get((core, MSR_OS_MAILBOX_DATA), 0)
+        self.commands.append((core, cmd, sub, param, data))
+        handler = self.handlers.get((cmd, sub))
+        status, data = (INVALID_COMMAND, 0) if handler is None else \
+            handler(core, param, data)
+        self._regs[(core, MSR_OS_MAILBOX_DATA)] = data & 0xFFFFFFFF
+        self._regs[(core, MSR_OS_MAILBOX_INTERFACE)] = status & 0xFF
+
+
+class IsstDevice(object):
+    """ The isst_if character device """
+
+    def __init__(self, path=ISST_DEVICE):
+        """ IsstDevice object constructor """
+        self.path = path                    # device node
+        self._fd = os.open(path, os.O_RDWR)
+
+    def ioctl(self, request, buf):
+        """ Run an ioctl on a mutable buffer, returns the ioctl result """
+        return fcntl.ioctl(self._fd, request, buf, True)
+
+    def close(self):
+        """ Close the device """
+        os.close(self._fd)
+
+
+class FakeIsstDevice(object):
+    """
+    Fake isst_if device for testing, running mailbox commands on a
+    SimulatedTransport with the kernel's batching and error semantics.
+    Commands listed in denied fail with EPERM, as the driver does for
+    commands it does not allow. Each ioctl is logged as (request, count).
+    """
+
+    def __init__(self, firmware, max_cmds=ISST_IF_CMD_LIMIT, mbox_supported=True,
+                 denied=()):
+        """ FakeIsstDevice object constructor """
+        self.firmware = firmware                # SimulatedTransport
+        self.max_cmds = max_cmds                # reported command limit
+        self.mbox_supported = mbox_supported    # reported mailbox support
+        self.denied = frozenset(denied)         # (command, sub-command) rejected
+        self.ioctls = []                        # log of (request, count)
+
+    def ioctl(self, request, buf):
+        """ Run an ioctl on a mutable buffer, returns the ioctl result """
+        if request == ISST_IF_GET_PLATFORM_INFO:
+            ISST_PLATFORM_INFO.pack_into(buf, 0, 1, 1, self.max_cmds,
+                                         int(self.mbox_supported), 0)
+            return 0
+        if request == ISST_IF_GET_PHY_ID:
+            header, cmd_fmt, run = ISST_CPU_MAPS, ISST_CPU_MAP, self._phy_id
+        elif request == ISST_IF_MBOX_COMMAND:
+            header, cmd_fmt, run = ISST_MBOX_CMDS, ISST_MBOX_CMD, self._mbox
+        elif request == ISST_IF_MSR_COMMAND:
+            header, cmd_fmt, run = ISST_MSR_CMDS, ISST_MSR_CMD, self._msr
+        else:
+            raise OSError(errno.ENOTTY, os.strerror(errno.ENOTTY))
+        count = header.unpack_from(buf, 0)[0]
+        if not 0 < count <= self.max_cmds:
+            raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+        self.ioctls.append((request, count))
+        # like the driver, stop at the first failed command and return the
+        # count of completed ones, or the error if none completed
+        for i in range(count):
+            offset = header.size + i * cmd_fmt.size
+            try:
+                cmd_fmt.pack_into(buf, offset, *run(cmd_fmt.unpack_from(buf, offset)))
+            except OSError:
+                if i == 0:
+                    raise
+                return i
+        return count
+
+    def _phy_id(self, fields):
+        """ Map a core to its firmware thread id """
+        core, _ = fields
+        return core, self.firmware.read(core, MSR_THREAD_ID_INFO)
+
+    def _mbox(self, fields):
+        """ Run a mailbox command """
+        core, param, data, _, cmd, sub, reserved = fields
+        if (cmd, sub) in self.denied:
+            raise OSError(errno.EPERM, os.strerror(errno.EPERM))
+        try:
+            response = self.firmware.command(core, cmd, sub, param, data, 1.0)
+        except MailboxError:
+            raise OSError(errno.ENXIO, os.strerror(errno.ENXIO))
+        return core, param, data, response, cmd, sub, reserved
+
+    def _msr(self, fields):
+        """ Run an MSR command """
+        write, core, msr, data = fields
+        if write:
+            self.firmware.write(core, msr, data)
+        else:
+            data = self.firmware.read(core, msr)
+        return write, core, msr, data
+
+    def close(self):
+        """ Close the device """
+
+
+class IsstTransport(object):
+    """
+    Mailbox access through the isst_if driver, /dev/isst_interface. Lists
+    of commands, for any cores, are sent in batches of up to max_cmds per
+    ioctl, and the driver serializes them with other users of the mailbox.
+    Raises IOError if the driver cannot run mailbox commands.
+    """
+    batched = True
+
+    def __init__(self, path=ISST_DEVICE, device=None):
+        """ IsstTransport object constructor """
+        try:
+            self.device = device or IsstDevice(path)    # isst_if device
+            buf = bytearray(ISST_PLATFORM_INFO.size)
+            self.device.ioctl(ISST_IF_GET_PLATFORM_INFO, buf)
+        except (IOError, OSError) as err:
+            raise IOError("{}\nCould not open isst interface {}".format(err, path))
+        api_version, _, max_cmds, mbox_supported, _ = ISST_PLATFORM_INFO.unpack(buf)
+        if not mbox_supported:
+            self.device.close()
+            raise IOError("isst interface {} does not support mailbox commands"
+                          .format(path))
+        self.api_version = api_version                  # driver API version
+        self.max_cmds = min(max_cmds or ISST_IF_CMD_LIMIT, ISST_IF_CMD_LIMIT)
+        self.ioctls = 0                                 # ioctls issued
+
+    def _batch(self, request, header, cmd_fmt, entries):
+        """
+        Send packed commands in batches. Returns a list of the unpacked
+        fields of each command after the call, or the OSError it failed with.
+        """
+        results = []
+        pos = 0
+        while pos < len(entries):
+            chunk = entries[pos:pos + self.max_cmds]
+            buf = bytearray(header.size + len(chunk) * cmd_fmt.size)
+            header.pack_into(buf, 0, len(chunk))
+            for i, fields in enumerate(chunk):
+                cmd_fmt.pack_into(buf, header.size + i * cmd_fmt.size, *fields)
+            self.ioctls += 1
+            try:
+                done = self.device.ioctl(request, buf)
+            except (IOError, OSError) as err:
+                # the first command failed, carry on after it
+                results.append(err)
+                pos += 1
+                continue
+            # the driver stops at a failed command and only returns the
+            # count of completed ones, the error itself is not passed
+            done = max(0, min(done, len(chunk)))
+            for i in range(done):
+                results.append(cmd_fmt.unpack_from(buf, header.size + i * cmd_fmt.size))
+            if done < len(chunk):
+                results.append(OSError(errno.EIO, "Command failed in a batch"))
+                done += 1
+            pos += done
+        return results
+
+    def run(self, commands, timeout=None):
+        """
+        Run a list of (core, cmd, sub, param, data) commands. Returns a list
+        of the response data of each command, or the exception it raised.
+        The driver does not pass the completion code of failed commands.
+        """
+        entries = [(core, param & 0x1FFF, data & 0xFFFFFFFF, 0, cmd, sub, 0)
+                   for core, cmd, sub, param, data in commands]
+        results = []
+        for (core, cmd, sub, _, _), result in zip(
+                commands, self._batch(ISST_IF_MBOX_COMMAND, ISST_MBOX_CMDS,
+                                      ISST_MBOX_CMD, entries)):
+            if not isinstance(result, Exception):
+                results.append(result[3])
+            elif result.errno == errno.ENXIO:
+                results.append(MailboxError(
+                    "Mailbox command 0x{:x}/0x{:x} failed on core {}"
+                    .format(cmd, sub, core), None))
+            else:
+                results.append(result)
+        return results
+
+    def punit_cpus(self, cores):
+        """
+        Get the thread id known to the firmware of each given core. Returns
+        a list of ids, or the exception raised reading them.
+        """
+        results = []
+        for result in self._batch(ISST_IF_GET_PHY_ID, ISST_CPU_MAPS, ISST_CPU_MAP,
+                                  [(core, 0) for core in cores]):
+            results.append(result if isinstance(result, Exception) else result[1])
+        return results
+
+    def msrs(self, commands):
+        """
+        Read or write MSRs in batches, from a list of (core, msr, value)
+        tuples where value is None for reads. Returns a list of the value
+        of each MSR, or the exception it raised. The driver only allows a
+        few SST related MSRs.
+        """
+        entries = [(int(value is not None), core, msr, value or 0)
+                   for core, msr, value in commands]
+        results = []
+        for (core, msr, _), result in zip(
+                commands, self._batch(ISST_IF_MSR_COMMAND, ISST_MSR_CMDS,
+                                      ISST_MSR_CMD, entries)):
+            if isinstance(result, Exception):
+                results.append(IOError("{}\nCould not access MSR 0x{:x} of core {}"
+                                       .format(result, msr, core)))
+            else:
+                results.append(result[3])
+        return results
+
+
+_PACKAGE_LOCKS = {}
+_PACKAGE_LOCKS_LOCK = threading.Lock()
+_MAILBOXES = {}
+_TRANSPORT = []
+_PUNIT_CORES = {}
+
+
+def _package_lock(physical_id):
+    """ Get the lock serializing mailbox commands on a package """
+    with _PACKAGE_LOCKS_LOCK:
+        return _PACKAGE_LOCKS.setdefault(physical_id, threading.Lock())
+
+
+def default_transport():
+    """
+    Get the shared default transport, the isst_if driver if it can run
+    mailbox commands, otherwise the msr driver
+    """
+    if not _TRANSPORT:
+        try:
+            transport = IsstTransport()
+        except IOError:
+            transport = MsrTransport()
+        _TRANSPORT[:] = [transport]
+    return _TRANSPORT[0]
+
+
+def _decode_levels_info(data):
+    """ Decode a GET_LEVELS_INFO response """
+    return LevelsInfo(
+        enabled=bool(data >> 31 & 1),
+        locked=bool(data >> 24 & 1),
+        current_level=data >> 16 & 0xFF,
+        max_level=data >> 8 & 0xFF,
+        version=data & 0xFF)
+
+
+def _decode_tdp_control(data):
+    """ Decode a GET_CONFIG_TDP_CONTROL response """
+    return TdpControl(
+        fact_support=bool(data & 1),
+        pbf_support=bool(data >> 1 & 1),
+        fact_enabled=bool(data >> 16 & 1),
+        pbf_enabled=bool(data >> 17 & 1))
+
+
+def _decode_tdp_info(data):
+    """ Decode a GET_TDP_INFO response """
+    return TdpInfo(base_freq=(data >> 16 & 0xFF) * 100, tdp=data & 0x7FFF)
+
+
+def _decode_pbf_info(data):
+    """ Decode a PBF_GET_P1HI_P1LO_INFO response """
+    return PbfInfo(p1_hi=(data >> 8 & 0xFF) * 100, p1_lo=(data & 0xFF) * 100)
+
+
+def _decode_p1_info(data):
+    """ Decode a GET_P1_INFO response """
+    return P1Info(sse=(data & 0xFF) * 100, avx2=(data >> 8 & 0xFF) * 100,
+                  avx3=(data >> 16 & 0xFF) * 100)
+
+
+def _decode_uncore_info(data):
+    """ Decode a GET_UNCORE_P0_P1_INFO response """
+    return UncoreInfo(p0=(data & 0xFF) * 100, p1=(data >> 8 & 0xFF) * 100)
+
+
+def _turbo_requests(level, avx_level=0):
+    """ Get the commands reading the turbo ratio limits of a level """
+    return [(CONFIG_TDP, CONFIG_TDP_GET_TURBO_LIMIT_RATIOS, 0,
+             avx_level << 16 | word << 8 | level) for word in range(2)]
+
+
+def _decode_turbo_freqs(data):
+    """ Decode the responses of the _turbo_requests() commands """
+    return tuple((data[byte // 4] >> (8 * (byte % 4)) & 0xFF) * 100
+                 for byte in range(8))
+
+
+def _mask_requests(sub, level):
+    """ Get the commands reading a core mask, one 32-bit word at a time """
+    return [(CONFIG_TDP, sub, 0, word << 8 | level) for word in range(CORE_MASK_WORDS)]
+
+
+def _decode_mask(words):
+    """ Combine the words of a core mask """
+    mask = 0
+    for word, data in enumerate(words):
+        mask |= data << (32 * word)
+    return mask
+
+
+def _fact_requests(level, avx_level=0):
+    """ Get the commands reading the SST-TF buckets of a level """
+    return [(CONFIG_TDP, CONFIG_TDP_GET_FACT_HP_TURBO_LIMIT_NUMCORES, 0,
+             word << 8 | level) for word in range(2)] + \
+        [(CONFIG_TDP, CONFIG_TDP_GET_FACT_HP_TURBO_LIMIT_RATIOS, 0,
+          avx_level << 16 | word << 8 | level) for word in range(2)] + \
+        [(CONFIG_TDP, CONFIG_TDP_GET_FACT_LP_CLIPPING_RATIO, 0, level)]
+
+
+def _decode_fact_info(data):
+    """ Decode the responses of the _fact_requests() commands """
+    cores, freqs = [], []
+    for word in range(2):
+        for byte in range(4):
+            cores.append(data[word] >> (8 * byte) & 0xFF)
+            freqs.append((data[2 + word] >> (8 * byte) & 0xFF) * 100)
+    # empty buckets are reported as zero
+    buckets = [i for i, count in enumerate(cores) if count]
+    return FactInfo(
+        bucket_cores=tuple(cores[i] for i in buckets),
+        bucket_freqs=tuple(freqs[i] for i in buckets),
+        lp_clip_freqs=tuple((data[4] >> (8 * byte) & 0xFF) * 100 for byte in range(3)))
+
+
+def _level_requests(level, control):
+    """
+    Get the commands reading the core mask, frequencies and the SST-BF and
+    SST-TF settings supported at an SST-PP level, as a list of (field,
+    commands, decoder)
+    """
+    requests = [
+        ("core_mask", _mask_requests(CONFIG_TDP_GET_CORE_MASK, level), _decode_mask),
+        ("p1_info", [(CONFIG_TDP, CONFIG_TDP_GET_P1_INFO, 0, level)],
+         lambda data: _decode_p1_info(data[0])),
+        ("turbo_freqs", _turbo_requests(level), _decode_turbo_freqs),
+        ("uncore_info", [(CONFIG_TDP, CONFIG_TDP_GET_UNCORE_P0_P1_INFO, 0, level)],
+         lambda data: _decode_uncore_info(data[0])),
+    ]
+    if control is not None and control.pbf_support:
+        requests.append(("pbf_core_mask",
+                         _mask_requests(CONFIG_TDP_PBF_GET_CORE_MASK_INFO, level),
+                         _decode_mask))
+        requests.append(("pbf_info",
+                         [(CONFIG_TDP, CONFIG_TDP_PBF_GET_P1HI_P1LO_INFO, 0, level)],
+                         lambda data: _decode_pbf_info(data[0])))
+    if control is not None and control.fact_support:
+        requests.append(("fact_info", _fact_requests(level), _decode_fact_info))
+    return requests
+
+
+class Mailbox(object):
+    """
+    OS mailbox of a CPU package. Commands are issued on an online core of
+    the package, and fail with IOError if RUN_BUSY is not cleared within
+    timeout seconds. Commands failed by a batched transport are retried
+    one at a time through the fallback transport, which reports their
+    completion code.
+    """
+
+    def __init__(self, cpu, transport=None, timeout=0.01, fallback=None):
+        """ Mailbox object constructor """
+        self.cpu = cpu                              # CPU object of the package
+        self.transport = transport or default_transport()
+        self.timeout = timeout                      # command timeout in seconds
+        self.fallback = fallback                    # transport retrying failed batches
+        if self.fallback is None and self.transport.batched:
+            self.fallback = MsrTransport()
+        self._lock = _package_lock(cpu.physical_id)
+        self._cache = {}
+
+    def commands(self, requests):
+        """
+        Issue a list of (cmd, sub, param, data) mailbox commands. Returns a
+        list of the 32-bit response data of each command, or the MailboxError
+        or IOError it failed with.
+        """
+        return run([(self,) + tuple(request) for request in requests])
+
+    def _checked(self, requests):
+        """ Issue mailbox commands, raising the first error """
+        results = self.commands(requests)
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+    def command(self, cmd, sub, param=0, data=0):
+        """
+        Issue a mailbox command and return its 32-bit response data.
+        Raises MailboxError if the command completes with an error code.
+        """
+        return self._checked([(cmd, sub, param, data)])[0]
+
+    def get_levels_info(self):
+        """ Get the SST-PP levels information """
+        return _decode_levels_info(self.command(CONFIG_TDP, CONFIG_TDP_GET_LEVELS_INFO))
+
+    def get_tdp_control(self, level):
+        """ Get SST-TF and SST-BF support of an SST-PP level, and their state """
+        return _decode_tdp_control(
+            self.command(CONFIG_TDP, CONFIG_TDP_GET_CONFIG_TDP_CONTROL, data=level))
+
+    def set_tdp_control(self, fact_enabled=None, pbf_enabled=None):
+        """
+        Enable or disable SST-TF and SST-BF at the current SST-PP level.
+        Settings which are None are left unchanged.
+        """
+        level = self.get_levels_info().current_level
+        data = self.command(CONFIG_TDP, CONFIG_TDP_GET_CONFIG_TDP_CONTROL, data=level)
+        data &= 0x30000
+        for bit, enabled in ((16, fact_enabled), (17, pbf_enabled)):
+            if enabled is not None:
+                data = data | 1 << bit if enabled else data & ~(1 << bit)
+        self.command(CONFIG_TDP, CONFIG_TDP_SET_CONFIG_TDP_CONTROL, data=data)
+
+    def get_tdp_info(self, level):
+        """ Get the base frequency and TDP of an SST-PP level """
+        return _decode_tdp_info(self.command(CONFIG_TDP, CONFIG_TDP_GET_TDP_INFO, data=level))
+
+    def get_core_mask(self, level):
+        """
+        Get the mask of the cores enabled at an SST-PP level. Bits are the
+        logical core ids known to the firmware.
+        """
+        return _decode_mask(self._checked(_mask_requests(CONFIG_TDP_GET_CORE_MASK, level)))
+
+    def get_pbf_core_mask(self, level):
+        """ Get the mask of the SST-BF high priority cores of an SST-PP level """
+        return _decode_mask(self._checked(
+            _mask_requests(CONFIG_TDP_PBF_GET_CORE_MASK_INFO, level)))
+
+    def get_p1_info(self, level):
+        """ Get the base frequencies of an SST-PP level for each AVX license """
+        return _decode_p1_info(self.command(CONFIG_TDP, CONFIG_TDP_GET_P1_INFO, data=level))
+
+    def get_turbo_freqs(self, level, avx_level=0):
+        """ Get the turbo frequency of each bucket of an SST-PP level """
+        return _decode_turbo_freqs(self._checked(_turbo_requests(level, avx_level)))
+
+    def get_uncore_info(self, level):
+        """ Get the uncore max and base frequencies of an SST-PP level """
+        return _decode_uncore_info(
+            self.command(CONFIG_TDP, CONFIG_TDP_GET_UNCORE_P0_P1_INFO, data=level))
+
+    def set_level(self, level):
+        """ Select an SST-PP level, fails if the level selection is locked """
+        self.command(CONFIG_TDP, CONFIG_TDP_SET_LEVEL, data=level)
+
+    def get_pbf_info(self, level):
+        """ Get the SST-BF high and low priority base frequencies of a level """
+        return _decode_pbf_info(
+            self.command(CONFIG_TDP, CONFIG_TDP_PBF_GET_P1HI_P1LO_INFO, data=level))
+
+    def get_fact_info(self, level, avx_level=0):
+        """
+        Get the SST-TF buckets of an SST-PP level, the high priority core
+        count and turbo frequency of each, and the low priority frequencies
+        """
+        return _decode_fact_info(self._checked(_fact_requests(level, avx_level)))
+
+    def clear_cache(self):
+        """ Forget cached responses, e.g. after a firmware update """
+        self._cache = {}
+
+
+def get_mailbox(cpu):
+    """ Get the shared mailbox client of a CPU package """
+    mailbox = _MAILBOXES.get(cpu.physical_id)
+    if mailbox is None or mailbox.cpu is not cpu:
+        mailbox = Mailbox(cpu)
+        _MAILBOXES[cpu.physical_id] = mailbox
+    return mailbox
+
+
+def punit_cores(cores):
+    """
+    Get the core id known to the firmware of each given core, as used in
+    core masks and CLOS commands, as a dict of core id to firmware core id.
+    Hyperthread siblings share a firmware core id.
+    """
+    missing = {}
+    for core in cores:
+        if core.core_id not in _PUNIT_CORES:
+            transport = get_mailbox(core.cpu).transport
+            missing.setdefault(transport, []).append(core.core_id)
+    for transport, core_ids in missing.items():
+        for core_id, punit_cpu in zip(core_ids, transport.punit_cpus(core_ids)):
+            if isinstance(punit_cpu, Exception):
+                raise IOError("{}\nCould not get firmware id of core {}"
+                              .format(punit_cpu, core_id))
+            # bits 8:0 are the firmware thread id, two threads per core
+            _PUNIT_CORES[core_id] = (punit_cpu & 0x1FF) >> 1
+    return {core.core_id: _PUNIT_CORES[core.core_id] for core in cores}
+
+
+def _run_locked(mailbox, transport, commands):
+    """ Run commands of one package through an unbatched transport """
+    with mailbox._lock:
+        return transport.run(commands, mailbox.timeout)
+
+
+def run(requests):
+    """
+    Issue mailbox commands on any packages, from a list of (mailbox, cmd,
+    sub, param, data) tuples. Commands for batched transports are sent
+    together, in as few calls as possible. Returns a list of the response
+    data of each command, or the MailboxError or IOError it failed with.
+    """
+    results = [None] * len(requests)
+    batches = collections.OrderedDict()     # transport to request indexes
+    cores = {}
+    for i, (mailbox, cmd, sub, param, data) in enumerate(requests):
+        key = (cmd, sub, param, data)
+        if (cmd, sub) in CACHEABLE and key in mailbox._cache:
+            results[i] = mailbox._cache[key]
+            continue
+        if mailbox not in cores:
+            try:
+                cores[mailbox] = mailbox.cpu._msr_core()
+            except (IOError, OSError, ValueError) as err:
+                cores[mailbox] = err
+        if isinstance(cores[mailbox], Exception):
+            results[i] = cores[mailbox]
+            continue
+        transport = mailbox.transport
+        batches.setdefault(transport if transport.batched else mailbox, []).append(i)
+
+    for owner, indexes in batches.items():
+        commands = [(cores[requests[i][0]],) + tuple(requests[i][1:]) for i in indexes]
+        if isinstance(owner, Mailbox):
+            responses = _run_locked(owner, owner.transport, commands)
+        else:
+            responses = owner.run(commands, max(requests[i][0].timeout for i in indexes))
+        for i, command, response in zip(indexes, commands, responses):
+            mailbox = requests[i][0]
+            if isinstance(response, Exception) and not isinstance(owner, Mailbox) \
+                    and mailbox.fallback is not None:
+                response = _run_locked(mailbox, mailbox.fallback, [command])[0]
+            results[i] = response
+
+    for i, result in enumerate(results):
+        mailbox, cmd, sub, param, data = requests[i]
+        if isinstance(result, Exception):
+            if not isinstance(result, MailboxError):
+                results[i] = IOError("{}\nMailbox command 0x{:x}/0x{:x} failed on "
+                                     "package {}".format(result, cmd, sub,
+                                                         mailbox.cpu.physical_id))
+        elif (cmd, sub) in CACHEABLE:
+            mailbox._cache[(cmd, sub, param, data)] = result
+    return results
+
+
+def discover(cpus=None):
+    """
+    Read the SST-PP levels of the given packages, all by default, with the
+    core mask, frequencies, and SST-BF and SST-TF configuration of each
+    level. Commands of all packages and levels are batched. Returns a dict
+    of package id to a tuple of the LevelsInfo and a dict of level number
+    to Level. Levels which cannot be read, such as disabled ones, are left
+    out.
+    """
+    if cpus is None:
+        cpus = pwr.get_cpus()
+    mailboxes = [get_mailbox(cpu) for cpu in cpus]
+    infos = []
+    for mailbox, data in zip(mailboxes, run(
+            [(m, CONFIG_TDP, CONFIG_TDP_GET_LEVELS_INFO, 0, 0) for m in mailboxes])):
+        if isinstance(data, Exception):
+            raise data
+        infos.append(_decode_levels_info(data))
+
+    # the control and TDP info tell which levels exist and what they support
+    levels = [(mailbox, level) for mailbox, info in zip(mailboxes, infos)
+              for level in range(info.max_level + 1)]
+    responses = run([(mailbox, CONFIG_TDP, sub, 0, level) for mailbox, level in levels
+                     for sub in (CONFIG_TDP_GET_CONFIG_TDP_CONTROL,
+                                 CONFIG_TDP_GET_TDP_INFO)])
+    values = {}
+    for i, (mailbox, level) in enumerate(levels):
+        control, tdp_info = responses[2 * i:2 * i + 2]
+        if isinstance(tdp_info, Exception):
+            continue
+        values[(mailbox, level)] = {
+            "control": None if isinstance(control, Exception)
+            else _decode_tdp_control(control),
+            "tdp_info": _decode_tdp_info(tdp_info),
+            "core_mask": None, "pbf_core_mask": None, "pbf_info": None,
+            "fact_info": None, "p1_info": None, "turbo_freqs": None,
+            "uncore_info": None,
+        }
+
+    requests, fields = [], []
+    for (mailbox, level), level_values in values.items():
+        for field, commands, decoder in _level_requests(level, level_values["control"]):
+            fields.append((mailbox, level, field, decoder,
+                           len(requests), len(requests) + len(commands)))
+            requests.extend((mailbox,) + command for command in commands)
+    responses = run(requests)
+    for mailbox, level, field, decoder, start, end in fields:
+        data = responses[start:end]
+        if not any(isinstance(d, Exception) for d in data):
+            values[(mailbox, level)][field] = decoder(data)
+
+    result = {}
+    for mailbox, info in zip(mailboxes, infos):
+        result[mailbox.cpu.physical_id] = (info, {
+            level: Level(level=level, **values[(mailbox, level)])
+            for level in range(info.max_level + 1) if (mailbox, level) in values})
+    return result
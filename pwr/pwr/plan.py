@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright(c) 2019 Intel Corporation
+"""
+Write plans, ordered and deduplicated sets of sysfs, MSR and mailbox writes
+which can be diffed against the current system state and applied in one
+batch.
+"""
+import collections
+import errno
+import struct
+
+from . import mailbox
+from . import pwr
+
+# MSR write targets are ("msr", core id, register) tuples, their values are
+# (bits, mask) pairs so only the masked bits of the register are changed
+MSR = "msr"
+
+# Mailbox write targets are ("mailbox", package id, command, sub-command,
+# parameter) tuples of commands which read without and write with the
+# CLOS_WRITE flag in their parameter. Their values are (bits, mask) pairs
+# like MSR ones. Consecutive mailbox writes are sent as one batch.
+MAILBOX = "mailbox"
+
+
+def msr_target(core, msr):
+    """ Get the plan target of an MSR, accessed through the given core """
+    return (MSR, core, msr)
+
+
+def mailbox_target(cpu, cmd, sub, param=0):
+    """ Get the plan target of a mailbox setting of a CPU package """
+    return (MAILBOX, cpu.physical_id, cmd, sub, param)
+
+
+class WritePlan(object):
+    """
+    Ordered set of writes. Adding a write to a target already in the plan
+    replaces its value, keeping the position of the first write.
+    """
+
+    def __init__(self):
+        """ WritePlan object constructor """
+        self._writes = collections.OrderedDict()   # target to value
+        self._owners = {}                          # target to Core/CPU object
+
+    def __len__(self):
+        return len(self._writes)
+
+    def __iter__(self):
+        return iter(self._writes.items())
+
+    def __contains__(self, target):
+        return target in self._writes
+
+    def add(self, target, value, owner=None):
+        """
+        Add a write of value to target, a sysfs path or an msr_target().
+        Owner is the library object whose state the write changes.
+        """
+        if isinstance(target, tuple):
+            bits, mask = value
+            if target in self._writes:
+                # merge with the bits already planned for this register
+                old_bits, old_mask = self._writes[target]
+                bits = (old_bits & ~mask) | (bits & mask)
+                mask |= old_mask
+            value = (bits & mask, mask)
+        else:
+            value = str(value)
+        self._writes[target] = value
+        if owner is not None:
+            self._owners[target] = owner
+
+    def update(self, other):
+        """ Add all writes of another plan, its values take precedence """
+        for target, value in other:
+            self.add(target, value, other._owners.get(target))
+
+    def owners(self):
+        """ Get the objects changed by this plan, in plan order """
+        owners = []
+        for target in self._writes:
+            owner = self._owners.get(target)
+            if owner is not None and owner not in owners:
+                owners.append(owner)
+        return owners
+
+    def diff(self):
+        """
+        Get a new plan with only the writes which would change the current
+        state. Targets which cannot be read are kept.
+        """
+        changed = WritePlan()
+        current = _read_mailboxes([t for t in self._writes if _is_mailbox(t)])
+        for target, value in self._writes.items():
+            try:
+                if target in current:
+                    if not isinstance(current[target], Exception) and \
+                            (current[target] & value[1], value[1]) == value:
+                        continue
+                elif _read(target, value) == value:
+                    continue
+            except (IOError, OSError, ValueError):
+                pass
+            changed.add(target, value, self._owners.get(target))
+        return changed
+
+    def apply(self):
+        """
+        Perform all writes in order. Writes rejected with EINVAL, such as a
+        new minimum frequency above the current maximum, are retried once
+        after all other writes. Returns a dict of target to exception for
+        the writes which failed.
+        """
+        errors = {}
+        retry = []
+        batch = []
+        for target, value in self._writes.items():
+            if _is_mailbox(target):
+                batch.append((target, value))
+                continue
+            if batch:
+                errors.update(_write_mailboxes(batch))
+                batch = []
+            try:
+                _write(target, value)
+            except (IOError, OSError) as err:
+                if err.errno == errno.EINVAL:
+                    retry.append((target, value))
+                else:
+                    errors[target] = err
+        if batch:
+            errors.update(_write_mailboxes(batch))
+        for target, value in retry:
+            try:
+                _write(target, value)
+            except (IOError, OSError) as err:
+                errors[target] = err
+        return errors
+
+
+def _read(target, value):
+    """ Read the current value of a target, in the form used in plans """
+    if isinstance(target, tuple):
+        _, core, msr = target
+        current = struct.unpack("Q", pwr._rdmsr(core, msr))[0]
+        mask = value[1]
+        return (current & mask, mask)
+    return pwr._read_sysfs(target)
+
+
+def _write(target, value):
+    """ Write a planned value to its target """
+    if isinstance(target, tuple):
+        _, core, msr = target
+        bits, mask = value
+        current = struct.unpack("Q", pwr._rdmsr(core, msr))[0]
+        pwr._wrmsr(core, msr, struct.pack("Q", (current & ~mask) | bits))
+        return
+    pwr._write_sysfs(target, value)
+
+
+def _is_mailbox(target):
+    """ Check whether a target is a mailbox_target() """
+    return isinstance(target, tuple) and target[0] == MAILBOX
+
+
+def _mailbox(package_id):
+    """ Get the mailbox of a package """
+    for cpu in pwr.get_cpus():
+        if cpu.physical_id == package_id:
+            return mailbox.get_mailbox(cpu)
+    raise ValueError("Package {} does not exist".format(package_id))
+
+
+def _read_mailboxes(targets):
+    """
+    Read mailbox targets in one batch, returns a dict of target to its
+    current data, or the exception raised reading it
+    """
+    requests, current = [], {}
+    for target in targets:
+        _, package_id, cmd, sub, param = target
+        try:
+            requests.append((target, (_mailbox(package_id), cmd, sub, param, 0)))
+        except ValueError as err:
+            current[target] = err
+    results = mailbox.run([request for _, request in requests])
+    for (target, _), result in zip(requests, results):
+        current[target] = result
+    return current
+
+
+def _write_mailboxes(writes):
+    """
+    Write mailbox targets in one batch, after reading the ones only partly
+    written. Returns a dict of target to exception for the failed writes.
+    """
+    current = _read_mailboxes([t for t, (_, mask) in writes if mask != 0xFFFFFFFF])
+    errors = {}
+    requests = []
+    for target, (bits, mask) in writes:
+        data = current.get(target, 0)
+        if isinstance(data, Exception):
+            errors[target] = data
+            continue
+        _, package_id, cmd, sub, param = target
+        requests.append((target, (_mailbox(package_id), cmd, sub,
+                                  param | mailbox.CLOS_WRITE, (data & ~mask) | bits)))
+    results = mailbox.run([request for _, request in requests])
+    for (target, _), result in zip(requests, results):
+        if isinstance(result, Exception):
+            errors[target] = result
+    return errors
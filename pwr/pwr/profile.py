@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright(c) 2019 Intel Corporation
+"""
+Declarative power profiles.
+
+A profile assigns core settings to sets of cores, and uncore and power
+limits to packages. It is compiled against the live topology into a write
+plan, which is diffed against the current state so only changed values are
+written.
+
+    {
+        "name": "night",
+        "sets": {"latency": "20-22"},
+        "cores": [
+            {"cores": "all", "min_freq": "min", "max_freq": "base",
+             "epp": "power"},
+            {"cores": ["high_priority", "latency"], "max_freq": "max",
+             "cstates": {"*": false, "POLL": true}},
+            {"cores": "node1", "cstate_latency": 20}
+        ],
+        "packages": [
+            {"packages": "all", "uncore_min_freq": 1200,
+             "uncore_max_freq": 1800, "power_limit": 150},
+            {"packages": [0], "core_power": true,
+             "clos": {"0": {"min_freq": 2000, "max_freq": 3900, "priority": 0},
+                      "3": {"max_freq": 1800, "priority": 15}}}
+        ],
+        "system": {"idle_governor": "haltpoll",
+                   "haltpoll": {"guest_halt_poll_ns": 200000}}
+    }
+
+Core rules are applied in order, later rules override earlier ones.
+"cstate_latency" is a wakeup latency budget in us, which enables the C-states
+that fit in it, explicit "cstates" entries take precedence over it. "resume_latency" is
+the PM QoS resume latency limit of the cores in us, null for no limit.
+"clos" associates cores with an SST-CP class of service, which packages
+configure with "clos", "core_power" and "clos_priority_type". A core
+set is "all", "isolated", "high_priority", "normal_priority", a NUMA node
+such as "node1", a cpulist, a name from "sets", or a list of these.
+"system" selects the cpuidle governor and sets guest haltpoll parameters.
+"""
+import argparse
+import json
+import os
+import sys
+
+from . import cpuidle
+from . import plan
+from . import pwr
+from . import sst
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+ISOLATED_FILE = os.path.join(pwr.BASE_PATH, "isolated")
+NODE_PATH = "/sys/devices/system/node"
+
+# Core frequency keywords, and the core attributes they stand for
+FREQ_KEYWORDS = {
+    "min": "lowest_freq",
+    "max": "highest_freq",
+    "base": "base_freq",
+    "all_core_turbo": "all_core_turbo_freq",
+    "sst_bf": "sst_bf_base_freq",
+}
+CORE_SETTINGS = ("min_freq", "max_freq", "epp", "cstates", "cstate_latency",
+                 "resume_latency", "clos")
+PACKAGE_SETTINGS = ("uncore_min_freq", "uncore_max_freq", "power_limit", "clos",
+                    "core_power", "clos_priority_type")
+SYSTEM_SETTINGS = ("idle_governor", "haltpoll")
+
+
+class Profile(object):
+    """
+    Power profile, compiled on demand into a write plan. The compiled plan
+    is reused while the online cores, their frequency capabilities, which
+    change with the SST-PP level, the SST-BF state and the isolated cores
+    do not change.
+    """
+
+    def __init__(self, data, name=None):
+        """ Profile object constructor """
+        if not isinstance(data, dict):
+            raise ValueError("Profile must be a mapping, got {}"
+                             .format(type(data).__name__))
+        unknown = set(data) - set(["name", "sets", "cores", "packages", "system"])
+        if unknown:
+            raise ValueError("Unknown profile sections {}".format(sorted(unknown)))
+        self.name = name or data.get("name", "")    # profile name
+        self.sets = data.get("sets", {})            # named core sets
+        self.cores = data.get("cores", [])          # core rules
+        self.packages = data.get("packages", [])    # package rules
+        self.system = data.get("system", {})        # system wide settings
+        self._plan = None
+        self._plan_key = None
+
+    @classmethod
+    def load(cls, path):
+        """ Load a profile from a JSON or YAML file """
+        with open(path) as profile_file:
+            if os.path.splitext(path)[1] in (".yaml", ".yml"):
+                if yaml is None:
+                    raise IOError("PyYAML is needed to load {}".format(path))
+                data = yaml.safe_load(profile_file)
+            else:
+                data = json.load(profile_file)
+        name = os.path.splitext(os.path.basename(path))[0]
+        return cls(data, data.get("name", name))
+
+    def invalidate(self):
+        """ Forget the compiled plan, e.g. after an SST-PP level switch by another tool """
+        self._plan = None
+        self._plan_key = None
+
+    @staticmethod
+    def _key(system, cores):
+        """ Get the state a compiled plan depends on """
+        try:
+            isolated = pwr._read_sysfs(ISOLATED_FILE)
+        except (IOError, OSError):
+            isolated = None
+        return (isolated, system.sst_bf_enabled,
+                tuple((c.core_id, c.high_priority, c.lowest_freq, c.base_freq,
+                       c.all_core_turbo_freq, c.highest_freq, c.sst_bf_base_freq)
+                      for c in cores if c.online))
+
+    @staticmethod
+    def _select_packages(selector, cpus):
+        """ Get the CPUs matching a package selector, "all", an id or a list of ids """
+        if selector == "all":
+            return list(cpus)
+        if isinstance(selector, int) and not isinstance(selector, bool):
+            selector = [selector]
+        if not isinstance(selector, list) or \
+                not all(isinstance(s, int) and not isinstance(s, bool) for s in selector):
+            raise ValueError("Invalid package set {}, must be \"all\", a package "
+                             "id or a list of package ids".format(selector))
+        return [cpu for cpu in cpus if cpu.physical_id in selector]
+
+    def _select(self, selector, cores):
+        """ Get the ids of the cores matching a core set selector """
+        if isinstance(selector, list):
+            return set().union(*[self._select(s, cores) for s in selector])
+        if isinstance(selector, int):
+            return set([selector])
+        if selector in self.sets:
+            return self._select(self.sets[selector], cores)
+        if not isinstance(selector, str):
+            raise ValueError("Invalid core set {}".format(selector))
+        if selector == "all":
+            return set(c.core_id for c in cores)
+        if selector == "isolated":
+            return set(pwr._parse_cpulist(pwr._read_sysfs(ISOLATED_FILE)))
+        if selector in ("high_priority", "normal_priority"):
+            if not pwr.get_system().sst_bf_enabled:
+                raise ValueError("Cannot select {} cores, SST-BF is not enabled"
+                                 .format(selector))
+            high = selector == "high_priority"
+            return set(c.core_id for c in cores if c.high_priority == high)
+        if selector.startswith("node") and selector[len("node"):].isdigit():
+            return set(pwr._parse_cpulist(pwr._read_sysfs(
+                os.path.join(NODE_PATH, selector, "cpulist"))))
+        try:
+            return set(pwr._parse_cpulist(selector))
+        except ValueError:
+            raise ValueError("Invalid core set {}".format(selector))
+
+    def _core_values(self, cores):
+        """ Merge the core rules into the settings of each core id """
+        values = {}
+        for rule in self.cores:
+            settings = dict(rule)
+            selector = settings.pop("cores", "all")
+            unknown = set(settings) - set(CORE_SETTINGS)
+            if unknown:
+                raise ValueError("Unknown core settings {}, available settings "
+                                 "are {}".format(sorted(unknown), list(CORE_SETTINGS)))
+            for core_id in self._select(selector, cores):
+                core_values = values.setdefault(core_id, {})
+                cstates = dict(core_values.get("cstates", {}))
+                core_values.update(settings)
+                if "cstates" in settings:
+                    cstates.update(settings["cstates"])
+                    core_values["cstates"] = cstates
+        return values
+
+    def compile(self):
+        """
+        Compile the profile against the live topology into a write plan of
+        all its settings, not yet diffed against the current state.
+        """
+        system, cpus, cores = pwr.get_objects()
+        key = self._key(system, cores)
+        if self._plan is not None and self._plan_key == key:
+            return self._plan
+
+        write_plan = plan.WritePlan()
+        online_cores = [c for c in cores if c.online]
+        clos_cores = {}
+        for core_id, values in sorted(self._core_values(online_cores).items()):
+            core = pwr.get_core(core_id)
+            if core is None:
+                raise ValueError("Core {} does not exist".format(core_id))
+            if core.online:
+                _plan_core(write_plan, core, values, system)
+                if values.get("clos") is not None:
+                    sst._check_clos(values["clos"])
+                    clos_cores.setdefault(values["clos"], []).append(core)
+        # CLOS associations of all cores are batched
+        for clos, clos_core_list in sorted(clos_cores.items()):
+            sst.plan_clos_assoc(clos_core_list, clos, write_plan)
+
+        for rule in self.packages:
+            settings = dict(rule)
+            selector = settings.pop("packages", "all")
+            unknown = set(settings) - set(PACKAGE_SETTINGS)
+            if unknown:
+                raise ValueError("Unknown package settings {}, available settings "
+                                 "are {}".format(sorted(unknown), list(PACKAGE_SETTINGS)))
+            for cpu in self._select_packages(selector, cpus):
+                _plan_package(write_plan, cpu, settings)
+
+        unknown = set(self.system) - set(SYSTEM_SETTINGS)
+        if unknown:
+            raise ValueError("Unknown system settings {}, available settings "
+                             "are {}".format(sorted(unknown), list(SYSTEM_SETTINGS)))
+        # haltpoll parameters only take effect under the haltpoll governor
+        if "idle_governor" in self.system:
+            cpuidle.plan_governor(self.system["idle_governor"], write_plan)
+        if "haltpoll" in self.system:
+            cpuidle.plan_haltpoll(self.system["haltpoll"], write_plan)
+
+        self._plan = write_plan
+        self._plan_key = key
+        return write_plan
+
+    def apply(self, diff=True):
+        """
+        Apply the profile, writing only the values which differ from the
+        current state unless diff is False. The changed core and CPU objects
+        are refreshed. Returns a dict of write target to exception.
+        """
+        write_plan = self.compile()
+        if diff:
+            write_plan = write_plan.diff()
+        errors = write_plan.apply()
+        targets = dict(write_plan)
+        for obj in write_plan.owners():
+            with obj._lock:
+                if isinstance(obj, pwr.Core):
+                    obj.refresh_stats(["min_freq", "max_freq", "epp", "cstates",
+                                       "resume_latency"])
+                else:
+                    obj.refresh_stats(fields=["uncore_min_freq", "uncore_max_freq"])
+                    if _power_limit_path(obj) in targets:
+                        obj._read_capabilities()    # TDP follows the power limit
+        return errors
+
+
+def _core_freq(core, value):
+    """ Resolve a core frequency, in MHz or as a keyword """
+    if value in FREQ_KEYWORDS:
+        freq = getattr(core, FREQ_KEYWORDS[value])
+        if freq is None:
+            raise ValueError("Core {} has no {} frequency".format(core.core_id, value))
+        return freq
+    return int(value)
+
+
+def _plan_core(write_plan, core, values, system):
+    """ Validate the settings of a core and add its writes to a plan """
+    min_freq = _core_freq(core, values.get("min_freq", core.min_freq))
+    max_freq = _core_freq(core, values.get("max_freq", core.max_freq))
+    valid_range = list(range(core.lowest_freq, core.highest_freq, 100))
+    valid_range.append(core.highest_freq)
+    for freq in (min_freq, max_freq):
+        if freq not in valid_range:
+            raise ValueError("Invalid frequency {} for core {}. "
+                             "Lowest: {}, Highest: {}".format(
+                                 freq, core.core_id, core.lowest_freq, core.highest_freq))
+    if min_freq > max_freq:
+        raise ValueError("Invalid config for core {}, desired min freq({}) is "
+                         "greater than desired max freq({})"
+                         .format(core.core_id, min_freq, max_freq))
+    if "min_freq" in values:
+        write_plan.add(core._min_desired_filename, min_freq * 1000, core)
+    if "max_freq" in values:
+        write_plan.add(core._max_desired_filename, max_freq * 1000, core)
+
+    if "epp" in values:
+        if not system.epp_enabled:
+            raise ValueError("Cannot set epp to {}, EPP is not enabled"
+                             .format(values["epp"]))
+        if not core._valid_epp(values["epp"]):
+            raise ValueError("Cannot set epp to {}, available options are {} "
+                             "or a number from 0 to 255"
+                             .format(values["epp"], core._epp_available))
+        write_plan.add(core._epp_filename, values["epp"], core)
+
+    if "cstates" in values or "cstate_latency" in values:
+        cstates = {}
+        if "cstate_latency" in values:
+            cstates = cpuidle.allowed_states(core, values["cstate_latency"])
+        cstates.update(values.get("cstates", {}))
+        default = cstates.pop("*", None)
+        names = set(core._states_name_map.values())
+        unknown = set(cstates) - names
+        if unknown:
+            raise ValueError("Unknown C-states {} on core {}, available C-states "
+                             "are {}".format(sorted(unknown), core.core_id, sorted(names)))
+        for state, name in sorted(core._states_name_map.items()):
+            enable = cstates.get(name, default)
+            if enable is not None:
+                write_plan.add(os.path.join(core._idle_filename, state, "disable"),
+                               int(not enable), core)
+
+    if "resume_latency" in values:
+        latency = values["resume_latency"]
+        if latency is not None and (not isinstance(latency, int) or latency < 0):
+            raise ValueError("Invalid resume latency {} for core {}"
+                             .format(latency, core.core_id))
+        if not core.resume_latency_available:
+            raise ValueError("Cannot set resume latency of core {}, PM QoS is "
+                             "not available".format(core.core_id))
+        write_plan.add(core._resume_latency_filename,
+                       pwr._format_resume_latency(latency), core)
+
+
+def _power_limit_path(cpu):
+    """ Get the powercap long term power limit file of a package """
+    return os.path.join(pwr.BASE_POWERCAP_PATH, "intel-rapl:{}".format(cpu.cpu_id),
+                        "constraint_0_power_limit_uw")
+
+
+def _plan_package(write_plan, cpu, settings):
+    """ Validate the settings of a package and add its writes to a plan """
+    uncore_min = settings.get("uncore_min_freq")
+    uncore_max = settings.get("uncore_max_freq")
+    for freq in (uncore_min, uncore_max):
+        if freq is not None and not cpu.uncore_hw_min <= freq <= cpu.uncore_hw_max:
+            raise ValueError("Invalid uncore frequency {} on package {}, must be "
+                             "in range {} to {}".format(freq, cpu.physical_id,
+                                                        cpu.uncore_hw_min, cpu.uncore_hw_max))
+    if uncore_min is not None and uncore_max is not None and uncore_min > uncore_max:
+        raise ValueError("Invalid uncore config, desired min({}) greater than "
+                         "desired max({})".format(uncore_min, uncore_max))
+
+    if cpu._uncore_max_freq_khz_filename:
+        if uncore_min is not None:
+            write_plan.add(cpu._uncore_min_freq_khz_filename, uncore_min * 1000, cpu)
+        if uncore_max is not None:
+            write_plan.add(cpu._uncore_max_freq_khz_filename, uncore_max * 1000, cpu)
+    else:
+        # max ratio in bits 0-6, min ratio in bits 8-14 of the uncore MSR
+        target = plan.msr_target(cpu._msr_core(), pwr.MSR_UNCORE_RATIO_LIMIT)
+        if uncore_min is not None:
+            write_plan.add(target, ((uncore_min // 100) << 8, 0x7F00), cpu)
+        if uncore_max is not None:
+            write_plan.add(target, (uncore_max // 100, 0x7F), cpu)
+
+    if settings.get("power_limit") is not None:
+        path = _power_limit_path(cpu)
+        if not os.path.exists(path):
+            raise ValueError("Cannot set power limit on package {}, powercap "
+                             "is not available".format(cpu.physical_id))
+        write_plan.add(path, int(settings["power_limit"] * 1000000), cpu)
+
+    sst.plan_package(cpu, settings, write_plan)
+
+
+def load(path):
+    """ Load a profile from a JSON or YAML file """
+    return Profile.load(path)
+
+
+def main():
+    """ Apply a profile file """
+    parser = argparse.ArgumentParser(description="Apply a pwr profile")
+    parser.add_argument("profile", help="JSON or YAML profile file")
+    parser.add_argument("-n", "--dry-run", action="store_true",
+                        help="only print the writes which would be made")
+    parser.add_argument("-f", "--force", action="store_true",
+                        help="write all values, not only changed ones")
+    args = parser.parse_args()
+
+    try:
+        profile = load(args.profile)
+        write_plan = profile.compile()
+        if not args.force:
+            write_plan = write_plan.diff()
+        if args.dry_run:
+            for target, value in write_plan:
+                print(target, value)
+            return
+        errors = write_plan.apply()
+    except (IOError, OSError, ValueError) as err:
+        print(err, file=sys.stderr)
+        sys.exit(1)
+    for target, err in errors.items():
+        print("Could not write {}: {}".format(target, err), file=sys.stderr)
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
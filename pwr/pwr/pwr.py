@@ -4,11 +4,14 @@
 """
 Power library which allows an application to modify power attributes of cpu.
 """
+import errno
 import os
 import re
 import struct
+import threading
 import time
 from .internal import cpuinfo
+from . import cpuid
 import glob
 
 MSR_PLATFORM_INFO = 0xCE
@@ -24,11 +27,43 @@ MSR_PKG_ENERGY_STATUS = 0x611
 BASE_PATH = "/sys/devices/system/cpu"
 BASE_POWERCAP_PATH = "/sys/devices/virtual/powercap/intel-rapl"
 UNCORE_PATH = "/sys/devices/system/cpu/intel_uncore_frequency/"
+DMA_LATENCY_DEVICE = "/dev/cpu_dma_latency"
+
+# Hybrid CPUs list the cpus of each core type under their PMU in sysfs
+CORE_TYPE_CPUS_FILES = (
+    ("core", "/sys/devices/cpu_core/cpus"),
+    ("atom", "/sys/devices/cpu_atom/cpus"),
+)
+# Core type field of CPUID leaf 0x1A, EAX bits 24-31
+CPUID_CORE_TYPES = cpuid.CORE_TYPES
+
+# Numeric EPP values the kernel uses for the named preferences
+EPP_VALUES = {
+    "performance": 0,
+    "balance_performance": 128,
+    "balance_power": 192,
+    "power": 255,
+}
+
+# Stats which can be selectively updated by refresh_stats()
+CORE_STATS = ("online", "min_freq", "max_freq", "cstates", "epp", "curr_freq",
+              "resume_latency")
+CPU_STATS = ("sst_bf_configured", "uncore_freq", "uncore_min_freq",
+             "uncore_max_freq", "power_consumption")
 
 # Core and cpu lists to be filled with corresponding objects
 CORES = []
 CPUS = []
 SYSTEM = None
+# Core objects indexed by logical cpu id, cpu ids may be sparse
+_CORES_BY_ID = {}
+# Open MSR file descriptors indexed by core, None if not kept open
+_MSR_FDS = None
+# RAPL MSRs readable, None until probed
+_RAPL_MSR = None
+# Serializes the first initialization of the objects
+_INIT_LOCK = threading.Lock()
+_INITIALIZED = False
 # Python 2 doesn't have monotonic
 try:
     time.monotonic
@@ -49,6 +84,7 @@ class Core(object):
         self.cpu = cpu                      # this cores cpu object
         self.thread_siblings = None         # list of thread siblings
         self.high_priority = False          # high/low priority
+        self.core_type = None               # "core" or "atom" on hybrid CPUs
         self.base_freq = None               # base freqeuncy
         self.sst_bf_base_freq = None        # priority based frequency
         self.all_core_turbo_freq = None     # all core turbo frequency
@@ -59,8 +95,11 @@ class Core(object):
         self.max_freq = None                # desired high frequency
         self.epp = None                     # energy performance preference
         self.cstates = None                 # dict of c-states
+        self.resume_latency = None          # PM QoS resume latency limit in us
+        self.resume_latency_available = False  # PM QoS resume latency present
 
-        self._epp_available = []
+        self._lock = threading.RLock()      # serializes staged commits
+        self._epp_available = ""
         self._cpu_name = "cpu{}".format(self.core_id)
         self._core_online_filename = os.path.join(
             BASE_PATH, self._cpu_name, "online")
@@ -76,33 +115,46 @@ class Core(object):
         self._sst_bf_base_filename = os.path.join(BASE_PATH,
                                                   "cpu{}".format(id_num),
                                                   "cpufreq", "base_frequency")
+        self._idle_filename = os.path.join(
+            BASE_PATH, self._cpu_name, "cpuidle")
+        self._resume_latency_filename = os.path.join(
+            BASE_PATH, self._cpu_name, "power", "pm_qos_resume_latency_us")
+        self._resume_latency_value = None   # last read or written PM QoS value
+        self._states_name_map = {}
+        self._probe_sysfs()
+
+    def _probe_sysfs(self):
+        """
+        Discover per-core sysfs entries, which are only present while the core
+        is online. Called again by the topology watcher when a core comes online.
+        """
+        self.resume_latency_available = os.path.exists(self._resume_latency_filename)
         try:
             self._epp_available = _read_sysfs(self._epp_available_filename)
         except (IOError, OSError):
             # EPP is not available
             pass
 
-        self._idle_filename = os.path.join(
-            BASE_PATH, self._cpu_name, "cpuidle")
         try:
             cstate_fnames = os.listdir(os.path.join(self._idle_filename))
             self._states_name_map = {
                 fnames: _read_sysfs(os.path.join(self._idle_filename, fnames, "name"))
                 for fnames in cstate_fnames
             }
-        except IOError as err:
-            if err.errno == 2:  # cpuidle driver not present
+        except (IOError, OSError) as err:
+            if err.errno == 2:  # cpuidle driver not present, or core offline
                 self._states_name_map = {}
             else:
                 raise IOError("{}\nCould not read from cpuidle directory".format(err))
 
-
     def _read_capabilities(self):
         """
         Get constant capabilities of core, this is called at core initialization
         and does not need to be called by the application
         """
-        self.base_freq = self.cpu.base_freq
+        # hybrid core types have their own frequency tables
+        caps = self.cpu.core_types.get(self.core_type, {})
+        self.base_freq = caps.get("base_freq", self.cpu.base_freq)
 
         # On initialization these values need to be checked before checking is sst_bf enabled
         try:
@@ -123,12 +175,18 @@ class Core(object):
         if self.cpu.sys.sst_bf_enabled and self.sst_bf_base_freq > self.base_freq:
             self.high_priority = True
 
-        self.all_core_turbo_freq = self.cpu.all_core_turbo_freq
-        self.highest_freq = self.cpu.highest_freq
-        self.lowest_freq = self.cpu.lowest_freq
+        self.all_core_turbo_freq = caps.get("all_core_turbo_freq",
+                                            self.cpu.all_core_turbo_freq)
+        self.highest_freq = self.cpu._highest_freqs.get(
+            self.core_id, caps.get("highest_freq", self.cpu.highest_freq))
+        self.lowest_freq = caps.get("lowest_freq", self.cpu.lowest_freq)
 
-    def refresh_stats(self):
-        """ Get current regularly changing or user defined stats of core """
+    def refresh_stats(self, fields=None):
+        """
+        Get current regularly changing or user defined stats of core.
+        Only the stats named in fields are updated, if given.
+        """
+        fields = _check_stats(fields, CORE_STATS)
         valid_range = [v for v in range(
             self.lowest_freq, self.highest_freq, 100)]
         valid_range.append(self.highest_freq)
@@ -160,13 +218,33 @@ class Core(object):
             try:
                 if self.cpu.sys.epp_enabled:
                     epp = _read_sysfs(self._epp_filename)
-                    if epp not in self._epp_available:  # Ensure valid sysfs entry before setting
+                    if epp.isdigit():  # value without a name, set numerically
+                        return int(epp)
+                    if not self._valid_epp(epp):  # Ensure valid sysfs entry before setting
                         raise ValueError("Incorrect sysfs Entry")
                     return epp
             except (IOError, OSError) as err:
                 raise IOError("{} \nCould not read core {} stats from sysfs entry"
                               .format(err, self.core_id))
 
+        def get_resume_latency():
+            """
+            Get PM QoS resume latency limit, None if there is no limit or
+            PM QoS is not available
+            """
+            if not self.resume_latency_available:
+                return None
+            try:
+                self._resume_latency_value = _read_sysfs(self._resume_latency_filename)
+                return _parse_resume_latency(self._resume_latency_value)
+            except (IOError, OSError) as err:
+                if err.errno == errno.ENOENT:  # PM QoS not available
+                    self.resume_latency_available = False
+                    self._resume_latency_value = None
+                    return None
+                raise IOError("{}\nCould not read core {} resume latency"
+                              .format(err, self.core_id))
+
         def get_curr_freq():
             """ Get current frequency """
             regstr = _rdmsr(self.core_id, MSR_IA32_PERF_STATUS)
@@ -196,44 +274,63 @@ class Core(object):
 
             return c_states
 
-        self.min_freq = get_desired_min_freq()
-        self.max_freq = get_desired_max_freq()
-        self.cstates = get_cstates()
+        readers = {
+            "min_freq": get_desired_min_freq,
+            "max_freq": get_desired_max_freq,
+            "cstates": get_cstates,
+            "epp": get_desired_epp,
+            "curr_freq": get_curr_freq,
+            "resume_latency": get_resume_latency,
+        }
+
+        # offline cores have no cpufreq/cpuidle entries, check this first
         self.online = check_core_online()
         if not self.online:
             return
-        self.epp = get_desired_epp()
-        self.curr_freq = get_curr_freq()
+        for field in CORE_STATS:
+            if field in fields and field in readers:
+                setattr(self, field, readers[field]())
 
-    def commit(self, profile=""):
-        """ Update sysfs entries for min/max/epp with core instance attributes """
-        if not self.online:
-            return
+    def _valid_epp(self, epp):
+        """
+        Check an EPP value is one of the available preferences, or a number
+        from 0 to 255, which intel_pstate accepts in HWP mode
+        """
+        if isinstance(epp, int) or (isinstance(epp, str) and epp.isdigit()):
+            return 0 <= int(epp) <= 255
+        return epp in self._epp_available.split()
+
+    def _profiles(self):
+        """ Get names of the pre-set profiles available for this core """
         core_profiles = ["minimum", "maximum", "base", "default", "no_turbo"]
 
         if self.cpu.sys.sst_bf_enabled:
             core_profiles += ["sst_bf"]
+        return core_profiles
+
+    def _profile_freqs(self, profile):
+        """ Get min and max core frequency of a pre-set profile """
+        if profile not in self._profiles():  # Check if valid profile
+            raise ValueError("Cannot set core profile {}, available profiles are {}"
+                             .format(profile, self._profiles()))
+        return {
+            "minimum": (self.lowest_freq, self.lowest_freq),
+            "maximum": (self.highest_freq, self.highest_freq),
+            "base": (self.base_freq, self.base_freq),
+            "default": (self.lowest_freq, self.highest_freq),
+            "no_turbo": (self.lowest_freq, self.base_freq),
+            "sst_bf": (self.sst_bf_base_freq, self.sst_bf_base_freq),
+        }[profile]
+
+    def commit(self, profile=""):
+        """ Update sysfs entries for min/max/epp with core instance attributes """
+        if not self.online:
+            return
 
         def apply_profile(profile=""):
             """ Set min and max core frequency based on profile if one has been chosen """
-            if profile == "minimum":
-                self.min_freq = self.lowest_freq
-                self.max_freq = self.lowest_freq
-            elif profile == "maximum":
-                self.min_freq = self.highest_freq
-                self.max_freq = self.highest_freq
-            elif profile == "base":
-                self.min_freq = self.base_freq
-                self.max_freq = self.base_freq
-            elif profile == "default":
-                self.min_freq = self.lowest_freq
-                self.max_freq = self.highest_freq
-            elif profile == "no_turbo":
-                self.min_freq = self.lowest_freq
-                self.max_freq = self.base_freq
-            elif profile == "sst_bf":
-                self.min_freq = self.sst_bf_base_freq
-                self.max_freq = self.sst_bf_base_freq
+            if profile:
+                self.min_freq, self.max_freq = self._profile_freqs(profile)
 
         def set_min_max_freq(self):
             """ Set desired minimum and maximum frequency """
@@ -260,8 +357,9 @@ class Core(object):
                 else:
                     raise ValueError("Cannot set epp to {}, EPP is not enabled"
                                      .format(self.epp))
-            if self.epp and self.epp not in self._epp_available:
-                raise ValueError("Cannot set epp to {}, available options are {}"
+            if self.epp not in (None, "") and not self._valid_epp(self.epp):
+                raise ValueError("Cannot set epp to {}, available options are {} "
+                                 "or a number from 0 to 255"
                                  .format(self.epp, self._epp_available))
 
             _write_sysfs(self._epp_filename, self.epp)
@@ -284,10 +382,28 @@ class Core(object):
                 _write_sysfs(os.path.join(
                     self._idle_filename, state, "disable"), disable)
 
+        def set_resume_latency(self):
+            """ Set PM QoS resume latency limit, if it changed """
+            if not self.resume_latency_available:
+                if self.resume_latency is None:
+                    return
+                raise ValueError("Cannot set resume latency to {}, PM QoS is "
+                                 "not available".format(self.resume_latency))
+            value = _format_resume_latency(self.resume_latency)
+            if value == self._resume_latency_value:
+                return
+            self._resume_latency_value = None   # unknown if the write fails
+            _write_sysfs(self._resume_latency_filename, value)
+            self._resume_latency_value = value
+
         valid_range = [v for v in range(
             self.lowest_freq, self.highest_freq, 100)]
         valid_range.append(self.highest_freq)
 
+        if self.resume_latency is not None and self.resume_latency < 0:
+            raise ValueError("Cannot update core, resume latency must not be "
+                             "negative")
+
         if self.min_freq not in valid_range:
             raise ValueError("Cannot update core, min freq out of valid range. "
                              "Lowest: {}, Highest: {}".format(self.lowest_freq, self.highest_freq))
@@ -296,16 +412,13 @@ class Core(object):
             raise ValueError("Cannot update core, max freq out of valid range. "
                              "Lowest: {}, Highest: {}".format(self.lowest_freq, self.highest_freq))
 
-        if profile and profile not in core_profiles:  # Check if valid profile
-            raise ValueError("Cannot set core profile {}, available profiles are {}"
-                             .format(profile, core_profiles))
-        else:
-            apply_profile(profile)
+        apply_profile(profile)
 
         try:
             set_min_max_freq(self)
         except (IOError, OSError) as err:
-            if err.errno == 16 or 22:  # Change in core offline/online status mid flight
+            # Change in core offline/online status mid flight
+            if err.errno in (errno.EBUSY, errno.EINVAL):
                 return  # skip core
             raise IOError("{}\nCannot update min/max freq on core {}"
                           .format(err, self.core_id))
@@ -313,7 +426,8 @@ class Core(object):
         try:
             set_epp(self)
         except (IOError, OSError) as err:
-            if err.errno == 16 or 22:  # Change in core offline/online status mid flight
+            # Change in core offline/online status mid flight
+            if err.errno in (errno.EBUSY, errno.EINVAL):
                 return  # skip core
             raise IOError("{}\nCannot update epp on core {}"
                           .format(err, self.core_id))
@@ -321,11 +435,21 @@ class Core(object):
         try:
             set_cstates(self)
         except (IOError, OSError) as err:
-            if err.errno == 16 or 22:  # Change in core offline/online status mid flight
+            # Change in core offline/online status mid flight
+            if err.errno in (errno.EBUSY, errno.EINVAL):
                 return  # skip core
             raise IOError("{}\nCannot update C-states on core {}"
                           .format(err, self.core_id))
 
+        try:
+            set_resume_latency(self)
+        except (IOError, OSError) as err:
+            # Change in core offline/online status mid flight
+            if err.errno in (errno.EBUSY, errno.EINVAL):
+                return  # skip core
+            raise IOError("{}\nCannot update resume latency on core {}"
+                          .format(err, self.core_id))
+
 
 class CPU(object):
     """
@@ -346,6 +470,7 @@ class CPU(object):
         self.all_core_turbo_freq = None     # all core turbo frequency
         self.highest_freq = None            # single core turbo frequency
         self.lowest_freq = None             # lowest active frequency
+        self.core_types = {}                # capabilities of each hybrid core type
         self.uncore_hw_max = 2400           # max available uncore frequency
         self.uncore_hw_min = 800            # min available uncore frequency
         self.power_consumption = None       # power consumption since last update
@@ -355,6 +480,9 @@ class CPU(object):
         self.uncore_max_freq = None         # max desired uncore frequency
         self.uncore_min_freq = None         # min desired uncore frequency
 
+        self._lock = threading.RLock()      # serializes staged commits
+        self._highest_freqs = {}            # hybrid core id to its own highest freq
+
         # private power consumption-related data
         self._prev_power_cons_ts = None   # timestamp for previous power consumption data
         self._prev_power_cons_val = None  # previous power consumption data
@@ -369,17 +497,32 @@ class CPU(object):
         self._uncore_max_freq_khz_filename = ''
         self._uncore_min_freq_khz_filename = ''
 
+    def _msr_core(self):
+        """ Get id of an online core which can be used for package MSR access """
+        for core in self.core_list:
+            if core.online:
+                return core.core_id
+        return self.core_list[0].core_id
+
+    def _update_aggregates(self):
+        """ Recalculate package wide values which depend on the online cores """
+        online = [c for c in self.core_list if c.online]
+        self.freq_budget = sum([c.base_freq or self.base_freq for c in online], 0)
+
     def _read_capabilities(self, core=None):
         """
         Get constant capabilities of CPU, this is called at CPU initialization
         and does not need to be called by application
         """
         if core is None:
-            core = self.core_list[0].core_id
+            core = self._msr_core()
 
         powercap_cpu_base = os.path.join(
             BASE_POWERCAP_PATH, "intel-rapl:{}".format(self.cpu_id))
         power_cons_msr = not os.path.isdir(powercap_cpu_base)
+        # None without the cpuid driver, then the MSRs are probed instead
+        features = cpuid.get_features(core, _CORES_BY_ID[core].core_type
+                                      if core in _CORES_BY_ID else None)
 
         def get_msr_power_units():
             """ Get power and energy units from MSR_RAPL_POWER_UNIT """
@@ -428,6 +571,8 @@ class CPU(object):
 
         def check_hwp():
             """ Check HWP enabled """
+            if features is not None and not features.hwp:
+                return False  # IA32_PM_ENABLE does not exist
             regstr = _rdmsr(core, MSR_IA32_PM_ENABLE)
             # Unpack the 8 bytes into array of unsigned chars
             data = struct.unpack('BBBBBBBB', regstr)
@@ -436,12 +581,33 @@ class CPU(object):
 
         def check_turbo():
             """ Check Turbo enabled """
+            if features is not None:
+                # CPUID reports turbo as unavailable while it is disabled,
+                # which can change at runtime, so the cached leaf is not used
+                try:
+                    return bool(cpuinfo.read_cpuid(core, 0x6)[0] & (1 << 1))
+                except IOError:
+                    pass
             regstr = _rdmsr(core, MSR_IA32_MISC_ENABLES)
             # Unpack 8 bytes into array of unsigned chars
             msr_bytes = struct.unpack('BBBBBBBB', regstr)
             disabled = msr_bytes[4] & 0x40
             return disabled == 0
 
+        def check_rapl_msr():
+            """
+            Check the RAPL MSRs are present, they are not enumerated by CPUID
+            so MSR_RAPL_POWER_UNIT is probed, once for the system
+            """
+            global _RAPL_MSR
+            if _RAPL_MSR is None:
+                try:
+                    _rdmsr(core, MSR_RAPL_POWER_UNIT)
+                    _RAPL_MSR = True
+                except (IOError, OSError):
+                    _RAPL_MSR = False
+            return _RAPL_MSR
+
         def get_all_core_turbo():
             """ Get frequency at which all cores can go turbo """
             regstr = _rdmsr(core, MSR_TURBO_RATIO_LIMIT)
@@ -483,8 +649,13 @@ class CPU(object):
         self.hwp_enabled = check_hwp()
         self.turbo_enabled = check_turbo()
         self.all_core_turbo_freq = get_all_core_turbo()
-        self.freq_budget = sum([self.base_freq for c in self.core_list], 0)
-        if power_cons_msr:
+        self._read_core_type_capabilities()
+        self._update_aggregates()
+        if power_cons_msr and not check_rapl_msr():
+            # no powercap and no RAPL MSRs, power consumption is not available
+            self.tdp = None
+            self._power_cons_max = None
+        elif power_cons_msr:
             # read raw power units from MSR
             power_unit, energy_unit = get_msr_power_units()
 
@@ -527,6 +698,47 @@ class CPU(object):
             # attempted to read uncore sysfs but failed, so fall back to MSR
             pass
 
+    def _read_core_type_capabilities(self):
+        """
+        Get the frequency capabilities of each core type on hybrid CPUs,
+        read from the online cores of that type
+        """
+        self.core_types = {}
+        self._highest_freqs = {}
+        online = [c for c in self.core_list if c.online and c.core_type]
+        for core_type in set(c.core_type for c in online):
+            cores = [c.core_id for c in online if c.core_type == core_type]
+            lowest, base = [], []
+            for core in cores:
+                cpufreq = os.path.join(BASE_PATH, "cpu{}".format(core), "cpufreq")
+                try:
+                    lowest.append(int(_read_sysfs(
+                        os.path.join(cpufreq, "cpuinfo_min_freq"))) // 1000)
+                    # favored cores of a type may turbo higher than the others
+                    self._highest_freqs[core] = int(_read_sysfs(
+                        os.path.join(cpufreq, "cpuinfo_max_freq"))) // 1000
+                except (IOError, OSError) as err:
+                    raise IOError("{}\nCould not read core {} capabilities from "
+                                  "sysfs entry".format(err, core))
+                try:
+                    base.append(int(_read_sysfs(
+                        os.path.join(cpufreq, "base_frequency"))) // 1000)
+                except (IOError, OSError):
+                    pass
+            if not base:
+                # platform info holds the base ratio of the core type it is read on
+                data = struct.unpack('BBBBBBBB', _rdmsr(cores[0], MSR_PLATFORM_INFO))
+                base = [data[1] * 100]
+            # the turbo ratio limits are also reported per core type
+            turbo = struct.unpack('BBBBBBBB', _rdmsr(cores[0], MSR_TURBO_RATIO_LIMIT))
+            self.core_types[core_type] = {
+                "lowest_freq": min(lowest),
+                "highest_freq": max(self._highest_freqs[c] for c in cores),
+                # with SST-BF the lower tier is the base of the type
+                "base_freq": min(base),
+                "all_core_turbo_freq": turbo[7] * 100,
+            }
+
     # this isn't an inner function in refresh_stats because we need private state
     def _get_avg_power_consumption(self, core):
         """ Get average power consumption since last check """
@@ -553,6 +765,9 @@ class CPU(object):
             cur_cons, _ = struct.unpack('II', regstr)
             return cur_cons
 
+        if power_cons_msr and self._power_cons_max is None:
+            return None  # no RAPL
+
         # first, read current power consumption value and timestamp
         cur_ts = time.monotonic()
         if power_cons_msr:
@@ -607,16 +822,22 @@ class CPU(object):
         res = min(max(0.0, res), self.tdp)
         return res
 
-    def refresh_stats(self, core=None):
-        """ Get current regularly changing or user defined stats of CPU """
+    def refresh_stats(self, core=None, fields=None):
+        """
+        Get current regularly changing or user defined stats of CPU.
+        Only the stats named in fields are updated, if given.
+        """
+        fields = _check_stats(fields, CPU_STATS)
         if core is None:
-            core = self.core_list[0].core_id
+            core = self._msr_core()
 
         def check_sst_bf_configured():
             if not self.sys.sst_bf_enabled:
                 return False
             for _core in self.core_list:
                 _core.refresh_stats()
+                if not _core.online:
+                    continue
                 if _core.min_freq != _core.sst_bf_base_freq or _core.max_freq != _core.sst_bf_base_freq:
                     return False
             return True
@@ -639,10 +860,14 @@ class CPU(object):
             minimum = data[1] & 0x7F  # bits 8-14
             return minimum * 100, maximum * 100
 
-        self.sst_bf_configured = check_sst_bf_configured()
-        self.uncore_freq = get_current_uncore_freq()
-        self.uncore_min_freq, self.uncore_max_freq = get_uncore_min_max()
-        self.power_consumption = self._get_avg_power_consumption(core)
+        if "sst_bf_configured" in fields:
+            self.sst_bf_configured = check_sst_bf_configured()
+        if "uncore_freq" in fields:
+            self.uncore_freq = get_current_uncore_freq()
+        if "uncore_min_freq" in fields or "uncore_max_freq" in fields:
+            self.uncore_min_freq, self.uncore_max_freq = get_uncore_min_max()
+        if "power_consumption" in fields:
+            self.power_consumption = self._get_avg_power_consumption(core)
 
     def _validate_uncore_freq(self, uncore_freq):
         """ Only check if using sysfs, cannot validate using MSRs alone """
@@ -666,14 +891,14 @@ class CPU(object):
             raise ValueError("Cannot update uncore freq, desired min({}) greater than desired max({})"
                              .format(self.uncore_min_freq, self.uncore_max_freq))
         # Read all msr data as to not overwrite other MSR data on write
-        read_regstr = _rdmsr(self.core_list[0].core_id, MSR_UNCORE_RATIO_LIMIT)
+        read_regstr = _rdmsr(self._msr_core(), MSR_UNCORE_RATIO_LIMIT)
         data = struct.unpack('BBBBBBBB', read_regstr)
 
         # Update uncore desired min & max, currently only bytes 0 and 1 are used.
         write_regstr = struct.pack('BBBBBBBB',
                                    self.uncore_max_freq // 100, self.uncore_min_freq // 100,
                                    data[2], data[3], data[4], data[5], data[6], data[7])
-        _wrmsr(self.core_list[0].core_id, MSR_UNCORE_RATIO_LIMIT, write_regstr)
+        _wrmsr(self._msr_core(), MSR_UNCORE_RATIO_LIMIT, write_regstr)
 
     def commit(self):
         ''' Try to set uncore min/max using sysfs if available, else via MSR. '''
@@ -697,6 +922,10 @@ class System(object):
         self.sst_bf_enabled = False         # base frequency enabled in BIOS
         self.sst_bf_configured = False      # all cores set to sst_bf config
         self.epp_enabled = None             # epp enabled flag
+        self.dma_latency = None             # system wide PM QoS latency request in us
+
+        self._dma_latency_fd = None         # held open while a request is active
+        self._dma_latency_committed = None
 
     def request_config(self, cpus=None):
         """
@@ -705,10 +934,10 @@ class System(object):
         or through parameters passed to API.
         """
         def check_valid_core_freq(core):
-            """ Ensure frequencies are valid """
+            """ Ensure frequencies are valid for the type of the core """
             valid_range = [v for v in range(
-                self.cpu_list[0].lowest_freq, self.cpu_list[0].highest_freq, 100)]
-            valid_range.append(self.cpu_list[0].highest_freq)
+                core.lowest_freq, core.highest_freq, 100)]
+            valid_range.append(core.highest_freq)
             if core.min_freq > core.max_freq:
                 raise ValueError("Invalid config, desired min freq({}) "
                                  "is greater than desired max freq({})" .format(core.min_freq, core.max_freq))
@@ -721,7 +950,7 @@ class System(object):
 
             if not cpus:
                 cpus = self.cpu_list
-            cores = [c for cpu in cpus for c in cpu.core_list]
+            cores = [c for cpu in cpus for c in cpu.core_list if c.online]
 
             # ensure all frequencies are valid
             for core in cores:
@@ -738,9 +967,11 @@ class System(object):
 
             # Check requested configuration minimum greater than the cpu budget frequency
             for cpu in cpus:
-                freqs = [c.min_freq for c in cpu.core_list]
-                requested_budget = sum(freqs)
-                over_act = max(freqs) > cpu.all_core_turbo_freq
+                online = [c for c in cpu.core_list if c.online]
+                if not online:
+                    continue
+                requested_budget = sum(c.min_freq for c in online)
+                over_act = any(c.min_freq > c.all_core_turbo_freq for c in online)
                 if over_act or requested_budget > cpu.freq_budget:
                     return False
             return True
@@ -761,21 +992,62 @@ class System(object):
         for cpu in self.cpu_list:
             cpu.commit()
 
+        self._commit_dma_latency()
+
+    def _commit_dma_latency(self):
+        """
+        Update the system wide latency request. The request stays active
+        while the device file is held open, None drops it. If the update
+        fails, the previous request stays active and dma_latency is rolled
+        back to it.
+        """
+        if self.dma_latency == self._dma_latency_committed:
+            return
+        if self.dma_latency is None:
+            os.close(self._dma_latency_fd)
+            self._dma_latency_fd = None
+            self._dma_latency_committed = None
+            return
+
+        opened = False
+        try:
+            if self.dma_latency < 0:
+                raise ValueError("Cannot set dma latency to {}, it must not be "
+                                 "negative".format(self.dma_latency))
+            if self._dma_latency_fd is None:
+                self._dma_latency_fd = os.open(DMA_LATENCY_DEVICE, os.O_WRONLY)
+                opened = True
+            os.write(self._dma_latency_fd, struct.pack("i", int(self.dma_latency)))
+        except (IOError, OSError, ValueError) as err:
+            if opened:
+                os.close(self._dma_latency_fd)
+                self._dma_latency_fd = None
+            self.dma_latency = self._dma_latency_committed
+            if isinstance(err, ValueError):
+                raise
+            raise IOError("{}\nCould not update {} request"
+                          .format(err, DMA_LATENCY_DEVICE))
+        self._dma_latency_committed = self.dma_latency
+
     def _check_epp_enabled(self):
         """
         EPP is enabled if CPUID bits indicate support for EPP, and if there are
         sysfs entries.
         """
-        core_obj = self.cpu_list[0].core_list[0]
+        core_obj = _CORES_BY_ID[self.cpu_list[0]._msr_core()]
         core_id = core_obj.core_id
+        features = cpuid.get_features(core_id, core_obj.core_type)
         try:
-            cpuinfo_obj = cpuinfo.get_info_list()[core_id]
+            if features is not None:
+                hwp_epp = features.hwp_epp
+            else:
+                hwp_epp = cpuinfo.has_flag(core_id, "hwp_epp")
         except (IOError, OSError):
-            # failed to read /proc/cpuinfo, assume EPP is not supported
+            # failed to read /proc/cpuinfo and CPUID, assume EPP is not supported
             self.epp_enabled = False
             return
         # if EPP bit in CPUID is not set, EPP is not supported
-        if "hwp_epp" not in cpuinfo_obj.flags:
+        if not hwp_epp:
             self.epp_enabled = False
             return
 
@@ -786,10 +1058,14 @@ class System(object):
         def _check_sst_bf_enabled():
             """
             SST_BF is enabled when sysfs base frequencies differ between cores
+            of the same type, hybrid core types have different base frequencies
             """
-            base_freqs = set(core.sst_bf_base_freq for core in CORES)
+            base_freqs = {}
+            for core in CORES:
+                if core.online:
+                    base_freqs.setdefault(core.core_type, set()).add(core.sst_bf_base_freq)
             # if there are two tiers, that means SST-BF is enabled
-            self.sst_bf_enabled = len(base_freqs) == 2
+            self.sst_bf_enabled = any(len(f) == 2 for f in base_freqs.values())
 
         _check_sst_bf_enabled()
         self._check_epp_enabled()
@@ -810,6 +1086,8 @@ class System(object):
                     target = set([core.sst_bf_base_freq])
                     # refresh the core before reading min
                     core.refresh_stats()
+                    if not core.online:
+                        continue
                     if set([core.min_freq, core.max_freq]) != target:
                         cpu.sst_bf_configured = False
                         break
@@ -830,11 +1108,60 @@ class System(object):
         self.refresh_stats()
 
 
+def _check_stats(fields, valid):
+    """ Validate a list of stats names to refresh, defaulting to all of them """
+    if fields is None:
+        return valid
+    unknown = set(fields) - set(valid)
+    if unknown:
+        raise ValueError("Cannot refresh unknown stats {}, available stats are {}"
+                         .format(sorted(unknown), list(valid)))
+    return fields
+
+
+def keep_msr_open(enable=True):
+    """
+    Keep MSR device files open between accesses, saving an open and close
+    on every read and write. Intended for long running applications.
+    """
+    global _MSR_FDS
+    if enable:
+        if _MSR_FDS is None:
+            _MSR_FDS = {}
+        return
+    if _MSR_FDS is not None:
+        for core in list(_MSR_FDS):
+            _close_msr_fd(core)
+    _MSR_FDS = None
+
+
+def _msr_fd(core):
+    """ Get the cached MSR file descriptor of a core, opening it if needed """
+    fd = _MSR_FDS.get(core)
+    if fd is None:
+        fd = os.open(os.path.join("/dev/cpu", str(core), "msr"), os.O_RDWR)
+        _MSR_FDS[core] = fd
+    return fd
+
+
+def _close_msr_fd(core):
+    """ Close a cached MSR file descriptor, e.g. after the core went offline """
+    fd = _MSR_FDS.pop(core, None)
+    if fd is not None:
+        os.close(fd)
+
+
 def _rdmsr(core, msr):
     """
     Read a 64-byte value from an MSR through the sysfs interface.
     Returns an 8-byte binary packed string.
     """
+    if _MSR_FDS is not None:
+        try:
+            return os.pread(_msr_fd(core), 8, msr)
+        except (IOError, OSError):
+            # fall back to opening the file, to get the usual error
+            _close_msr_fd(core)
     msr_filename = os.path.join("/dev/cpu", str(core), "msr")
     try:
         with open(msr_filename, "rb") as msr_file:
@@ -851,6 +1178,13 @@ def _wrmsr(core, msr, regstr):
     Write a 64-byte value to an MSR through the sysfs interface.
     Expects an 8-byte binary packed string in regstr.
     """
+    if _MSR_FDS is not None:
+        try:
+            os.pwrite(_msr_fd(core), regstr, msr)
+            return
+        except (IOError, OSError):
+            # fall back to opening the file, to get the usual error
+            _close_msr_fd(core)
     msr_filename = os.path.join("/dev/cpu", str(core), "msr")
     try:
         with open(msr_filename, "wb") as msr_file:
@@ -861,6 +1195,65 @@ def _wrmsr(core, msr, regstr):
                       .format(err, msr, core))
 
 
+def _cpuid(core, leaf, subleaf=0):
+    """
+    Run CPUID on a core through the cpuid driver.
+    Returns the eax, ebx, ecx and edx registers.
+    """
+    return cpuinfo.read_cpuid(core, leaf, subleaf)
+
+
+def _read_core_types(core_ids):
+    """
+    Get the core type of each of the given online cores on hybrid CPUs,
+    from the hybrid PMU cpu lists in sysfs or else from CPUID leaf 0x1A.
+    Returns an empty dict on CPUs which are not hybrid.
+    """
+    types = {}
+    for core_type, filename in CORE_TYPE_CPUS_FILES:
+        try:
+            for core in _parse_cpulist(_read_sysfs(filename)):
+                types[core] = core_type
+        except (IOError, OSError):
+            continue
+    missing = [c for c in core_ids if c not in types]
+    if not missing:
+        return types
+    if not types:
+        # no hybrid PMUs, check the hybrid flag, CPUID leaf 7 EDX bit 15
+        features = cpuid.get_features(missing[0])
+        if features is None or not features.hybrid:
+            return types  # not hybrid, or cpuid driver not loaded
+    for core in missing:
+        try:
+            core_type = CPUID_CORE_TYPES.get(_cpuid(core, 0x1A)[0] >> 24)
+        except IOError:
+            continue
+        if core_type:
+            types[core] = core_type
+    return types
+
+
+def _parse_resume_latency(value):
+    """
+    Convert a pm_qos_resume_latency_us value to us, "0" means there is no
+    limit and "n/a" means no latency is allowed
+    """
+    if value == "n/a":
+        return 0
+    value = int(value)
+    return value if value else None
+
+
+def _format_resume_latency(latency):
+    """ Convert a resume latency in us, or None, to a pm_qos_resume_latency_us value """
+    if latency is None:
+        return "0"
+    if latency == 0:
+        return "n/a"
+    return str(int(latency))
+
+
 def _write_sysfs(file_name, value):
     """
     Write desired value into sysfs file
@@ -882,42 +1275,56 @@ def get_cores():  # type: () -> List[Core]
     """
     Returns Core object list
     """
-    if not CORES:
+    if not _INITIALIZED:
         _init()
     return CORES
 
 
+def get_core(core_id):  # type: (int) -> Core
+    """ Returns Core object for a logical cpu id, or None if not present """
+    if not _INITIALIZED:
+        _init()
+    return _CORES_BY_ID.get(core_id)
+
+
 def get_cpus():  # type: () -> List[CPU]
     """ Returns CPU object list """
-    if not CPUS:
+    if not _INITIALIZED:
         _init()
     return CPUS
 
 
 def get_system():  # type: () -> SYSTEM
-    global SYSTEM
     """ Returns system object """
-    if not SYSTEM:
+    if not _INITIALIZED:
         _init()
     return SYSTEM
 
 
 def get_objects():  # type: () -> SYSTEM,List[CPU],List[Core]
     """ Returns all objects, system, cpus and cores """
-    global SYSTEM
-    if not SYSTEM:
+    if not _INITIALIZED:
         _init()
     return SYSTEM, CPUS, CORES
 
 
 def _init():
-    """ Check drivers present and populate core and CPU lists """
+    """
+    Check drivers present and populate core and CPU lists. Only the first
+    call initializes, concurrent callers wait for it to finish.
+    """
+    global _INITIALIZED
+    with _INIT_LOCK:
+        if _INITIALIZED:
+            return
+
+        _get_msr_driver()
 
-    _get_msr_driver()
+        _get_scaling_driver()
 
-    _get_scaling_driver()
+        _populate_cores_cpus()
 
-    _populate_cores_cpus()
+        _INITIALIZED = True
 
 
 def _get_msr_driver():
@@ -940,77 +1347,120 @@ def _get_scaling_driver():
         raise IOError("Scaling driver not loaded\n{}".format(err))
 
 
+def _parse_cpulist(cpulist):
+    """
+    Parse a kernel cpulist string such as "0-3,8,10-11" into a list of ints
+    """
+    cpus = []
+    for part in cpulist.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            low, high = part.split('-')
+            cpus += range(int(low), int(high) + 1)
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def _get_cpu_ids():
+    """ Get sorted list of logical cpu ids present in sysfs """
+    regex = re.compile(r'cpu([0-9]+)$')
+    matches = [regex.match(name) for name in os.listdir(BASE_PATH)]
+    return sorted(int(m.group(1)) for m in matches if m)
+
+
+def _read_core_topology(core):
+    """
+    Read online state, physical package id and thread siblings of a core.
+    Package id and siblings are None if the core is offline, as the kernel
+    removes topology entries of offline cores.
+    """
+    core_dir = os.path.join(BASE_PATH, "cpu{}".format(core))
+    try:
+        with open(os.path.join(core_dir, "online")) as online_file:
+            core_online = bool(int(online_file.readline()))
+    except IOError:
+        # File not found, core is online, proceed with setup
+        core_online = True
+
+    physical_id = None
+    siblings = None
+    try:
+        physical_id = int(_read_sysfs(
+            os.path.join(core_dir, "topology/physical_package_id")))
+        # thread_siblings_list is a cpulist, so parse it
+        siblings = _parse_cpulist(_read_sysfs(
+            os.path.join(core_dir, "topology/thread_siblings_list")))
+        # remove self from list
+        siblings.remove(core)
+    except (IOError, OSError) as err:
+        if core_online:  # Check if failure due to core offline
+            raise Exception(
+                "{}\nCould not read core {} topology".format(err, core))
+    return core_online, physical_id, siblings
+
+
+def _get_cpu_obj(physical_id):
+    """ Find CPU object for a physical package, creating it if necessary """
+    for cpu_obj in CPUS:
+        if cpu_obj.physical_id == physical_id:
+            return cpu_obj
+    cpu_obj = CPU()
+    cpu_obj.cpu_id = len(CPUS)
+    cpu_obj.physical_id = physical_id
+    cpu_obj.sys = SYSTEM
+    CPUS.append(cpu_obj)
+    return cpu_obj
+
+
 def _populate_cores_cpus():
     """ Create and initialize core and cpu object lists """
     global SYSTEM
-    core_num = os.listdir("/sys/devices/system/cpu")
-    regex = re.compile(r'cpu[0-9]+')
-    core_num = list(filter(regex.match, core_num))
-    corecount = len(core_num)
-    cpu_ids = []
     ht_siblings_map = {}
+    physical_id = None
+    deferred = []
 
-    for core in range(corecount):
-        # Get CPU ID of each core
-        file_path = os.path.join(BASE_PATH, "cpu{}".format(core),
-                                 "topology/physical_package_id")
-        try:
-            with open(os.path.join(BASE_PATH, "cpu{}".format(core), "online")) as online_file:
-                core_online = bool(int(online_file.readline()))
-        except IOError:
-                # File not found, core is online, proceed with setup
-            core_online = True
-        try:
-            with open(file_path) as package_file:
-                physical_id = int(package_file.read())
-        except (IOError, OSError) as err:
-            if core_online:  # Check if failure due to core offline
-                raise Exception(
-                    "{}\nCould not read cores physical ID".format(err))
+    # Create system object
+    SYSTEM = System()
 
-        # Get siblings of each core
-        file_path = os.path.join(BASE_PATH, "cpu{}".format(core),
-                                 "topology/thread_siblings_list")
-        try:
-            with open(file_path) as s_list:
-                # thread_siblings_list is a CSV list, so parse it
-                siblings = [int(c) for c in s_list.read().split(',')]
-                # remove self from list
-                siblings.remove(core)
-        except (IOError, OSError) as err:
-            if core_online:  # Check if failure due to core offline
-                raise Exception(
-                    "{}\nCould not read thread siblings".format(err))
-        # Store  siblings for current core in a map
-        ht_siblings_map[core] = siblings
-
-        # Create CPU object
-        if physical_id not in cpu_ids:
-            cpu_obj = CPU()
-            cpu_obj.cpu_id = len(cpu_ids)
-            cpu_ids.append(physical_id)
-            cpu_obj.physical_id = physical_id
-            CPUS.append(cpu_obj)
-        else:
-            cpu_idx = cpu_ids.index(physical_id)
-            cpu_obj = CPUS[cpu_idx]
+    for core in _get_cpu_ids():
+        core_online, core_pkg, siblings = _read_core_topology(core)
+        # Offline cores have no topology, assume the package of the previous
+        # core, the topology watcher will correct this when they come online
+        if core_pkg is not None:
+            physical_id = core_pkg
+        # Store siblings for current core in a map
+        ht_siblings_map[core] = siblings or []
 
         # Create core object
-        core_obj = Core(core, cpu_obj)
+        if physical_id is None:
+            core_obj = Core(core, None)
+            deferred.append(core_obj)
+        else:
+            cpu_obj = _get_cpu_obj(physical_id)
+            core_obj = Core(core, cpu_obj)
+            cpu_obj.core_list.append(core_obj)
         core_obj.online = bool(core_online)
-        cpu_obj.core_list.append(core_obj)
-
-        # Create system object
-        SYSTEM = System()
 
         # Add core object to core list
         CORES.append(core_obj)
+        _CORES_BY_ID[core] = core_obj
+
+    for core_obj in deferred:
+        core_obj.cpu = CPUS[0]
+    CPUS[0].core_list[0:0] = deferred
+
+    core_types = _read_core_types([c.core_id for c in CORES if c.online])
+    for core in CORES:
+        core.core_type = core_types.get(core.core_id)
 
     # Gather hyperthread siblings - we have to have the full list before we can do that
     for core in CORES:
         # Update siblings list in core object list
-        core.thread_siblings = [CORES[s]
-                                for s in ht_siblings_map[core.core_id]]
+        core.thread_siblings = [_CORES_BY_ID[s]
+                                for s in ht_siblings_map[core.core_id]
+                                if s in _CORES_BY_ID]
 
     # Initialize all system, cpu and core objects.
     SYSTEM._check_epp_enabled()
@@ -0,0 +1,427 @@
+#!/usr/bin/env python
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright(c) 2019 Intel Corporation
+"""
+pwrd, a long running daemon holding initialized pwr objects, serving
+requests over a local Unix socket, and a client for it.
+
+The protocol is one JSON object per line in each direction. Every request
+has an "op" field and gets a response with an "ok" field, plus "error" if
+it failed, except for "subscribe" which streams samples until the client
+disconnects.
+
+    {"op": "snapshot"}
+    {"op": "capabilities"}
+    {"op": "set", "cores": "0-3,8", "min_freq": 1000, "max_freq": "max",
+     "epp": "performance", "cstates": {"C6": false}}
+    {"op": "profile", "name": "base", "cores": "0-3"}
+    {"op": "uncore", "packages": [0], "min_freq": 1200, "max_freq": 2000}
+    {"op": "subscribe", "interval": 1.0}
+
+Core sets are cpulists, or lists of core ids, and default to all cores.
+Frequencies can also be given as "min", "max" or "base", for each core's
+lowest, highest and base frequency. Concurrent "set" and "profile" requests
+are merged and committed together.
+"""
+import argparse
+import errno
+import json
+import os
+import queue
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+from . import pwr
+from . import snapshot
+
+DEFAULT_SOCKET = "/run/pwrd.sock"
+FREQ_KEYWORDS = {
+    "min": "lowest_freq",
+    "max": "highest_freq",
+    "base": "base_freq",
+}
+
+
+def _core_ids(cores):
+    """ Parse a core set, given as a cpulist or a list of core ids """
+    if cores is None:
+        return [c.core_id for c in pwr.get_cores()]
+    if isinstance(cores, str):
+        return pwr._parse_cpulist(cores)
+    return [int(c) for c in cores]
+
+
+def _snapshot_dict(snap):
+    """ Convert a snapshot to plain JSON serializable types """
+    return {
+        "version": snap.version,
+        "timestamp": snap.timestamp,
+        "sst_bf_configured": snap.sst_bf_configured,
+        "cores": {str(k): dict(v._asdict(), cstates=dict(v.cstates))
+                  for k, v in snap.cores.items()},
+        "cpus": {str(k): v._asdict() for k, v in snap.cpus.items()},
+    }
+
+
+def _is_int(value):
+    """ Check for an int which is not a bool """
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _check_value(attr, value):
+    """ Check the type of a value sent for a tunable attribute """
+    if attr in ("min_freq", "max_freq"):
+        valid = _is_int(value) or value in FREQ_KEYWORDS
+    elif attr == "epp":
+        valid = _is_int(value) or isinstance(value, str)
+    elif attr == "cstates":
+        valid = isinstance(value, dict) and \
+            all(isinstance(v, bool) for v in value.values())
+    else:  # resume_latency, in us or None for no limit
+        valid = value is None or (_is_int(value) and value >= 0)
+    if not valid:
+        raise ValueError("Invalid value {!r} for {}".format(value, attr))
+
+
+class _Pending(object):
+    """ A set of core changes waiting to be committed by the batcher """
+
+    def __init__(self, changes):
+        self.changes = changes      # dict of core id to attribute values
+        self.errors = None          # dict of core id to error message
+        self.done = threading.Event()
+
+
+class _Batcher(object):
+    """
+    Collects core changes arriving within a short window and commits each
+    affected core once, with a single snapshot publish.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self._queue = queue.Queue()
+        thread = threading.Thread(target=self._run, name="pwrd-batcher")
+        thread.daemon = True
+        thread.start()
+
+    def submit(self, changes):
+        """ Queue changes and wait for them to be committed """
+        pending = _Pending(changes)
+        self._queue.put(pending)
+        pending.done.wait()
+        return pending.errors
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._commit(batch)
+
+    @staticmethod
+    def _commit(batch):
+        errors = {}
+        try:
+            # later requests override earlier ones for the same attribute
+            merged = {}
+            for pending in batch:
+                for core_id, values in pending.changes.items():
+                    merged.setdefault(core_id, {}).update(values)
+
+            staged = []
+            for core_id, values in merged.items():
+                st = snapshot.stage(pwr.get_core(core_id))
+                for attr, value in values.items():
+                    if attr == "cstates":
+                        st.cstates.update(value)
+                    else:
+                        setattr(st, attr, value)
+                staged.append(st)
+            errors = snapshot.commit_all(staged)
+        except Exception as err:
+            # the batcher thread must survive, fail the whole batch instead
+            errors = {core_id: err for pending in batch
+                      for core_id in pending.changes}
+        finally:
+            for pending in batch:
+                pending.errors = {k: str(v) for k, v in errors.items()
+                                  if k in pending.changes}
+                pending.done.set()
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    """ Serves the requests of one client connection """
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode())
+                op = request.pop("op")
+                if op == "subscribe":
+                    self._subscribe(**request)
+                    return
+                response = self.server.dispatch(op, request)
+                response["ok"] = True
+            except (KeyError, TypeError, ValueError, IOError, OSError) as err:
+                response = {"ok": False, "error": str(err),
+                            "type": type(err).__name__}
+            self._send(response)
+
+    def _send(self, message):
+        self.wfile.write(json.dumps(message).encode() + b"\n")
+        self.wfile.flush()
+
+    def _subscribe(self, interval=1.0, count=None):
+        """ Stream the latest snapshot every interval seconds """
+        interval = max(float(interval), self.server.min_interval)
+        deadline = time.monotonic()
+        while count is None or count > 0:
+            try:
+                self._send(_snapshot_dict(snapshot.current()))
+            except (IOError, OSError):
+                return  # client went away
+            if count is not None:
+                count -= 1
+            deadline += interval
+            time.sleep(max(0, deadline - time.monotonic()))
+
+
+def _remove_stale_socket(path):
+    """
+    Remove the socket left behind by a daemon which is gone. A socket which
+    still accepts connections belongs to a running daemon, which is not
+    taken over.
+    """
+    if not os.path.exists(path):
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except (IOError, OSError) as err:
+        if err.errno not in (errno.ECONNREFUSED, errno.ENOENT):
+            raise IOError("{}\nCould not check socket {}".format(err, path))
+    else:
+        raise IOError("pwrd is already running on {}".format(path))
+    finally:
+        sock.close()
+    try:
+        os.unlink(path)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    pwrd server, holding warm pwr objects and a periodically refreshed
+    snapshot of their state
+    """
+    daemon_threads = True
+
+    def __init__(self, path=DEFAULT_SOCKET, refresh_interval=1.0,
+                 batch_window=0.002, min_interval=0.1):
+        """ Server object constructor """
+        self.refresh_interval = refresh_interval  # snapshot refresh period
+        self.min_interval = min_interval          # fastest subscribe period
+
+        _remove_stale_socket(path)
+        pwr.keep_msr_open()
+        snapshot.refresh_all()
+        self._batcher = _Batcher(batch_window)
+
+        # create the socket accessible to root only, there is no window
+        # with the default permissions
+        umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.__init__(self, path, _Handler)
+        finally:
+            os.umask(umask)
+
+        thread = threading.Thread(target=self._refresh, name="pwrd-refresh")
+        thread.daemon = True
+        thread.start()
+
+    def _refresh(self):
+        """ Keep the published snapshot up to date """
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                snapshot.refresh()
+            except (IOError, OSError):
+                # cores may go offline mid refresh, try again next time
+                pass
+
+    def dispatch(self, op, args):
+        """ Handle a single request, returning the response fields """
+        handler = getattr(self, "_op_" + op, None)
+        if handler is None:
+            raise ValueError("Unknown request {}".format(op))
+        return handler(**args)
+
+    def _op_snapshot(self):
+        return {"snapshot": _snapshot_dict(snapshot.current())}
+
+    def _op_capabilities(self):
+        system, cpus, cores = pwr.get_objects()
+        return {
+            "sst_bf_enabled": system.sst_bf_enabled,
+            "epp_enabled": system.epp_enabled,
+            "cpus": {str(c.physical_id): {
+                "base_freq": c.base_freq,
+                "all_core_turbo_freq": c.all_core_turbo_freq,
+                "uncore_hw_min": c.uncore_hw_min,
+                "uncore_hw_max": c.uncore_hw_max,
+                "tdp": c.tdp,
+            } for c in cpus},
+            "cores": {str(c.core_id): {
+                "physical_id": c.cpu.physical_id,
+                "lowest_freq": c.lowest_freq,
+                "highest_freq": c.highest_freq,
+                "base_freq": c.base_freq,
+                "sst_bf_base_freq": c.sst_bf_base_freq,
+                "high_priority": c.high_priority,
+                "profiles": c._profiles(),
+            } for c in cores},
+        }
+
+    def _op_set(self, cores=None, **values):
+        unknown = set(values) - set(snapshot.TUNABLES)
+        if unknown:
+            raise ValueError("Cannot set {}, settable attributes are {}"
+                             .format(sorted(unknown), list(snapshot.TUNABLES)))
+        for attr, value in values.items():
+            _check_value(attr, value)
+        changes = {}
+        for core_id in _core_ids(cores):
+            core = pwr.get_core(core_id)
+            if core is None:
+                raise ValueError("Core {} does not exist".format(core_id))
+            core_values = dict(values)
+            for attr in ("min_freq", "max_freq"):
+                if core_values.get(attr) in FREQ_KEYWORDS:
+                    core_values[attr] = getattr(
+                        core, FREQ_KEYWORDS[core_values[attr]])
+            changes[core_id] = core_values
+        return {"errors": self._batcher.submit(changes)}
+
+    def _op_profile(self, name, cores=None):
+        changes = {}
+        for core_id in _core_ids(cores):
+            core = pwr.get_core(core_id)
+            if core is None:
+                raise ValueError("Core {} does not exist".format(core_id))
+            min_freq, max_freq = core._profile_freqs(name)
+            changes[core_id] = {"min_freq": min_freq, "max_freq": max_freq}
+        return {"errors": self._batcher.submit(changes)}
+
+    def _op_uncore(self, packages=None, min_freq=None, max_freq=None):
+        for cpu in pwr.get_cpus():
+            if packages is not None and cpu.physical_id not in packages:
+                continue
+            with cpu._lock:
+                cpu.refresh_stats(fields=["uncore_min_freq", "uncore_max_freq"])
+                if min_freq is not None:
+                    cpu.uncore_min_freq = int(min_freq)
+                if max_freq is not None:
+                    cpu.uncore_max_freq = int(max_freq)
+                cpu.commit()
+        snapshot.refresh(["uncore_min_freq", "uncore_max_freq"])
+        return {}
+
+
+class Client(object):
+    """
+    Client for the pwrd daemon
+    """
+
+    def __init__(self, path=DEFAULT_SOCKET, timeout=None):
+        """ Client object constructor """
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.settimeout(timeout)
+        self._sock.connect(path)
+        self._file = self._sock.makefile("rb")
+
+    def close(self):
+        """ Close the connection """
+        self._file.close()
+        self._sock.close()
+
+    def request(self, op, **args):
+        """ Send a request and return the response """
+        args["op"] = op
+        self._sock.sendall(json.dumps(args).encode() + b"\n")
+        response = json.loads(self._file.readline().decode())
+        if not response.pop("ok"):
+            if response.get("type") == "ValueError":
+                raise ValueError(response["error"])
+            raise IOError(response["error"])
+        return response
+
+    def snapshot(self):
+        """ Get the latest snapshot, as a dict """
+        return self.request("snapshot")["snapshot"]
+
+    def capabilities(self):
+        """ Get the constant capabilities of all cores and CPUs """
+        return self.request("capabilities")
+
+    def set(self, cores=None, **values):
+        """ Set core attributes, returns dict of per-core errors """
+        return self.request("set", cores=cores, **values)["errors"]
+
+    def profile(self, name, cores=None):
+        """ Apply a pre-set profile, returns dict of per-core errors """
+        return self.request("profile", name=name, cores=cores)["errors"]
+
+    def uncore(self, packages=None, min_freq=None, max_freq=None):
+        """ Set uncore frequency limits """
+        self.request("uncore", packages=packages,
+                     min_freq=min_freq, max_freq=max_freq)
+
+    def subscribe(self, interval=1.0, count=None):
+        """ Iterate over snapshots sent every interval seconds """
+        self._sock.sendall(json.dumps(
+            {"op": "subscribe", "interval": interval, "count": count})
+            .encode() + b"\n")
+        for line in self._file:
+            yield json.loads(line.decode())
+
+
+def main():
+    """ Run the daemon """
+    parser = argparse.ArgumentParser(description="pwr daemon")
+    parser.add_argument("-s", "--socket", default=DEFAULT_SOCKET,
+                        help="Unix socket path (default: %(default)s)")
+    parser.add_argument("-r", "--refresh", type=float, default=1.0,
+                        help="snapshot refresh period in seconds")
+    parser.add_argument("-b", "--batch-window", type=float, default=2.0,
+                        help="time to collect concurrent changes, in ms")
+    args = parser.parse_args()
+
+    try:
+        server = Server(args.socket, args.refresh, args.batch_window / 1000.0)
+    except (IOError, OSError) as err:
+        print(err, file=sys.stderr)
+        sys.exit(1)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(args.socket)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright(c) 2019 Intel Corporation
+"""
+Shared memory telemetry segment.
+
+A single publisher writes pwr samples into a fixed layout memory mapped file,
+guarded by a sequence lock. Any number of reader processes map the same file
+and read samples without any system calls, or needing to be root.
+
+Layout (native byte order, version 1):
+    header      HEADER_FMT, 64 bytes
+    cores       ncores records of CORE_FMT, ordered by core id
+    cpus        ncpus records of CPU_FMT, ordered by physical id
+The sequence number is odd while a sample is being written.
+"""
+import collections
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+from . import pwr
+from . import snapshot
+
+DEFAULT_PATH = "/dev/shm/pwr-telemetry"
+MAGIC = b"PWRS"
+LAYOUT_VERSION = 1
+
+# magic, version, header size, seq, timestamp, flags, ncores, ncpus,
+# core record size, cpu record size, cores offset, cpus offset, reserved
+HEADER_FMT = struct.Struct("=4sHHQdIIIIIII12x")
+SEQ_OFFSET = 8
+SEQ_FMT = struct.Struct("=Q")
+FLAG_STALE = 0x1            # segment replaced, readers must re-open
+
+# core id, physical id, flags, curr freq, min freq, max freq, epp,
+# disabled C-states bitmask (bit N is cpuidle stateN, states from 32 up are
+# not reported)
+CORE_FMT = struct.Struct("=IIIIIIII")
+CORE_ONLINE = 0x1
+
+# physical id, uncore freq, uncore min, uncore max, flags, pad,
+# power consumption (W), tdp (W)
+CPU_FMT = struct.Struct("=IIIIIIdd")
+CPU_SST_BF_CONFIGURED = 0x1
+
+UNKNOWN = 0xFFFFFFFF        # value not available
+
+CoreSample = collections.namedtuple("CoreSample", [
+    "core_id", "physical_id", "online", "curr_freq", "min_freq", "max_freq",
+    "epp", "cstates_disabled"])
+CPUSample = collections.namedtuple("CPUSample", [
+    "physical_id", "uncore_freq", "uncore_min_freq", "uncore_max_freq",
+    "sst_bf_configured", "power_consumption", "tdp"])
+Sample = collections.namedtuple("Sample", ["seq", "timestamp", "cores", "cpus"])
+
+
+def _u32(value):
+    """ Encode an optional integer value """
+    return UNKNOWN if value is None else int(value) & 0xFFFFFFFF
+
+
+def _epp_u32(epp):
+    """ Encode EPP as its numeric value """
+    if epp in pwr.EPP_VALUES:
+        return pwr.EPP_VALUES[epp]
+    try:
+        return int(epp)
+    except (TypeError, ValueError):
+        return UNKNOWN
+
+
+def _opt(value):
+    """ Decode an optional integer value """
+    return None if value == UNKNOWN else value
+
+
+class Publisher(object):
+    """
+    Writes pwr snapshots into the shared memory segment.
+    """
+
+    def __init__(self, path=DEFAULT_PATH):
+        """ Publisher object constructor """
+        self.path = path                    # shared memory file path
+        self._mm = None
+        self._core_ids = ()
+        self._cpu_ids = ()
+        self._seq = 0
+
+    def _create(self, core_ids, cpu_ids, data, timestamp):
+        """
+        (Re)create the segment for the given cores and CPUs, with data as
+        its first sample
+        """
+        cores_off = HEADER_FMT.size
+        cpus_off = cores_off + len(core_ids) * CORE_FMT.size
+        size = cpus_off + len(cpu_ids) * CPU_FMT.size
+
+        # build the new segment aside, with the records of its first sample,
+        # and rename it into place, so readers never see a partially
+        # initialized file. The directory is world writable, so the file is
+        # created exclusively under an unpredictable name.
+        fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(self.path) + ".",
+                                        dir=os.path.dirname(self.path))
+        try:
+            try:
+                os.fchmod(fd, 0o644)    # readers need not be root
+                os.ftruncate(fd, size)
+                new_mm = mmap.mmap(fd, size, mmap.MAP_SHARED,
+                                   mmap.PROT_READ | mmap.PROT_WRITE)
+            finally:
+                os.close(fd)
+            HEADER_FMT.pack_into(new_mm, 0, MAGIC, LAYOUT_VERSION, HEADER_FMT.size,
+                                 2, timestamp, 0, len(core_ids), len(cpu_ids),
+                                 CORE_FMT.size, CPU_FMT.size, cores_off, cpus_off)
+            new_mm[cores_off:cores_off + len(data)] = bytes(data)
+            os.rename(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        if self._mm is not None:
+            # tell readers of the old segment to re-open the file
+            self._set_flags(self._mm, FLAG_STALE)
+            self._mm.close()
+        self._mm = new_mm
+        self._core_ids = core_ids
+        self._cpu_ids = cpu_ids
+        self._seq = 2
+
+    @staticmethod
+    def _set_flags(mm, flags):
+        """ Update the header flags """
+        header = list(HEADER_FMT.unpack_from(mm, 0))
+        header[5] |= flags
+        HEADER_FMT.pack_into(mm, 0, *header)
+
+    def publish(self, snap=None):
+        """
+        Write a snapshot, the currently published one if not given,
+        into the segment
+        """
+        if snap is None:
+            snap = snapshot.current()
+        core_ids = tuple(sorted(snap.cores))
+        cpu_ids = tuple(sorted(snap.cpus))
+
+        data = bytearray()
+        for core_id in core_ids:
+            state = snap.cores[core_id]
+            disabled = 0
+            core = pwr.get_core(core_id)
+            for fname, name in core._states_name_map.items():
+                number = int(fname[len("state"):])
+                if number < 32 and state.cstates.get(name) is False:
+                    disabled |= 1 << number
+            data += CORE_FMT.pack(
+                core_id, _u32(state.physical_id),
+                CORE_ONLINE if state.online else 0,
+                _u32(state.curr_freq), _u32(state.min_freq),
+                _u32(state.max_freq), _epp_u32(state.epp), disabled)
+        for physical_id in cpu_ids:
+            state = snap.cpus[physical_id]
+            cpu = [c for c in pwr.get_cpus() if c.physical_id == physical_id][0]
+            data += CPU_FMT.pack(
+                physical_id, _u32(state.uncore_freq),
+                _u32(state.uncore_min_freq), _u32(state.uncore_max_freq),
+                CPU_SST_BF_CONFIGURED if state.sst_bf_configured else 0, 0,
+                state.power_consumption or 0.0, cpu.tdp or 0.0)
+
+        if core_ids != self._core_ids or cpu_ids != self._cpu_ids:
+            self._create(core_ids, cpu_ids, data, snap.timestamp)
+            return
+
+        mm = self._mm
+        # odd sequence number marks the sample as being written
+        self._seq += 1
+        SEQ_FMT.pack_into(mm, SEQ_OFFSET, self._seq)
+        struct.pack_into("=d", mm, SEQ_OFFSET + 8, snap.timestamp)
+        mm[HEADER_FMT.size:HEADER_FMT.size + len(data)] = bytes(data)
+        self._seq += 1
+        SEQ_FMT.pack_into(mm, SEQ_OFFSET, self._seq)
+
+    def run(self, interval, fields=None, count=None):
+        """
+        Refresh and publish a sample every interval seconds, forever or
+        count times
+        """
+        deadline = time.monotonic()
+        while count is None or count > 0:
+            self.publish(snapshot.refresh(fields))
+            if count is not None:
+                count -= 1
+            deadline += interval
+            time.sleep(max(0, deadline - time.monotonic()))
+
+    def close(self, unlink=True):
+        """ Unmap the segment, and remove the file """
+        if self._mm is None:
+            return
+        self._set_flags(self._mm, FLAG_STALE)
+        self._mm.close()
+        self._mm = None
+        if unlink:
+            os.unlink(self.path)
+
+
+class Reader(object):
+    """
+    Reads samples from the shared memory segment. Apart from opening the
+    segment, reads do not make any system calls.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, retries=1000):
+        """ Reader object constructor """
+        self.path = path                    # shared memory file path
+        self.retries = retries              # attempts before giving up
+        self._mm = None
+        self._index = {}
+        self._open()
+
+    def _open(self):
+        """ Map the segment and check its layout """
+        if self._mm is not None:
+            self._mm.close()
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            self._mm = mmap.mmap(fd, 0, mmap.MAP_SHARED, mmap.PROT_READ)
+        finally:
+            os.close(fd)
+        (magic, version, _, _, _, _, self._ncores, self._ncpus, core_size,
+         cpu_size, self._cores_off, self._cpus_off) = \
+            HEADER_FMT.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != LAYOUT_VERSION or \
+                core_size != CORE_FMT.size or cpu_size != CPU_FMT.size:
+            raise IOError("Unsupported telemetry segment layout in {}"
+                          .format(self.path))
+        self._index = {}
+        for slot in range(self._ncores):
+            core_id = CORE_FMT.unpack_from(
+                self._mm, self._cores_off + slot * CORE_FMT.size)[0]
+            self._index[core_id] = slot
+
+    def _stale(self):
+        """ Check whether the publisher has replaced the segment """
+        return HEADER_FMT.unpack_from(self._mm, 0)[5] & FLAG_STALE
+
+    def _read(self, func):
+        """ Run func on the mapping until it reads a consistent sample """
+        mm = self._mm
+        for _ in range(self.retries):
+            seq = SEQ_FMT.unpack_from(mm, SEQ_OFFSET)[0]
+            if seq & 1:
+                continue
+            result = func(mm)
+            if SEQ_FMT.unpack_from(mm, SEQ_OFFSET)[0] == seq:
+                return seq, result
+        raise IOError("Could not read a consistent telemetry sample")
+
+    def read(self):
+        """ Read a complete sample of all cores and CPUs """
+        if self._stale():
+            self._open()
+
+        def read_all(mm):
+            timestamp = struct.unpack_from("=d", mm, SEQ_OFFSET + 8)[0]
+            cores = [CORE_FMT.unpack_from(mm, self._cores_off + i * CORE_FMT.size)
+                     for i in range(self._ncores)]
+            cpus = [CPU_FMT.unpack_from(mm, self._cpus_off + i * CPU_FMT.size)
+                    for i in range(self._ncpus)]
+            return timestamp, cores, cpus
+
+        seq, (timestamp, cores, cpus) = self._read(read_all)
+        return Sample(seq=seq, timestamp=timestamp,
+                      cores=[_core_sample(r) for r in cores],
+                      cpus=[_cpu_sample(r) for r in cpus])
+
+    def core(self, core_id):
+        """ Read the sample of a single core """
+        if self._stale():
+            self._open()
+        offset = self._cores_off + self._index[core_id] * CORE_FMT.size
+        return _core_sample(self._read(
+            lambda mm: CORE_FMT.unpack_from(mm, offset))[1])
+
+    def close(self):
+        """ Unmap the segment """
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+
+
+def _core_sample(record):
+    """ Decode a core record """
+    (core_id, physical_id, flags, curr_freq, min_freq, max_freq, epp,
+     disabled) = record
+    return CoreSample(core_id=core_id, physical_id=_opt(physical_id),
+                      online=bool(flags & CORE_ONLINE),
+                      curr_freq=_opt(curr_freq), min_freq=_opt(min_freq),
+                      max_freq=_opt(max_freq), epp=_opt(epp),
+                      cstates_disabled=disabled)
+
+
+def _cpu_sample(record):
+    """ Decode a CPU record """
+    (physical_id, uncore_freq, uncore_min, uncore_max, flags, _,
+     power_consumption, tdp) = record
+    return CPUSample(physical_id=physical_id, uncore_freq=_opt(uncore_freq),
+                     uncore_min_freq=_opt(uncore_min),
+                     uncore_max_freq=_opt(uncore_max),
+                     sst_bf_configured=bool(flags & CPU_SST_BF_CONFIGURED),
+                     power_consumption=power_consumption, tdp=tdp)
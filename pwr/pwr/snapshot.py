@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright(c) 2019 Intel Corporation
+"""
+Immutable snapshots of pwr state for lock-free concurrent readers.
+
+Refreshes update the live objects under per-object locks and then publish a
+new snapshot by swapping a single reference, so readers always see a
+consistent view without taking any locks. Writers change a staged copy of a
+core's tunables and commit it under that core's lock.
+"""
+import collections
+import threading
+import time
+import types
+
+from . import pwr
+
+CoreState = collections.namedtuple("CoreState", [
+    "core_id",              # logical core id number
+    "physical_id",          # physical package of the core
+    "online",               # core availability flag
+    "thread_siblings",      # tuple of sibling core ids
+    "curr_freq",            # current core frequency
+    "min_freq",             # desired low frequency
+    "max_freq",             # desired high frequency
+    "epp",                  # energy performance preference
+    "cstates",              # read-only dict of C-states
+    "resume_latency",       # PM QoS resume latency limit in us
+])
+
+CPUState = collections.namedtuple("CPUState", [
+    "cpu_id",               # CPU id number
+    "physical_id",          # physical cpu number
+    "core_ids",             # tuple of core ids on this CPU
+    "sst_bf_configured",    # cpu cores set to sst_bf config
+    "uncore_freq",          # current uncore frequency
+    "uncore_min_freq",      # min desired uncore frequency
+    "uncore_max_freq",      # max desired uncore frequency
+    "power_consumption",    # power consumption since last update
+])
+
+Snapshot = collections.namedtuple("Snapshot", [
+    "version",              # incremented on every publish
+    "timestamp",            # time of publish
+    "cores",                # read-only dict of core id to CoreState
+    "cpus",                 # read-only dict of physical id to CPUState
+    "sst_bf_configured",    # all cores set to sst_bf config
+])
+
+# Attributes of a core which can be staged and committed
+TUNABLES = ("min_freq", "max_freq", "epp", "cstates", "resume_latency")
+
+_CURRENT = None
+_PUBLISH_LOCK = threading.Lock()
+
+
+def _core_state(core):
+    """ Build an immutable state of a core, under the core lock """
+    with core._lock:
+        return CoreState(
+            core_id=core.core_id,
+            physical_id=core.cpu.physical_id,
+            online=core.online,
+            thread_siblings=tuple(c.core_id for c in core.thread_siblings or []),
+            curr_freq=core.curr_freq,
+            min_freq=core.min_freq,
+            max_freq=core.max_freq,
+            epp=core.epp,
+            cstates=types.MappingProxyType(dict(core.cstates or {})),
+            resume_latency=core.resume_latency)
+
+
+def _cpu_state(cpu):
+    """ Build an immutable state of a CPU, under the CPU lock """
+    with cpu._lock:
+        return CPUState(
+            cpu_id=cpu.cpu_id,
+            physical_id=cpu.physical_id,
+            core_ids=tuple(c.core_id for c in cpu.core_list),
+            sst_bf_configured=cpu.sst_bf_configured,
+            uncore_freq=cpu.uncore_freq,
+            uncore_min_freq=cpu.uncore_min_freq,
+            uncore_max_freq=cpu.uncore_max_freq,
+            power_consumption=cpu.power_consumption)
+
+
+def _swap(cores, cpus, sst_bf_configured):
+    """ Publish a new snapshot, must be called with the publish lock held """
+    global _CURRENT
+    version = _CURRENT.version + 1 if _CURRENT else 1
+    _CURRENT = Snapshot(version=version,
+                        timestamp=time.time(),
+                        cores=types.MappingProxyType(cores),
+                        cpus=types.MappingProxyType(cpus),
+                        sst_bf_configured=sst_bf_configured)
+    return _CURRENT
+
+
+def publish():
+    """ Publish a snapshot of the current state of the live objects """
+    system, cpus, cores = pwr.get_objects()
+    with _PUBLISH_LOCK:
+        return _swap({c.core_id: _core_state(c) for c in cores},
+                     {c.physical_id: _cpu_state(c) for c in cpus},
+                     system.sst_bf_configured)
+
+
+def _publish_cores(cores):
+    """ Publish a snapshot with only the given cores replaced """
+    with _PUBLISH_LOCK:
+        if _CURRENT is None:
+            system, cpus, all_cores = pwr.get_objects()
+            return _swap({c.core_id: _core_state(c) for c in all_cores},
+                         {c.physical_id: _cpu_state(c) for c in cpus},
+                         system.sst_bf_configured)
+        new_cores = dict(_CURRENT.cores)
+        for core in cores:
+            new_cores[core.core_id] = _core_state(core)
+        return _swap(new_cores, dict(_CURRENT.cpus),
+                     _CURRENT.sst_bf_configured)
+
+
+def current():
+    """
+    Get the most recently published snapshot. This never blocks on writers,
+    a snapshot is published from the live objects on first use.
+    """
+    snap = _CURRENT
+    if snap is None:
+        snap = publish()
+    return snap
+
+
+def _refresh(fields):
+    """ Refresh the named stats of the live objects under their locks """
+    _, cpus, cores = pwr.get_objects()
+    if fields is None:
+        fields = pwr.CORE_STATS + pwr.CPU_STATS
+    core_fields = [f for f in fields if f in pwr.CORE_STATS]
+    cpu_fields = [f for f in fields if f in pwr.CPU_STATS]
+    unknown = set(fields) - set(core_fields) - set(cpu_fields)
+    if unknown:
+        raise ValueError("Cannot refresh unknown stats {}"
+                         .format(sorted(unknown)))
+
+    if core_fields:
+        for core in cores:
+            with core._lock:
+                core.refresh_stats(core_fields)
+    if cpu_fields:
+        for cpu in cpus:
+            with cpu._lock:
+                cpu.refresh_stats(fields=cpu_fields)
+
+
+def refresh(fields=None):
+    """
+    Refresh the named core and CPU stats of the live objects, all stats if
+    fields is None, then publish a new snapshot
+    """
+    _refresh(fields)
+    return publish()
+
+
+def refresh_all():
+    """ Refresh all system, cpu and core stats, then publish a snapshot """
+    system, _, _ = pwr.get_objects()
+    _refresh(None)
+    system.refresh_stats()
+    return publish()
+
+
+class StagedCore(object):
+    """
+    Staged copy of the tunable attributes of a core. Changes made to it are
+    only visible to other threads once committed.
+    """
+
+    def __init__(self, core):
+        """ StagedCore object constructor """
+        self.core = core
+        with core._lock:
+            for attr in TUNABLES:
+                value = getattr(core, attr)
+                if isinstance(value, dict):
+                    value = dict(value)
+                setattr(self, attr, value)
+
+    def _commit(self, profile):
+        """ Write the staged values to the core under its lock """
+        core = self.core
+        with core._lock:
+            saved = {attr: getattr(core, attr) for attr in TUNABLES}
+            for attr in TUNABLES:
+                setattr(core, attr, getattr(self, attr))
+            try:
+                core.commit(profile)
+            except Exception:
+                # some values may have been written before the failure, so
+                # read back what the core actually has
+                try:
+                    core.refresh_stats(TUNABLES)
+                except (IOError, OSError, ValueError):
+                    for attr, value in saved.items():
+                        setattr(core, attr, value)
+                raise
+            core.refresh_stats(TUNABLES)
+
+    def commit(self, profile=""):
+        """
+        Write the staged values to the core under its lock and publish the
+        result. If the commit fails, the core attributes are read back from
+        sysfs, or restored to their previous values if that fails too.
+        """
+        self._commit(profile)
+        return _publish_cores([self.core])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+
+
+def stage(core):
+    """ Get a staged copy of a core, which can be used as a context manager """
+    return StagedCore(core)
+
+
+def commit_all(staged, profile=""):
+    """
+    Commit several staged cores and publish a single snapshot. Cores which
+    fail to commit are read back as in StagedCore.commit(), the errors are
+    returned as a dict of core id to exception.
+    """
+    errors = {}
+    for st in staged:
+        try:
+            st._commit(profile)
+        except (IOError, OSError, ValueError) as err:
+            errors[st.core.core_id] = err
+    _publish_cores([st.core for st in staged])
+    return errors
@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright(c) 2019 Intel Corporation
+"""
+Intel SST control through the OS mailbox.
+
+SST-CP (core power) assigns each core to one of four classes of service
+(CLOS), each with a minimum and maximum frequency and a priority. Once core
+power prioritization is enabled on a package, its power budget goes to the
+cores of the higher priority classes first. CLOS settings and core
+associations are planned as mailbox writes, so any number of them are
+diffed and applied in one batch.
+
+SST-TF (turbo frequency) lets a few high priority cores turbo above the
+all-core limit while the others are clipped. The high priority cores are
+those of the highest priority CLOS, and the firmware reports in buckets how
+many of them may turbo to which frequency.
+
+SST-PP (performance profiles) offers several configuration levels, each
+with its own set of enabled cores, base and turbo frequencies, uncore
+frequencies and TDP. Switching level re-reads the frequency capabilities of
+the affected packages and cores.
+"""
+import collections
+
+from . import mailbox
+from . import plan
+from . import pwr
+
+CLOS_COUNT = 4
+PRIORITY_TYPES = ("proportional", "ordered")
+
+ClosConfig = collections.namedtuple("ClosConfig", [
+    "min_freq",         # minimum frequency in MHz
+    "max_freq",         # maximum frequency in MHz
+    "priority",         # proportional priority, 0 (highest) to 15 (lowest)
+])
+
+CpConfig = collections.namedtuple("CpConfig", [
+    "enabled",          # core power prioritization enabled
+    "priority_type",    # "proportional" or "ordered" throttling
+])
+
+TurboFreqCaps = collections.namedtuple("TurboFreqCaps", [
+    "level",            # current SST-PP level
+    "supported",        # SST-TF supported at the level
+    "enabled",          # SST-TF enabled
+    "bucket_cores",     # high priority core count of each bucket
+    "bucket_freqs",     # turbo frequency of each bucket in MHz
+    "lp_clip_freqs",    # low priority core frequency, SSE, AVX2 and AVX3
+])
+
+
+def _check_clos(clos):
+    """ Validate a CLOS number """
+    if isinstance(clos, bool) or not isinstance(clos, int) or \
+            not 0 <= clos < CLOS_COUNT:
+        raise ValueError("Invalid CLOS {}, must be in range 0 to {}"
+                         .format(clos, CLOS_COUNT - 1))
+
+
+def _clos_freq(freq):
+    """ Convert a CLOS frequency in MHz to a ratio """
+    if isinstance(freq, bool) or not isinstance(freq, int) or \
+            freq % 100 or not 0 <= freq <= 25500:
+        raise ValueError("Invalid CLOS frequency {}, must be a multiple of 100 "
+                         "in range 0 to 25500".format(freq))
+    return freq // 100
+
+
+def _raise_first(results):
+    """ Raise the first error of a mailbox batch """
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+    return results
+
+
+def get_clos_configs(cpu):
+    """ Get the ClosConfig of each CLOS of a package """
+    mbox = mailbox.get_mailbox(cpu)
+    results = _raise_first(mbox.commands(
+        [(mailbox.CLOS, mailbox.CLOS_PM_CLOS, clos, 0) for clos in range(CLOS_COUNT)]))
+    return [ClosConfig(min_freq=(data >> 8 & 0xFF) * 100,
+                       max_freq=(data >> 16 & 0xFF) * 100,
+                       priority=data >> 4 & 0xF) for data in results]
+
+
+def get_cp_config(cpu):
+    """ Get the core power prioritization state of a package """
+    data = mailbox.get_mailbox(cpu).command(mailbox.CLOS, mailbox.CLOS_PM_QOS_CONFIG)
+    return CpConfig(enabled=bool(data >> 1 & 1),
+                    priority_type=PRIORITY_TYPES[data >> 2 & 1])
+
+
+def get_clos_assoc(cores):
+    """
+    Get the CLOS of the given cores, as a dict of core id to CLOS. Offline
+    cores are left out. The commands of all packages are batched.
+    """
+    cores = [c for c in cores if c.online]
+    punit = mailbox.punit_cores(cores)
+    results = _raise_first(mailbox.run([
+        (mailbox.get_mailbox(core.cpu), mailbox.CLOS, mailbox.CLOS_PQR_ASSOC,
+         punit[core.core_id], 0) for core in cores]))
+    return {core.core_id: data >> 16 & 0x3 for core, data in zip(cores, results)}
+
+
+def plan_clos_config(cpu, clos, min_freq=None, max_freq=None, priority=None,
+                     write_plan=None):
+    """
+    Add the writes of a CLOS configuration of a package to a write plan.
+    Settings which are None are left unchanged.
+    """
+    if write_plan is None:
+        write_plan = plan.WritePlan()
+    _check_clos(clos)
+    if min_freq is not None and max_freq is not None and min_freq > max_freq:
+        raise ValueError("Invalid config for CLOS {}, min freq({}) is greater "
+                         "than max freq({})".format(clos, min_freq, max_freq))
+    if priority is not None and (isinstance(priority, bool) or
+                                 not isinstance(priority, int) or
+                                 not 0 <= priority <= 15):
+        raise ValueError("Invalid CLOS priority {}, must be in range 0 to 15"
+                         .format(priority))
+    target = plan.mailbox_target(cpu, mailbox.CLOS, mailbox.CLOS_PM_CLOS, clos)
+    if priority is not None:
+        write_plan.add(target, (priority << 4, 0xF0))
+    if min_freq is not None:
+        write_plan.add(target, (_clos_freq(min_freq) << 8, 0xFF00))
+    if max_freq is not None:
+        write_plan.add(target, (_clos_freq(max_freq) << 16, 0xFF0000))
+    return write_plan
+
+
+def plan_cp(cpu, enabled=True, priority_type=None, write_plan=None):
+    """
+    Add the writes enabling or disabling core power prioritization on a
+    package to a write plan. Settings which are None are left unchanged.
+    """
+    if write_plan is None:
+        write_plan = plan.WritePlan()
+    target = plan.mailbox_target(cpu, mailbox.CLOS, mailbox.CLOS_PM_QOS_CONFIG)
+    if priority_type is not None:
+        if priority_type not in PRIORITY_TYPES:
+            raise ValueError("Invalid CLOS priority type {}, available types are {}"
+                             .format(priority_type, list(PRIORITY_TYPES)))
+        write_plan.add(target, (PRIORITY_TYPES.index(priority_type) << 2, 0x4))
+    if enabled is not None:
+        write_plan.add(target, (int(bool(enabled)) << 1, 0x2))
+    return write_plan
+
+
+def plan_clos_assoc(cores, clos, write_plan=None):
+    """
+    Add the writes associating cores with a CLOS to a write plan. Offline
+    cores are skipped. The CLOS is set per physical core, so hyperthread
+    siblings follow the last association planned for either of them.
+    """
+    if write_plan is None:
+        write_plan = plan.WritePlan()
+    _check_clos(clos)
+    cores = [c for c in cores if c.online]
+    punit = mailbox.punit_cores(cores)
+    for core in cores:
+        write_plan.add(plan.mailbox_target(core.cpu, mailbox.CLOS, mailbox.CLOS_PQR_ASSOC,
+                                           punit[core.core_id]),
+                       (clos << 16, 0x30000))
+    return write_plan
+
+
+def set_clos_config(cpu, clos, min_freq=None, max_freq=None, priority=None):
+    """
+    Configure a CLOS of a package, writing only if it changes. Returns a
+    dict of write target to exception.
+    """
+    return plan_clos_config(cpu, clos, min_freq, max_freq, priority).diff().apply()
+
+
+def set_cp(cpu, enabled=True, priority_type=None):
+    """
+    Enable or disable core power prioritization on a package. Returns a
+    dict of write target to exception.
+    """
+    return plan_cp(cpu, enabled, priority_type).diff().apply()
+
+
+def set_clos_assoc(cores, clos):
+    """
+    Associate cores with a CLOS, in one batch for all packages. Returns a
+    dict of write target to exception.
+    """
+    return plan_clos_assoc(cores, clos).diff().apply()
+
+
+def plan_package(cpu, settings, write_plan=None):
+    """
+    Add the SST settings of a package profile rule to a write plan: "clos",
+    a dict of CLOS number to min_freq, max_freq and priority, "core_power",
+    and "clos_priority_type"
+    """
+    if write_plan is None:
+        write_plan = plan.WritePlan()
+    for clos, config in sorted((settings.get("clos") or {}).items(),
+                               key=lambda item: str(item[0])):
+        unknown = set(config) - set(ClosConfig._fields)
+        if unknown:
+            raise ValueError("Unknown CLOS settings {}, available settings are {}"
+                             .format(sorted(unknown), list(ClosConfig._fields)))
+        try:
+            clos = int(clos)
+        except ValueError:
+            raise ValueError("Invalid CLOS {}".format(clos))
+        plan_clos_config(cpu, clos, write_plan=write_plan, **config)
+    plan_cp(cpu, settings.get("core_power"), settings.get("clos_priority_type"),
+            write_plan)
+    return write_plan
+
+
+def turbo_freq_caps(cpus=None):
+    """
+    Get the SST-TF capabilities of the current SST-PP level of the given
+    packages, all by default, as a dict of package id to TurboFreqCaps.
+    The commands of all packages are batched.
+    """
+    caps = {}
+    for package_id, (info, levels) in mailbox.discover(cpus).items():
+        level = levels.get(info.current_level)
+        fact = level and level.fact_info
+        control = level and level.control
+        caps[package_id] = TurboFreqCaps(
+            level=info.current_level,
+            supported=bool(control and control.fact_support and fact),
+            enabled=bool(control and control.fact_enabled),
+            bucket_cores=fact.bucket_cores if fact else (),
+            bucket_freqs=fact.bucket_freqs if fact else (),
+            lp_clip_freqs=fact.lp_clip_freqs if fact else ())
+    return caps
+
+
+def turbo_freq(caps, count):
+    """
+    Get the turbo frequency of count high priority physical cores, None if
+    more cores than the largest bucket
+    """
+    for cores, freq in sorted(zip(caps.bucket_cores, caps.bucket_freqs)):
+        if count <= cores:
+            return freq
+    return None
+
+
+def plan_turbo_freq(cores, hp_clos=0, lp_clos=3, write_plan=None):
+    """
+    Add the CLOS writes making the given cores the SST-TF high priority
+    cores of their packages to a write plan: they are associated with
+    hp_clos, the other online cores of their packages with lp_clos, and
+    ordered core power prioritization is enabled. Raises ValueError if a
+    package does not support SST-TF or gets more high priority physical
+    cores than its largest bucket. Returns the write plan and a dict of
+    package id to the turbo frequency of its high priority cores.
+    """
+    if write_plan is None:
+        write_plan = plan.WritePlan()
+    _check_clos(hp_clos)
+    _check_clos(lp_clos)
+    if hp_clos >= lp_clos:
+        raise ValueError("High priority CLOS {} must be lower than low priority "
+                         "CLOS {}".format(hp_clos, lp_clos))
+    hp_ids = set(c.core_id for c in cores if c.online)
+    packages = {}
+    for core in cores:
+        if core.online:
+            packages[core.cpu.physical_id] = core.cpu
+    caps = turbo_freq_caps(list(packages.values()))
+
+    freqs = {}
+    for package_id, cpu in sorted(packages.items()):
+        package_cores = [c for c in cpu.core_list if c.online]
+        hp_cores = [c for c in package_cores if c.core_id in hp_ids]
+        if not caps[package_id].supported:
+            raise ValueError("Cannot set high priority cores, SST-TF is not "
+                             "supported on package {}".format(package_id))
+        # buckets count physical cores, hyperthread siblings share a CLOS
+        count = len(set(mailbox.punit_cores(hp_cores).values()))
+        freqs[package_id] = turbo_freq(caps[package_id], count)
+        if freqs[package_id] is None:
+            raise ValueError("Cannot set {} high priority cores on package {}, "
+                             "SST-TF allows at most {}".format(
+                                 count, package_id, max(caps[package_id].bucket_cores)))
+        plan_clos_assoc([c for c in package_cores if c.core_id not in hp_ids],
+                        lp_clos, write_plan)
+        plan_clos_assoc(hp_cores, hp_clos, write_plan)
+        plan_cp(cpu, True, "ordered", write_plan)
+    return write_plan, freqs
+
+
+def set_turbo_freq(cores, hp_clos=0, lp_clos=3):
+    """
+    Make the given cores the SST-TF high priority cores of their packages
+    and enable SST-TF. Returns a dict of package id to the turbo frequency
+    of its high priority cores.
+    """
+    write_plan, freqs = plan_turbo_freq(cores, hp_clos, lp_clos)
+    for target, err in write_plan.diff().apply().items():
+        raise IOError("{}\nCould not write {}".format(err, target))
+    for cpu in set(c.cpu for c in cores if c.online):
+        mailbox.get_mailbox(cpu).set_tdp_control(fact_enabled=True)
+    return freqs
+
+
+def disable_turbo_freq(cpus=None):
+    """ Disable SST-TF on the given packages, all by default """
+    for cpu in cpus or pwr.get_cpus():
+        mailbox.get_mailbox(cpu).set_tdp_control(fact_enabled=False)
+
+
+def perf_levels(cpus=None):
+    """
+    Get the SST-PP levels of the given packages, all by default, as a dict
+    of package id to a tuple of the mailbox.LevelsInfo and a dict of level
+    number to mailbox.Level. The commands of all packages are batched.
+    """
+    return mailbox.discover(cpus)
+
+
+def level_cores(cpu, level):
+    """
+    Get the ids of the online cores of a package which are enabled at an
+    SST-PP level
+    """
+    mask = mailbox.get_mailbox(cpu).get_core_mask(level)
+    online = [c for c in cpu.core_list if c.online]
+    punit = mailbox.punit_cores(online)
+    return [c.core_id for c in online if mask >> punit[c.core_id] & 1]
+
+
+def _refresh_capabilities(cpus):
+    """
+    Re-read the frequency capabilities of the given packages and of their
+    cores after an SST-PP level switch, and the SST-BF state
+    """
+    cores = [c for cpu in cpus for c in cpu.core_list if c.online]
+    for cpu in cpus:
+        with cpu._lock:
+            cpu._read_capabilities()
+    for core in cores:
+        with core._lock:
+            core.high_priority = False
+            core._read_capabilities()
+    # the SST-BF state depends on the core base frequencies just read, and
+    # the SST-BF tier of each core on that state
+    system = pwr.get_system()
+    system._read_capabilities()
+    for core in cores:
+        with core._lock:
+            core.high_priority = system.sst_bf_enabled and \
+                core.sst_bf_base_freq > core.base_freq
+    for cpu in cpus:
+        cpu._update_aggregates()
+
+
+def set_perf_level(level, cpus=None):
+    """
+    Select an SST-PP level on the given packages, all by default. Raises
+    ValueError if a package does not have the level or its level selection
+    is locked. Only the capabilities of switched packages and their cores
+    are re-read. Returns the ids of the packages which were switched. If
+    the switch fails on a package, the first error is raised with the ids
+    of the packages which were switched in its switched attribute.
+    """
+    if cpus is None:
+        cpus = pwr.get_cpus()
+    levels = perf_levels(cpus)
+    switch = []
+    for cpu in cpus:
+        info, package_levels = levels[cpu.physical_id]
+        if not info.enabled:
+            raise ValueError("Cannot select SST-PP level, SST-PP is not supported "
+                             "on package {}".format(cpu.physical_id))
+        if level not in package_levels:
+            raise ValueError("Invalid SST-PP level {} on package {}, available "
+                             "levels are {}".format(level, cpu.physical_id,
+                                                    sorted(package_levels)))
+        if level == info.current_level:
+            continue
+        if info.locked:
+            raise ValueError("Cannot select SST-PP level {}, level selection is "
+                             "locked on package {}".format(level, cpu.physical_id))
+        switch.append(cpu)
+
+    results = mailbox.run([(mailbox.get_mailbox(cpu), mailbox.CONFIG_TDP,
+                            mailbox.CONFIG_TDP_SET_LEVEL, 0, level) for cpu in switch])
+    switched = [cpu for cpu, result in zip(switch, results)
+                if not isinstance(result, Exception)]
+    if switched:
+        _refresh_capabilities(switched)
+    switched_ids = [cpu.physical_id for cpu in switched]
+    for result in results:
+        if isinstance(result, Exception):
+            result.switched = switched_ids
+            raise result
+    return switched_ids
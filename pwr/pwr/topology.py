@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright(c) 2019 Intel Corporation
+"""
+CPU hotplug aware topology updates for the pwr library.
+"""
+import bisect
+import os
+import select
+import socket
+import threading
+
+from . import pwr
+
+ONLINE_FILE = os.path.join(pwr.BASE_PATH, "online")
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_GROUP_KERNEL = 1
+
+
+class TopologyWatcher(object):
+    """
+    Watches cpu online state and updates only the affected Core and CPU
+    objects in place, without re-initializing the library.
+    """
+
+    def __init__(self, callback=None, interval=1.0, use_netlink=True):
+        """ TopologyWatcher object constructor """
+        self.callback = callback            # called with (onlined, offlined)
+        self.interval = interval            # polling period in seconds
+        self.use_netlink = use_netlink      # wake up on kernel uevents
+
+        self._online_str = None
+        self._thread = None
+        self._sock = None
+        self._stop = threading.Event()
+
+        pwr.get_cores()
+        self._online = set(c.core_id for c in pwr.CORES if c.online)
+
+    def poll(self):
+        """
+        Check cpu online state and apply any changes. Only a single sysfs
+        file is read unless the online cpu list has changed.
+        Returns a tuple of (onlined, offlined) Core object lists.
+        """
+        online_str = pwr._read_sysfs(ONLINE_FILE)
+        if online_str == self._online_str:
+            return [], []
+        self._online_str = online_str
+
+        online = set(pwr._parse_cpulist(online_str))
+        onlined = [_core_online(c) for c in sorted(online - self._online)]
+        offlined = [_core_offline(c) for c in sorted(self._online - online)]
+        onlined = [c for c in onlined if c is not None]
+        offlined = [c for c in offlined if c is not None]
+        self._online = online
+
+        if self.callback and (onlined or offlined):
+            self.callback(onlined, offlined)
+        return onlined, offlined
+
+    def start(self):
+        """ Start watching for changes in a background thread """
+        if self._thread:
+            return
+        self._stop.clear()
+        if self.use_netlink:
+            self._sock = _open_uevent_socket()
+        self._thread = threading.Thread(target=self._run,
+                                        name="pwr-topology")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Stop the background thread """
+        if not self._thread:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def _run(self):
+        """ Wait for a uevent or the polling period, then check for changes """
+        while not self._stop.is_set():
+            if self._sock is not None:
+                readable = select.select([self._sock], [], [], self.interval)[0]
+                if readable:
+                    _drain_uevents(self._sock)
+            else:
+                self._stop.wait(self.interval)
+            if not self._stop.is_set():
+                self.poll()
+
+
+def _open_uevent_socket():
+    """ Open the kernel uevent netlink socket, None if it is not available """
+    try:
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM,
+                             NETLINK_KOBJECT_UEVENT)
+    except (AttributeError, socket.error):
+        return None
+    try:
+        sock.bind((0, UEVENT_GROUP_KERNEL))
+        sock.setblocking(False)
+    except socket.error:
+        sock.close()
+        return None
+    return sock
+
+
+def _drain_uevents(sock):
+    """
+    Discard pending uevents, the online cpu list is re-read anyway so the
+    messages only serve as a wakeup
+    """
+    while True:
+        try:
+            sock.recv(8192)
+        except socket.error:
+            return
+
+
+def _insert_sorted(core_list, core):
+    """ Insert core into a list of cores ordered by core id """
+    ids = [c.core_id for c in core_list]
+    core_list.insert(bisect.bisect(ids, core.core_id), core)
+
+
+def _attach_core(core, physical_id):
+    """ Attach core to the CPU object of its physical package """
+    cpu = pwr._get_cpu_obj(physical_id)
+    core.cpu = cpu
+    _insert_sorted(cpu.core_list, core)
+    if cpu.base_freq is None:
+        # package seen for the first time
+        cpu._read_capabilities(core.core_id)
+
+
+def _core_online(core_id):
+    """ Update library state for a core which came online """
+    online, physical_id, siblings = pwr._read_core_topology(core_id)
+    if not online:
+        # went offline again before we got to it
+        return None
+
+    core = pwr._CORES_BY_ID.get(core_id)
+    if core is None:
+        # cpu was hot-added
+        core = pwr.Core(core_id, None)
+        _attach_core(core, physical_id)
+        _insert_sorted(pwr.CORES, core)
+        pwr._CORES_BY_ID[core_id] = core
+    elif core.cpu.physical_id != physical_id:
+        # core was offline at init, so its package was not known
+        old_cpu = core.cpu
+        old_cpu.core_list.remove(core)
+        old_cpu._update_aggregates()
+        _attach_core(core, physical_id)
+
+    core.online = True
+    core._probe_sysfs()
+    if core.core_type is None:
+        core.core_type = pwr._read_core_types([core_id]).get(core_id)
+        if core.core_type and core.core_type not in core.cpu.core_types:
+            core.cpu._read_core_type_capabilities()
+    core._read_capabilities()
+    core.refresh_stats()
+
+    # siblings lists are replaced rather than modified for the sake of readers
+    core.thread_siblings = [pwr._CORES_BY_ID[s] for s in siblings
+                            if s in pwr._CORES_BY_ID]
+    for sibling in core.thread_siblings:
+        if core not in sibling.thread_siblings:
+            sibling.thread_siblings = sibling.thread_siblings + [core]
+
+    core.cpu._update_aggregates()
+    return core
+
+
+def _core_offline(core_id):
+    """ Update library state for a core which went offline """
+    core = pwr._CORES_BY_ID.get(core_id)
+    if core is None:
+        return None
+
+    core.online = False
+    for sibling in core.thread_siblings or []:
+        sibling.thread_siblings = [c for c in sibling.thread_siblings
+                                   if c is not core]
+    core.thread_siblings = []
+
+    core.cpu._update_aggregates()
+    return core
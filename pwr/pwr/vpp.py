@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright(c) 2019 Intel Corporation
+"""
+VPP stats segment reader for per-worker CPU utilization.
+
+The VPP patches in ipm/patches/vpp add per-worker counters to the stats
+segment, with the worker cpu id in the upper bits of each value:
+    /sys/cpu_util_per_worker        utilization in percent
+    /sys/queue_burst_per_worker     queue burst flag
+    /sys/capacity_per_worker        utilization scaled by frequency over P1
+The segment is mapped read-only and read in place, using the same optimistic
+locking as VPP's own clients: a read is retried if the segment epoch changed
+or an update was in progress while reading.
+"""
+import array
+import collections
+import mmap
+import os
+import socket
+import stat
+import struct
+import time
+
+DEFAULT_SOCKET = "/run/vpp/stats.sock"
+CPU_UTIL = "/sys/cpu_util_per_worker"
+QUEUE_BURST = "/sys/queue_burst_per_worker"
+CAPACITY = "/sys/capacity_per_worker"
+
+# version, base, epoch, in_progress, directory vector
+HEADER_FMT = struct.Struct("=QQQQQ")
+# type, index/value/data pointer union, name
+ENTRY_FMT = struct.Struct("@IQ128s")
+STAT_DIR_TYPE_COUNTER_VECTOR_SIMPLE = 2
+U64 = struct.Struct("=Q")
+VEC_LEN = struct.Struct("=I")   # vector length, 8 bytes before vector data
+
+WorkerStats = collections.namedtuple("WorkerStats", [
+    "thread", "cpu_id", "cpu_util", "queue_burst", "capacity"])
+
+
+class StatsSegment(object):
+    """
+    Read-only mapping of the VPP stats segment. The path is the VPP stats
+    socket, which passes the segment file descriptor, or a segment file.
+    """
+
+    def __init__(self, path=DEFAULT_SOCKET, retries=1000):
+        """ StatsSegment object constructor """
+        self.path = path                    # stats socket or segment file
+        self.retries = retries              # attempts before giving up
+        fd = _open_segment(path)
+        try:
+            self._mm = mmap.mmap(fd, 0, mmap.MAP_SHARED, mmap.PROT_READ)
+        finally:
+            os.close(fd)
+        self._epoch = None
+        self._index = {}
+
+    def close(self):
+        """ Unmap the segment """
+        self._mm.close()
+
+    def _header(self):
+        """ Get the segment header fields """
+        return HEADER_FMT.unpack_from(self._mm, 0)
+
+    def _offset(self, base, ptr):
+        """ Convert a pointer in the VPP address space to a segment offset """
+        offset = ptr - base
+        if ptr == 0 or not 0 <= offset < len(self._mm):
+            raise ValueError("Stats segment pointer 0x{:x} out of range".format(ptr))
+        return offset
+
+    def _vector(self, base, ptr, fmt):
+        """ Get the offset and length of a vector, and check it is mapped """
+        offset = self._offset(base, ptr)
+        length = VEC_LEN.unpack_from(self._mm, offset - 8)[0]
+        if offset + length * fmt.size > len(self._mm):
+            raise ValueError("Stats segment vector at 0x{:x} out of range".format(ptr))
+        return offset, length
+
+    def _read_directory(self, base, dir_ptr):
+        """ Build the index of entry names """
+        index = {}
+        offset, length = self._vector(base, dir_ptr, ENTRY_FMT)
+        for i in range(length):
+            name = ENTRY_FMT.unpack_from(self._mm, offset + i * ENTRY_FMT.size)[2]
+            name = name.split(b"\0", 1)[0].decode()
+            if name:
+                index[name] = i
+        return index
+
+    def _read_counters(self, base, dir_ptr, name):
+        """ Read a simple counter vector, as a list of per-thread lists """
+        i = self._index.get(name)
+        if i is None:
+            return None
+        offset, _ = self._vector(base, dir_ptr, ENTRY_FMT)
+        entry_type, data, _ = ENTRY_FMT.unpack_from(
+            self._mm, offset + i * ENTRY_FMT.size)
+        if entry_type != STAT_DIR_TYPE_COUNTER_VECTOR_SIMPLE:
+            raise ValueError("Stats entry {} is not a simple counter vector"
+                             .format(name))
+        threads_off, nthreads = self._vector(base, data, U64)
+        counters = []
+        for thread in range(nthreads):
+            ptr = U64.unpack_from(self._mm, threads_off + thread * 8)[0]
+            values_off, nvalues = self._vector(base, ptr, U64)
+            counters.append(list(struct.unpack_from(
+                "={}Q".format(nvalues), self._mm, values_off)))
+        return counters
+
+    def read(self, names):
+        """
+        Read simple counter vectors in one consistent pass. Returns a dict
+        of name to per-thread lists of values, None for missing entries.
+        """
+        for _ in range(self.retries):
+            _, base, epoch, in_progress, dir_ptr = self._header()
+            if in_progress:
+                time.sleep(0)
+                continue
+            try:
+                if epoch != self._epoch:
+                    # entries were added or removed, the directory may have moved
+                    self._index = self._read_directory(base, dir_ptr)
+                    self._epoch = epoch
+                result = {name: self._read_counters(base, dir_ptr, name)
+                          for name in names}
+            except (ValueError, struct.error):
+                # read a vector while it was being reallocated, try again
+                self._epoch = None
+                continue
+            _, _, new_epoch, in_progress, _ = self._header()
+            if new_epoch == epoch and not in_progress:
+                return result
+        raise IOError("Could not read a consistent VPP stats sample from {}"
+                      .format(self.path))
+
+    def workers(self):
+        """
+        Read utilization, queue burst flag and capacity of each VPP thread.
+        Values missing from the segment are None.
+        """
+        counters = self.read([CPU_UTIL, QUEUE_BURST, CAPACITY])
+        util = counters[CPU_UTIL] or []
+        burst = counters[QUEUE_BURST] or []
+        capacity = counters[CAPACITY] or []
+        workers = []
+        for thread, values in enumerate(util):
+            if not values:
+                continue
+            workers.append(WorkerStats(
+                thread=thread,
+                cpu_id=values[0] >> 8,
+                cpu_util=values[0] & 0xFF,
+                queue_burst=bool(burst[thread][0] & 0xFF)
+                if thread < len(burst) and burst[thread] else None,
+                capacity=capacity[thread][0] & 0xFF
+                if thread < len(capacity) and capacity[thread] else None))
+        return workers
+
+
+class VppSource(object):
+    """
+    Governor busyness source reading VPP worker utilization from the stats
+    segment. Workers with the queue burst flag set report 100, so their
+    cores step up before the utilization catches up.
+    """
+
+    def __init__(self, path=DEFAULT_SOCKET, metric="cpu_util", burst_boost=True):
+        """ VppSource object constructor """
+        if metric not in ("cpu_util", "capacity"):
+            raise ValueError("Invalid metric {}, available metrics are "
+                             "['cpu_util', 'capacity']".format(metric))
+        self.metric = metric                # cpu_util or capacity
+        self.burst_boost = burst_boost      # report busy on queue burst
+        self.segment = StatsSegment(path)   # mapped stats segment
+
+    def read(self, core_ids):
+        """ Get busyness of the given cores """
+        wanted = set(core_ids)
+        busyness = {}
+        for worker in self.segment.workers():
+            if worker.cpu_id not in wanted:
+                continue
+            value = getattr(worker, self.metric)
+            if value is None:
+                continue
+            if self.burst_boost and worker.queue_burst:
+                value = 100
+            busyness[worker.cpu_id] = max(value, busyness.get(worker.cpu_id, 0))
+        return busyness
+
+    def close(self):
+        """ Unmap the stats segment """
+        self.segment.close()
+
+
+def _open_segment(path):
+    """ Get a file descriptor of the stats segment """
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            return os.open(path, os.O_RDONLY)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        try:
+            sock.connect(path)
+            # VPP sends the segment memfd as SCM_RIGHTS ancillary data
+            fds = array.array("i")
+            _, ancdata, _, _ = sock.recvmsg(
+                1, socket.CMSG_LEN(fds.itemsize))
+        finally:
+            sock.close()
+    except (IOError, OSError) as err:
+        raise IOError("{}\nCould not open VPP stats segment {}".format(err, path))
+    for level, msg_type, data in ancdata:
+        if level == socket.SOL_SOCKET and msg_type == socket.SCM_RIGHTS:
+            fds.frombytes(data[:fds.itemsize])
+            return fds[0]
+    raise IOError("VPP stats socket {} did not send a segment".format(path))
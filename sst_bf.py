@@ -12,6 +12,9 @@ import struct
 import argparse
 import subprocess
 import textwrap
+import json
+import socket
+from multiprocessing.pool import ThreadPool
 
 # raw_input() is only available in python 2.
 try:
@@ -29,6 +32,10 @@ MSR_FILE = "/dev/cpu/0/msr"
 
 CPU_COUNT = 0
 ONLINE_CORES = []
+TOPOLOGY = {}
+SCAN_THREADS = 32
+CGROUP_ROOT = "/sys/fs/cgroup"
+TIERS = ("high", "normal")
 SCRIPT_VERSION = "1.3"
 
 # Read a 64-byte value from an MSR through the sysfs interface.
@@ -170,13 +177,95 @@ def get_sst_bf_frequency(core):
         base = FREQ_P1
     return base
 
+# Get the scaling governor
+def get_core_governor(core):
+    """ Get the scaling governor"""
+    governor_filename = "/sys/devices/system/cpu/cpu" + str(core) + "/cpufreq/scaling_governor"
+    try:
+        with open(governor_filename, 'r') as governor_file:
+            return governor_file.readline().strip("\n")
+    except IOError:
+        return None
+
+# Get the package and hyperthread siblings of a core
+def get_core_topology(core):
+    """ Get the package and siblings of a core"""
+    topology_dir = "/sys/devices/system/cpu/cpu" + str(core) + "/topology"
+    try:
+        with open(os.path.join(topology_dir, "physical_package_id")) as package_file:
+            package = int(package_file.readline())
+        with open(os.path.join(topology_dir, "thread_siblings_list")) as siblings_file:
+            siblings = parse_cpulist(siblings_file.readline().strip("\n"))
+    except (IOError, ValueError):
+        return (None, [core])
+    return (package, siblings)
+
+# Get the NUMA node of a core
+def get_core_node(core):
+    """ Get the NUMA node of a core"""
+    try:
+        entries = os.listdir("/sys/devices/system/cpu/cpu" + str(core))
+    except OSError:
+        return 0
+    for entry in entries:
+        if re.match(r'node[0-9]+$', entry):
+            return int(entry[len("node"):])
+    return 0
+
+def parse_cpulist(cpulist):
+    """Convert a cpulist such as 0-3,8 to a list of core ids."""
+    cores = []
+    for item in cpulist.split(","):
+        if "-" in item:
+            first, last = item.split("-")
+            cores.extend(range(int(first), int(last) + 1))
+        elif item:
+            cores.append(int(item))
+    return cores
+
+def __scan_core(core):
+    """Read everything the subcommands need to know about a core."""
+    if not __is_online(core):
+        return {"online": False}
+    package, siblings = get_core_topology(core)
+    return {
+        "online": True,
+        "package": package,
+        "siblings": siblings,
+        "node": get_core_node(core),
+        "base": get_sst_bf_frequency(core),
+        "cpu_max": get_cpu_max_frequency(core),
+        "cpu_min": get_cpu_min_frequency(core),
+        "max": get_scaling_max_frequency(core),
+        "min": get_scaling_min_frequency(core),
+        "governor": get_core_governor(core),
+    }
+
+def scan_topology():
+    """
+    Read the state of all cores in one pass, with the sysfs reads of
+    different cores done concurrently, and classify the online cores as
+    high or normal priority. Returns a dict of core to its state.
+    """
+    pool = ThreadPool(max(1, min(SCAN_THREADS, CPU_COUNT)))
+    try:
+        states = pool.map(__scan_core, range(CPU_COUNT))
+    finally:
+        pool.close()
+        pool.join()
+    topology = dict(enumerate(states))
+    for state in topology.values():
+        if state["online"]:
+            state["high_priority"] = state["base"] > FREQ_P1
+    return topology
+
 def get_issbf_cpu_freqs():
     """Get the SST-BF frequencies."""
 
     p1_high = 0
     p1_normal = 0
     for core in ONLINE_CORES:
-        base = get_sst_bf_frequency(core)
+        base = TOPOLOGY[core]["base"]
         if p1_high == 0:
             p1_high = base
         if p1_normal == 0:
@@ -246,22 +335,64 @@ def getcpu_count():
     return len(cpus)
 
 
+def plan_core_freqs(core, minimum, maximum, governor=None):
+    """
+    Get the writes setting the min/max frequency of a core in kHz, and its
+    governor, as a list of (setter, value) pairs. Values which are already
+    set are left out, and the limits are written in the order which keeps
+    min below max at each step.
+    """
+    state = TOPOLOGY[core]
+    writes = []
+    if governor is not None and state["governor"] != governor:
+        writes.append(("governor", governor))
+    limits = [("min", minimum), ("max", maximum)]
+    if minimum > state["max"]:
+        limits.reverse()
+    writes.extend(w for w in limits if state[w[0]] != w[1])
+    return writes
+
+def __apply_core(item):
+    """Perform the planned writes of a core, in order."""
+    core, writes = item
+    setters = {"governor": set_core_governor, "min": set_min_cpu_freq,
+               "max": set_max_cpu_freq}
+    for name, value in writes:
+        setters[name](value, core)
+    # cache what the kernel accepted rather than what was asked for
+    state = TOPOLOGY[core]
+    state["max"] = get_scaling_max_frequency(core)
+    state["min"] = get_scaling_min_frequency(core)
+    state["governor"] = get_core_governor(core)
+
+def apply_plan(plan):
+    """
+    Apply a dict of core to planned writes. Cores are written in parallel,
+    and the cached state is updated with the new values.
+    """
+    items = [(core, writes) for core, writes in sorted(plan.items()) if writes]
+    if not items:
+        return
+    pool = ThreadPool(max(1, min(SCAN_THREADS, len(items))))
+    try:
+        pool.map(__apply_core, items)
+    finally:
+        pool.close()
+        pool.join()
+
 def set_sst_bf(mode):
     """Enable SST_BF mode"""
 
     print("CPU Count = " + str(CPU_COUNT))
 
+    plan = {}
     for core in ONLINE_CORES:
-        set_core_governor("powersave", core)
-        set_max_cpu_freq(FREQ_P0*1000, core)
-        base = get_sst_bf_frequency(core)
-
         if mode == 0:
-            set_min_cpu_freq(base*1000, core)
-            set_max_cpu_freq(base*1000, core)
-        elif mode == 1:
-            set_min_cpu_freq(FREQ_P1*1000, core)
-            set_max_cpu_freq(FREQ_P1*1000, core)
+            freq = TOPOLOGY[core]["base"]*1000
+        else:
+            freq = FREQ_P1*1000
+        plan[core] = plan_core_freqs(core, freq, freq, "powersave")
+    apply_plan(plan)
 
     query_sst_bf()
 
@@ -271,18 +402,18 @@ def reverse_sst_bf():
 
     print("CPU Count = " + str(CPU_COUNT))
 
+    plan = {}
     for core in ONLINE_CORES:
-        maximum = get_cpu_max_frequency(core)
-        set_max_cpu_freq(maximum, core)
-        minimum = get_cpu_min_frequency(core)
-        set_min_cpu_freq(minimum, core)
+        plan[core] = plan_core_freqs(core, TOPOLOGY[core]["cpu_min"],
+                                     TOPOLOGY[core]["cpu_max"])
+    apply_plan(plan)
 
     query_sst_bf()
 
 def sst_bf_enabled():
     prev = None
     for core in ONLINE_CORES:
-        base = get_sst_bf_frequency(core)
+        base = TOPOLOGY[core]["base"]
         if not prev:
             prev = base
             continue
@@ -295,40 +426,40 @@ def query_sst_bf():
 
     print("CPUs = " + str(CPU_COUNT))
 
-    freq_p1 = get_cpu_base_frequency()
-    print("Base = " + str(freq_p1))
+    print("Base = " + str(FREQ_P1))
     p1_high = 0
 
     print("     |------sysfs-------|")
     print("Core | base   max   min |")
     print("-----|------------------|")
     for core in ONLINE_CORES:
-        base = get_sst_bf_frequency(core)
-        maximum = get_scaling_max_frequency(core)
-        minimum = get_scaling_min_frequency(core)
+        base = TOPOLOGY[core]["base"]
+        maximum = TOPOLOGY[core]["max"]
+        minimum = TOPOLOGY[core]["min"]
         print(str(core).rjust(4) + " | " + \
             str(base).rjust(4) + "  " + \
             str(int(maximum//1000)).rjust(4) + "  " + \
             str(int(minimum//1000)).rjust(4) + " |")
-        if base > freq_p1:
+        if TOPOLOGY[core]["high_priority"]:
             p1_high = p1_high + 1
 
     print("-----|------------------|")
     print("We have " + str(p1_high) + " high priority cores according to sysfs base_frequency.")
 
 
-def list_sst_bf_cores():
-    """Short, comma-separated list of bf cores."""
-
-    freq_p1 = get_cpu_base_frequency()
-    cores = []
-
-    for core in ONLINE_CORES:
-        base = get_sst_bf_frequency(core)
-        if base > freq_p1:
-            cores.append(core)
-    print(*cores, sep=",")
+def format_cpulist(cores):
+    """Convert a list of core ids to a cpulist such as 0-3,8."""
+    ranges = []
+    for core in cores:
+        if ranges and core == ranges[-1][1] + 1:
+            ranges[-1][1] = core
+        else:
+            ranges.append([core, core])
+    return ",".join(str(first) if first == last else "%d-%d" % (first, last)
+                    for first, last in ranges)
 
+def format_mask(cores):
+    """Convert a list of core ids to a hexadecimal coremask."""
     # Coremask may be bigger than 64-bit number, but Python 2 and 3 handle big numbers differently
     # Python 2 has 'long' type while Python 3 uses 'int'.
     try:
@@ -338,30 +469,164 @@ def list_sst_bf_cores():
 
     for core in cores:
         coremask = coremask + (2**core)
-    print(hex(coremask).rstrip('L'))
+    return hex(coremask).rstrip('L')
+
+def order_cores(cores, order="core"):
+    """
+    Order a list of core ids. "core" sorts them by id, "numa" groups them by
+    NUMA node and package and keeps hyperthread siblings next to each other.
+    """
+    if order == "numa":
+        return sorted(cores, key=lambda core: (TOPOLOGY[core]["node"],
+                                               TOPOLOGY[core]["package"],
+                                               min(TOPOLOGY[core]["siblings"]),
+                                               core))
+    return sorted(cores)
+
+def tier_cores(tier):
+    """Get the online high or normal priority cores."""
+    high = tier == "high"
+    return [core for core in ONLINE_CORES if TOPOLOGY[core]["high_priority"] == high]
+
+def print_cores(cores, fmt="list", order="core"):
+    """
+    Print a list of cores as a comma-separated list and coremask ("list"),
+    a cpulist with ranges ("cpulist"), a coremask ("mask"), or JSON with
+    the cores of each package ("json").
+    """
+    cores = order_cores(cores, order)
+    if fmt == "cpulist":
+        print(format_cpulist(sorted(cores)))
+    elif fmt == "mask":
+        print(format_mask(cores))
+    elif fmt == "json":
+        packages = {}
+        for core in cores:
+            packages.setdefault(str(TOPOLOGY[core]["package"]), []).append(core)
+        print(json.dumps(dict((package, {
+            "cores": package_cores,
+            "cpulist": format_cpulist(sorted(package_cores)),
+            "mask": format_mask(package_cores),
+        }) for package, package_cores in packages.items()), indent=4, sort_keys=True))
+    else:
+        print(*cores, sep=",")
+        print(format_mask(cores))
 
-def list_sst_bf_normal_cores():
-    """Short, comma-separated list of bf normal cores."""
+def list_sst_bf_cores(fmt="list", order="core"):
+    """Short, comma-separated list of bf cores."""
 
-    freq_p1 = get_cpu_base_frequency()
-    cores = []
+    print_cores(tier_cores("high"), fmt, order)
 
-    for core in ONLINE_CORES:
-        base = get_sst_bf_frequency(core)
-        if base <= freq_p1:
-            cores.append(core)
-    print(*cores, sep=",")
+def list_sst_bf_normal_cores(fmt="list", order="core"):
+    """Short, comma-separated list of bf normal cores."""
 
-    # Coremask may be bigger than 64-bit number, but Python 2 and 3 handle big numbers differently
-    # Python 2 has 'long' type while Python 3 uses 'int'.
+    print_cores(tier_cores("normal"), fmt, order)
+
+def __enable_cpuset(cgroup_dir):
+    """Enable the cpuset controller for the children of a cgroup."""
+    control_filename = os.path.join(cgroup_dir, "cgroup.subtree_control")
+    with open(control_filename, 'r') as control_file:
+        if "cpuset" in control_file.readline().split():
+            return
+    with open(control_filename, 'w') as control_file:
+        control_file.write("+cpuset")
+
+def write_cgroup_slices(slices):
+    """
+    Set cpuset.cpus of cgroup v2 slices to the cores of a tier, from a list
+    of (slice, tier) pairs. Missing slices are created, and the cpuset
+    controller is enabled on the way down from the cgroup root. Returns
+    the number of slices which could not be set.
+    """
+    if not os.path.exists(os.path.join(CGROUP_ROOT, "cgroup.controllers")):
+        print("ERROR: No cgroup v2 hierarchy mounted at " + CGROUP_ROOT)
+        return len(slices)
+
+    failed = 0
+    for name, tier in slices:
+        cpulist = format_cpulist(tier_cores(tier))
+        cgroup_dir = CGROUP_ROOT
+        try:
+            for part in name.strip("/").split("/"):
+                __enable_cpuset(cgroup_dir)
+                cgroup_dir = os.path.join(cgroup_dir, part)
+                if not os.path.isdir(cgroup_dir):
+                    os.mkdir(cgroup_dir)
+            with open(os.path.join(cgroup_dir, "cpuset.cpus"), 'w') as cpus_file:
+                cpus_file.write(cpulist)
+        except (IOError, OSError) as err:
+            print("WARNING: cannot set cpuset.cpus of %s: %s" % (name, err))
+            failed = failed + 1
+            continue
+        print("%s: %s" % (name, cpulist))
+    return failed
+
+def pwrd_request(sock_path, op, **args):
+    """Send a request to the pwrd daemon and return its response."""
+    args["op"] = op
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
     try:
-        coremask = long(0)
-    except NameError:
-        coremask = int(0)
+        sock.connect(sock_path)
+        sock.sendall(json.dumps(args).encode() + b"\n")
+        response = json.loads(sock.makefile("rb").readline().decode())
+    finally:
+        sock.close()
+    if not response.pop("ok"):
+        raise IOError(response["error"])
+    return response
+
+
+def pwrd_main(sock_path):
+    """Thin client mode, run the -s/-m/-r/-i/-l/-n options through pwrd."""
+    parser = argparse.ArgumentParser(description="Configure SST-BF frequencies")
+    for opt in ('-s', '-m', '-r', '-i', '-l', '-n'):
+        parser.add_argument(opt, action="store_true")
+    parser.add_argument('--pwrd')
+    args = parser.parse_args()
+
+    profile = None
+    if args.s:
+        profile = "sst_bf"
+    elif args.m:
+        profile = "base"
+    elif args.r:
+        profile = "default"
+    if profile:
+        errors = pwrd_request(sock_path, "profile", name=profile)["errors"]
+        for core, err in sorted(errors.items(), key=lambda e: int(e[0])):
+            print("Could not update core %s: %s" % (core, err))
+        args.i = True
+
+    caps = pwrd_request(sock_path, "capabilities")
+    snap = pwrd_request(sock_path, "snapshot")["snapshot"]
+    online = [int(c) for c, state in snap["cores"].items() if state["online"]]
+    online.sort()
+    if not caps["sst_bf_enabled"]:
+        print("No High Priority Cores found. ")
+        print("Please ensure compatible BIOS and Kernel versions are being used.")
+        return -1
+
+    if args.i:
+        print("     |------sysfs-------|")
+        print("Core | base   max   min |")
+        print("-----|------------------|")
+        for core in online:
+            state = snap["cores"][str(core)]
+            print(str(core).rjust(4) + " | " + \
+                str(caps["cores"][str(core)]["sst_bf_base_freq"]).rjust(4) + "  " + \
+                str(state["max_freq"]).rjust(4) + "  " + \
+                str(state["min_freq"]).rjust(4) + " |")
+        print("-----|------------------|")
+        print("We have " + str(len([c for c in online
+                                    if caps["cores"][str(c)]["high_priority"]])) +
+              " high priority cores according to sysfs base_frequency.")
+    if args.l or args.n:
+        cores = [c for c in online
+                 if caps["cores"][str(c)]["high_priority"] == args.l]
+        print(*cores, sep=",")
+        print(hex(sum(2**core for core in cores)))
+    return 0
 
-    for core in cores:
-        coremask = coremask + (2**core)
-    print(hex(coremask).rstrip('L'))
 
 def print_banner():
     """Print script banner."""
@@ -444,6 +709,20 @@ def do_menu():
         print("")
         print("Unknown Option")
 
+#
+# Thin client mode. The pwrd daemon has already discovered the system, so the
+# prerequisite checks are skipped.
+#
+PWRD_PARSER = argparse.ArgumentParser(add_help=False)
+PWRD_PARSER.add_argument('--pwrd')
+PWRD_ARGS = PWRD_PARSER.parse_known_args()[0]
+if PWRD_ARGS.pwrd:
+    try:
+        sys.exit(pwrd_main(PWRD_ARGS.pwrd))
+    except (IOError, OSError) as err:
+        print("pwrd request failed: %s" % err)
+        sys.exit(1)
+
 #
 # Do some prerequesite checks.
 #
@@ -467,10 +746,13 @@ if check_driver() == 0:
 
 CPU_COUNT = getcpu_count()
 
-ONLINE_CORES = list(filter(__is_online, range(0, CPU_COUNT)))
-
 FREQ_P1 = get_cpu_base_frequency()
-BASE = get_sst_bf_frequency(0)
+
+# All subcommands work from this single scan of the cores
+TOPOLOGY = scan_topology()
+ONLINE_CORES = [core for core in range(0, CPU_COUNT) if TOPOLOGY[core]["online"]]
+
+BASE = TOPOLOGY[0]["base"]
 if BASE == FREQ_P1:
     print("ERROR: No High Priority cores found. Is SST-BF enabled in BIOS?")
     print("       (base_frequency equals p1 frequency)")
@@ -481,8 +763,8 @@ if not sst_bf_enabled():
     print("Please ensure compatible BIOS and Kernel versions are being used.")
     sys.exit(-1)
 
-FREQ_P0 = get_cpu_max_frequency(0) // 1000
-FREQ_P1N = get_cpu_min_frequency(0) // 1000
+FREQ_P0 = TOPOLOGY[0]["cpu_max"] // 1000
+FREQ_P1N = TOPOLOGY[0]["cpu_min"] // 1000
 (FREQ_P1_HIGH, FREQ_P1_NORMAL) = get_issbf_cpu_freqs()
 
 SCRIPT_NAME = sys.argv[0]
@@ -535,12 +817,32 @@ PARSER.add_argument('-l', action="store_true", help=HELP_TEXT_L)
 HELP_TEXT_N = "List Normal Priority cores"
 PARSER.add_argument('-n', action="store_true", help=HELP_TEXT_N)
 
+HELP_TEXT_FORMAT = "Output format of -l/-n: comma-separated list and coremask " \
+      "(list), cpulist with ranges (cpulist), coremask (mask) or the cores " \
+      "of each package as JSON (json)"
+PARSER.add_argument('--format', choices=("list", "cpulist", "mask", "json"),
+                    default="list", help=HELP_TEXT_FORMAT)
+
+HELP_TEXT_ORDER = "Order of the -l/-n cores: by core id (core), or grouped " \
+      "by NUMA node with hyperthread siblings kept together (numa)"
+PARSER.add_argument('--order', choices=("core", "numa"), default="core",
+                    help=HELP_TEXT_ORDER)
+
+HELP_TEXT_CGROUP = "Set cpuset.cpus of cgroup v2 SLICE to the high or " \
+      "normal priority cores, e.g. --cgroup hp.slice=high. May be repeated"
+PARSER.add_argument('--cgroup', action="append", metavar='SLICE=TIER',
+                    help=HELP_TEXT_CGROUP)
+
 HELP_TEXT_U = "Set UNCORE frequency, e.g. -u 1800 sets to 1.8GHz"
 PARSER.add_argument('-u', type=int, help=HELP_TEXT_U)
 
 HELP_TEXT_V = "Show script version"
 PARSER.add_argument('-v', action="store_true", help=HELP_TEXT_V)
 
+HELP_TEXT_PWRD = "Send -s/-m/-r/-i/-l/-n requests to the pwrd daemon " \
+      "listening on SOCKET"
+PARSER.add_argument('--pwrd', metavar='SOCKET', help=HELP_TEXT_PWRD)
+
 HELP_TEXT_H = "Print additional help on menu options"
 
 ARGS = PARSER.parse_args()
@@ -558,11 +860,18 @@ if ARGS.i:
     query_sst_bf()
     sys.exit(0)
 if ARGS.l:
-    list_sst_bf_cores()
+    list_sst_bf_cores(ARGS.format, ARGS.order)
     sys.exit(0)
 if ARGS.n:
-    list_sst_bf_normal_cores()
+    list_sst_bf_normal_cores(ARGS.format, ARGS.order)
     sys.exit(0)
+if ARGS.cgroup:
+    SLICES = [tuple(arg.rsplit("=", 1)) for arg in ARGS.cgroup]
+    for SLICE in SLICES:
+        if len(SLICE) != 2 or not SLICE[0] or SLICE[1] not in TIERS:
+            PARSER.error("invalid --cgroup %s, expected SLICE=high or "
+                         "SLICE=normal" % "=".join(SLICE))
+    sys.exit(1 if write_cgroup_slices(SLICES) else 0)
 if ARGS.u:
     __set_uncore(ARGS.u)
     UNCORE_FREQ = __get_uncore()